@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from multiprocessing import Pool
+
+import numpy as np
+
+import configRegistry
+import flightData
+import syntheticData
+
+# Times each stage of the pipeline on a synthetic day and writes the results as JSON
+# Run from the repository root (simASR11 and filterData read the YAML files from there):
+#   python benchmark.py --out bench.json
+#   python benchmark.py --out bench.json --baseline baseline.json   # exits with 1 if a stage got slower than --tolerance
+
+tStart = datetime(2025, 3, 1, tzinfo=timezone.utc)
+scalarFlights = 5 # simulate.scalar only runs the first few flights through simulateFlight
+# Linear SNR_Min for the benchmark scenario. At the scenarios.yaml value hardly any of the synthetic traffic is detected and the
+# simulate and pool stages would only time the rejects, at 0.1 about a third of the flights are
+benchSNRMin = 0.1
+
+def timeRun(func, repeats: int = 1) -> list:
+    # [best of repeats in seconds, what the last run returned]
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return [best, result]
+
+def timeIt(func, repeats: int = 1) -> float:
+    # Best of repeats, in seconds
+    return timeRun(func, repeats)[0]
+
+def countDetections(flightDetects: list) -> int:
+    # Per flight [t, stateIdx, snr] arrays
+    return int(sum(len(detects[0]) for detects in flightDetects))
+
+def getScenario(snrMin: float) -> configRegistry.Scenario:
+    # simASR11's scenario with snrMin
+    import simASR11
+    scenario = simASR11.scenario
+    return configRegistry.makeScenario(scenario.name, scenario.transmitter, scenario.transmitterLocation, scenario.antenna, scenario.receiver,
+                                       scenario.receiverLocation, snrMin)
+
+def benchIngest(paths: dict, processes: int) -> dict:
+    import filterData
+    snapshots = sorted(os.path.join(paths['snapshots'], name) for name in os.listdir(paths['snapshots']))
+
+    def parallel():
+        with Pool(processes) as p:
+            p.map(filterData.filterFile, snapshots, chunksize=16)
+
+    return {
+        'ingest.sequential': timeIt(lambda: [filterData.filterFile(path) for path in snapshots]),
+        'ingest.pool': timeIt(parallel),
+    }
+
+def benchLoad(paths: dict, repeats: int) -> dict:
+    return {
+        'load.json': timeIt(lambda: flightData.loadFlights(paths['json'], tStart), repeats),
+        'load.table': timeIt(lambda: flightData.loadFlights(paths['table'], tStart), repeats),
+    }
+
+def benchGetState(flights: list, lookups: int, repeats: int) -> dict:
+    rng = np.random.default_rng(0)
+    flightIdx = rng.integers(0, len(flights), lookups)
+    t = rng.uniform(0, max(flight.t[-1] for flight in flights), lookups)
+    tSorted = np.sort(t)
+
+    return {
+        'getState.scalar': timeIt(lambda: [flights[idx].getState(tLookup) for idx, tLookup in zip(flightIdx, t)], repeats),
+        'getState.batch': timeIt(lambda: [flight.getStateIndices(tSorted) for flight in flights], repeats),
+    }
+
+def benchSimulate(flights: list, simRange: float, modes: list) -> list:
+    # [seconds, detections] per stage
+    import simASR11
+    import simPool
+
+    results = {}
+    detections = {}
+    for simMode, pulseInterval in modes:
+        stage = f'simulate.{simMode}'
+        if simMode == 'pulse':
+            [results[stage], flightDetects] = timeRun(lambda: simASR11.detectPulseCentric(pulseInterval, simRange, flights))
+            detections[stage] = countDetections(flightDetects)
+            continue
+        if simMode == 'scalar':
+            # The original per pulse simulateFlight, only over the first scalarFlights flights since it is so slow
+            tPulses = np.arange(0, simRange, pulseInterval)
+            [results[stage], flightDetects] = timeRun(lambda: [simASR11.simulateFlight(tPulses, flight) for flight in flights[:scalarFlights]])
+            detections[stage] = int(sum(len(detects) for detects in flightDetects))
+            continue
+
+        simulate = simPool.getSimulator(simMode, pulseInterval, simRange)
+        pulseCount = simASR11.getPulseCount(pulseInterval, simRange)
+        if simMode == 'compiled':
+            simulate(flights[0], 0, 1) # Compile outside of the timed region
+        [results[stage], flightDetects] = timeRun(lambda: [simulate(flight, 0, pulseCount) for flight in flights])
+        detections[stage] = countDetections(flightDetects)
+    return [results, detections]
+
+def benchPool(paths: dict, flights: list, simRange: float, simMode: str, pulseInterval: float, processCounts: list) -> list:
+    # [seconds, detections] per stage
+    import simPool
+    results = {}
+    detections = {}
+    for processes in processCounts:
+        stage = f'pool.{simMode}.{processes}'
+        [results[stage], flightDetects] = timeRun(lambda: simPool.runPool(paths['table'], tStart, simMode, pulseInterval, simRange, flights, processes))
+        detections[stage] = countDetections(flightDetects)
+    return [results, detections]
+
+def compareBaseline(results: dict, baseline: dict, tolerance: float) -> list:
+    # Returns [stage, baseline, now] for every stage that got slower by more than tolerance or whose detection count changed
+    regressions = []
+    for stage, count in results['detections'].items():
+        before = baseline.get('detections', {}).get(stage)
+        if before is not None and before != count:
+            print(f"{stage} made {count} detections, {before} in the baseline")
+            regressions.append([stage, before, count])
+
+    print(f"{'stage':<28}{'baseline':>12}{'now':>12}{'ratio':>8}")
+    for stage, seconds in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]
+        ratio = seconds / before if before > 0 else np.inf
+        flag = " <--" if ratio > 1 + tolerance else ""
+        print(f"{stage:<28}{before:>12.4f}{seconds:>12.4f}{ratio:>8.2f}{flag}")
+        if ratio > 1 + tolerance:
+            regressions.append([stage, before, seconds])
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the simulation pipeline on a synthetic day")
+    parser.add_argument('--aircraft', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=3600, help="seconds of traffic to generate and simulate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--categories', nargs='+', default=None, help="ADS-B categories to draw from, default all")
+    parser.add_argument('--gap-probability', type=float, default=0.01, help="chance per snapshot of an ADS-B drop out starting")
+    parser.add_argument('--processes', type=int, nargs='+', default=None, help="process counts for the pool scaling stage")
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=['ingest', 'load', 'getState', 'simulate', 'pool'])
+    parser.add_argument('--snr-min', type=float, default=benchSNRMin, help="linear SNR_Min of the scenario the simulate and pool stages run")
+    parser.add_argument('--data', default=None, help="directory for the synthetic data, default is a temporary directory")
+    parser.add_argument('--out', default="bench_output.json")
+    parser.add_argument('--baseline', default=None, help="earlier --out file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slow down before a stage counts as a regression")
+    args = parser.parse_args()
+
+    processCounts = args.processes or sorted(set([1, 2, 4, os.cpu_count()]))
+    dataPath = args.data or tempfile.mkdtemp(prefix="bistaticBench")
+
+    start = time.perf_counter()
+    paths = syntheticData.generateDay(dataPath, args.aircraft, args.duration, args.seed, writeRaw='ingest' in args.stages,
+                                      categories=args.categories, gapProbability=args.gap_probability)
+    print(f"Generated synthetic day in {round(time.perf_counter() - start, 2)}s at {dataPath}")
+    flights = flightData.loadFlights(paths['table'], tStart)
+
+    stages = {}
+    detections = {}
+    if 'simulate' in args.stages or 'pool' in args.stages:
+        import simASR11
+        simASR11.setScenario(getScenario(args.snr_min)) # Pool workers are handed the same scenario
+    if 'ingest' in args.stages:
+        stages.update(benchIngest(paths, processCounts[-1]))
+    if 'load' in args.stages:
+        stages.update(benchLoad(paths, args.repeats))
+    if 'getState' in args.stages:
+        stages.update(benchGetState(flights, args.lookups, args.repeats))
+    if 'simulate' in args.stages:
+        [times, counts] = benchSimulate(flights, args.duration, [['scalar', 1e-2], ['batch', 1e-2], ['compiled', 1e-2], ['beam', 1e-3], ['pulse', 1e-3]])
+        stages.update(times)
+        detections.update(counts)
+    if 'pool' in args.stages:
+        [times, counts] = benchPool(paths, flights, args.duration, 'beam', 1e-3, processCounts)
+        stages.update(times)
+        detections.update(counts)
+
+    results = {
+        'config': vars(args) | {'flights': len(flights), 'messages': int(sum(len(flight) for flight in flights))},
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'cpus': os.cpu_count(), 'machine': platform.machine()},
+        'stages': stages,
+        'detections': detections, # A stage that stops detecting would otherwise only show up as getting faster
+    }
+    with open(args.out, 'w') as outFile:
+        json.dump(results, outFile, indent=2)
+    for stage, seconds in stages.items():
+        count = f"{detections[stage]:>12} detections" if stage in detections else ""
+        print(f"{stage:<28}{seconds:>12.4f}s{count}")
+    if any(count == 0 for count in detections.values()):
+        print("Some stages made no detections, lower --snr-min so they time the detection path")
+
+    if args.baseline is not None:
+        with open(args.baseline) as baselineFile:
+            regressions = compareBaseline(results, json.load(baselineFile), args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} stages regressed by more than {round(args.tolerance * 100)}% or changed their detections")
+            sys.exit(1)
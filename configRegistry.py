@@ -0,0 +1,170 @@
+from typing import NamedTuple, Tuple
+import os
+import pickle
+
+import numpy as np
+import pymap3d
+import scipy.constants
+
+# Shared access to the YAML configs (transmitters, receivers, antennas, targets, locations, scenarios)
+# The YAML is parsed at most once per process, on first use, and the parsed result is pickled to __pycache__/config.pickle
+# so later processes (and pool workers) skip YAML parsing entirely until one of the files' mtime changes
+# Entries come back as immutable NamedTuples of plain floats, cheap to pickle to workers and usable as kernel arguments
+
+configDir = os.path.dirname(os.path.abspath(__file__))
+configFiles = ['transmitters', 'receivers', 'antennas', 'targets', 'locations', 'scenarios']
+cachePath = os.path.join(configDir, "__pycache__", "config.pickle")
+scenarioVariable = "SCENARIO" # Environment variable that overrides a script's default scenario
+
+def linear2db(l: float) -> float:
+    return 10*np.log10(l)
+
+def db2linear(db: float) -> float:
+    return 10**(db/10)
+
+class Transmitter(NamedTuple):
+    name: str
+    Pt: float  # Transmitter power
+    Gt: float  # Transmitter gain, linear
+    Fc: float  # Transmitter frequency
+    Tau: float # Transmitter pulse width, nan if unknown
+
+class Receiver(NamedTuple):
+    name: str
+    F: float  # Receiver noise figure, dB
+    T: float  # Receiver temperature
+    BW: float # Receiver bandwidth
+
+class Antenna(NamedTuple):
+    name: str
+    Gr: float # Receiver antenna gain, linear
+
+class Target(NamedTuple):
+    name: str
+    RCS: float
+
+class Location(NamedTuple):
+    name: str
+    LLA: Tuple[float, float, float]
+    ECEF: Tuple[float, float, float]
+
+class Scenario(NamedTuple):
+    name: str
+    transmitter: Transmitter
+    transmitterLocation: Location
+    antenna: Antenna
+    receiver: Receiver
+    receiverLocation: Location
+    SNR_Min: float       # As given, see scenarios.yaml
+    wavelength: float
+    powerScalar: float   # Pt*Gt*Gr*wavelength^2 / (4pi)^3, Pr = powerScalar * RCS / (Rt^2 * Rr^2)
+    noise: float         # https://en.wikipedia.org/wiki/Minimum_detectable_signal#General
+
+registry: dict = None
+scenarioCache = {}
+
+def getMtimes() -> dict:
+    return {name: os.stat(os.path.join(configDir, name + ".yaml")).st_mtime_ns for name in configFiles}
+
+def loadRegistry() -> dict:
+    # Parsed YAML keyed by file, from the pickle cache when it is newer than every YAML file
+    mtimes = getMtimes()
+    try:
+        with open(cachePath, 'rb') as cacheFile:
+            cached = pickle.load(cacheFile)
+        if cached['mtimes'] == mtimes:
+            return cached['data']
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+        pass
+
+    import yaml # Only needed when the cache is stale
+    data = {}
+    for name in configFiles:
+        with open(os.path.join(configDir, name + ".yaml")) as stream:
+            data[name] = yaml.safe_load(stream) or {}
+
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        tmpPath = f"{cachePath}.{os.getpid()}.tmp"
+        with open(tmpPath, 'wb') as cacheFile:
+            pickle.dump({'mtimes': mtimes, 'data': data}, cacheFile)
+        os.replace(tmpPath, cachePath)
+    except OSError:
+        pass # Read only checkout, parse again next time
+    return data
+
+def getRegistry() -> dict:
+    global registry
+    if registry is None:
+        registry = loadRegistry()
+    return registry
+
+def getEntry(file: str, name: str) -> dict:
+    entries = getRegistry()[file]
+    if name not in entries:
+        raise KeyError(f"{name} not found in {file}.yaml")
+    return entries[name] or {}
+
+def getNames(file: str) -> list:
+    # Every entry of e.g. 'locations', in file order
+    return list(getRegistry()[file].keys())
+
+def reload():
+    # Drops the parsed configs so the next lookup reads them again, e.g. after editing a YAML file from a notebook
+    global registry
+    registry = None
+    scenarioCache.clear()
+
+def getTransmitter(name: str) -> Transmitter:
+    entry = getEntry('transmitters', name)
+    return Transmitter(name, float(entry['Pt']), db2linear(float(entry['Gt'])), float(entry['Fc']), float(entry.get('Tau', 'nan')))
+
+def getReceiver(name: str) -> Receiver:
+    entry = getEntry('receivers', name)
+    return Receiver(name, float(entry['F']), float(entry['T']), float(entry['BW']))
+
+def getAntenna(name: str) -> Antenna:
+    return Antenna(name, db2linear(float(getEntry('antennas', name)['Gr'])))
+
+def getTarget(name: str) -> Target:
+    return Target(name, float(getEntry('targets', name)['RCS']))
+
+def makeLocation(name: str, LLA: list) -> Location:
+    LLA = tuple(float(value) for value in LLA)
+    return Location(name, LLA, tuple(float(value) for value in pymap3d.geodetic2ecef(*LLA)))
+
+def getLocation(name: str) -> Location:
+    return makeLocation(name, getEntry('locations', name)['LLA'])
+
+def getSiteLocation(site) -> Location:
+    # Scenarios give a site either as a locations.yaml name or as an inline [lat, lon, alt]
+    if isinstance(site, str):
+        return getLocation(site)
+    return makeLocation(str(site), site)
+
+def makeScenario(name: str, transmitter: Transmitter, transmitterLocation: Location, antenna: Antenna, receiver: Receiver,
+                 receiverLocation: Location, SNR_Min: float) -> Scenario:
+    wavelength = scipy.constants.c / transmitter.Fc
+    wavelength2 = wavelength*wavelength
+    powerScalar = (transmitter.Pt*transmitter.Gt*antenna.Gr*wavelength2) / ((4*np.pi)**3)
+    noise = db2linear(linear2db(scipy.constants.k*receiver.T) + receiver.F + linear2db(receiver.BW))
+    return Scenario(name, transmitter, transmitterLocation, antenna, receiver, receiverLocation, float(SNR_Min), wavelength, powerScalar, noise)
+
+def getScenario(name: str) -> Scenario:
+    if name in scenarioCache:
+        return scenarioCache[name]
+
+    entry = getEntry('scenarios', name)
+    scenario = makeScenario(name, getTransmitter(entry['transmitter']), getSiteLocation(entry['transmitterLocation']), getAntenna(entry['antenna']),
+                            getReceiver(entry['receiver']), getSiteLocation(entry['receiverLocation']), entry['SNR_Min'])
+    scenarioCache[name] = scenario
+    return scenario
+
+def selectScenario(default: str) -> Scenario:
+    # The scenario named by the SCENARIO environment variable if set, otherwise default
+    return getScenario(os.environ.get(scenarioVariable) or default)
+
+def getElevationAngle(scenario: Scenario) -> float:
+    # Elevation of the receiver seen from the transmitter, as the scripts have always printed it
+    transmitter2targetENU = np.array(pymap3d.ecef2enu(*scenario.receiverLocation.ECEF, *scenario.transmitterLocation.LLA))
+    return np.rad2deg(np.tan(transmitter2targetENU[2] / np.sqrt(transmitter2targetENU[0]**2 + transmitter2targetENU[1]**2)))
@@ -0,0 +1,160 @@
+from typing import List
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pymap3d
+
+import configRegistry
+
+# Detectability maps from the link_budget.py radar equation over a whole lat/lon/altitude grid instead of one target position
+# For every grid point: Pr = powerScalar * RCS / (Rt^2 Rr^2), SNR = Pr / N and margin = Pr - MDS with MDS = N + SNR_Min in dB,
+# the same numbers link_budget.py prints for a single targetLLA
+# The grid's ECEF is the slow part and only depends on the grid, so it is converted once and kept under cachePath as a memory
+# mapped .npy, every transmitter/receiver/target after that is a chunked pass of ranges and dB over it
+# Rasters are float32 .npy files shaped (altitude, lat, lon) with a coverage.json describing the axes and the link
+# Run from the repository root:
+#   python coverageMap.py --out FlightData/coverage/
+#   python coverageMap.py --scenario "ASR-11 Clairemont Hills" --receiver-site "Mount Jurupa" --target "Cessna C172" --lat 33.8 34.3 500
+
+cachePath = "FlightData/.coverageCache/"
+RASTERS = ['Pr', 'SNR', 'margin'] # dB
+
+def linear2db(l):
+    return 10*np.log10(l)
+
+def getAxes(lat: List[float], lon: List[float], alt: List[float]) -> List[np.ndarray]:
+    # [min, max, count] per axis to the grid's coordinates
+    return [np.linspace(axis[0], axis[1], int(axis[2])) for axis in [lat, lon, alt]]
+
+def gridKey(lats: np.ndarray, lons: np.ndarray, alts: np.ndarray) -> str:
+    digest = hashlib.sha1()
+    for axis in [lats, lons, alts]:
+        digest.update(np.ascontiguousarray(axis, dtype=float).tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+def buildGridECEF(path: str, lats: np.ndarray, lons: np.ndarray, alts: np.ndarray):
+    # Converted one altitude x latitude row at a time into a memory mapped file that's moved into place when complete
+    tmpPath = path + ".tmp.npy"
+    ECEF = np.lib.format.open_memmap(tmpPath, mode='w+', dtype=float, shape=(len(alts), len(lats), len(lons), 3))
+    [latGrid, lonGrid] = np.meshgrid(lats, lons, indexing='ij')
+    for altIdx, alt in enumerate(alts):
+        ECEF[altIdx] = np.stack(pymap3d.geodetic2ecef(latGrid, lonGrid, np.full(latGrid.shape, alt)), axis=-1)
+    ECEF.flush()
+    del ECEF
+    os.replace(tmpPath, path)
+
+def getGridECEF(lats: np.ndarray, lons: np.ndarray, alts: np.ndarray, cacheDir: str = cachePath) -> np.ndarray:
+    # (altitude, lat, lon, 3) ECEF of every grid point, memory mapped from the cache and built on a miss
+    path = os.path.join(cacheDir, gridKey(lats, lons, alts) + ".ecef.npy")
+    if not os.path.exists(path):
+        os.makedirs(cacheDir, exist_ok=True)
+        buildGridECEF(path, lats, lons, alts)
+    return np.load(path, mmap_mode='r')
+
+def computeCoverage(ECEF: np.ndarray, scenario: configRegistry.Scenario, RCS: float, outDir: str = None, chunkSize: int = 1000000) -> dict:
+    # Pr, SNR and margin rasters shaped like the grid, written chunkSize points at a time
+    # With outDir they are memory mapped .npy files in it, otherwise in memory arrays
+    shape = ECEF.shape[:-1]
+    rasters = {}
+    for name in RASTERS:
+        if outDir is None:
+            rasters[name] = np.empty(shape, dtype=np.float32)
+        else:
+            rasters[name] = np.lib.format.open_memmap(os.path.join(outDir, name + ".npy"), mode='w+', dtype=np.float32, shape=shape)
+
+    points = ECEF.reshape(-1, 3)
+    flat = {name: raster.reshape(-1) for name, raster in rasters.items()}
+    transmitterECEF = np.array(scenario.transmitterLocation.ECEF)
+    receiverECEF = np.array(scenario.receiverLocation.ECEF)
+    noiseDB = linear2db(scenario.noise)
+    MDS = noiseDB + scenario.SNR_Min
+    for chunkStart in range(0, len(points), chunkSize):
+        rows = slice(chunkStart, chunkStart + chunkSize)
+        chunk = np.asarray(points[rows])
+        Rt = np.linalg.norm(chunk - transmitterECEF, axis=1)
+        Rr = np.linalg.norm(chunk - receiverECEF, axis=1)
+        with np.errstate(divide='ignore'): # A grid point on top of a site has infinite power
+            PrDB = linear2db((scenario.powerScalar*RCS) / ((Rt*Rt)*(Rr*Rr)))
+        flat['Pr'][rows] = PrDB
+        flat['SNR'][rows] = PrDB - noiseDB
+        flat['margin'][rows] = PrDB - MDS
+
+    for raster in rasters.values():
+        if isinstance(raster, np.memmap):
+            raster.flush()
+    return rasters
+
+def summarize(rasters: dict, alts: np.ndarray) -> List[dict]:
+    # Share of the map with a positive margin at each altitude
+    return [{'altitude': float(alt), 'detectableFraction': float(np.count_nonzero(rasters['margin'][altIdx] > 0) / rasters['margin'][altIdx].size),
+             'maxMargin': float(rasters['margin'][altIdx].max())} for altIdx, alt in enumerate(alts)]
+
+def writeMetadata(path: str, scenario: configRegistry.Scenario, target: configRegistry.Target, lats: np.ndarray, lons: np.ndarray, alts: np.ndarray,
+                  levels: List[dict]):
+    with open(path, 'w') as outFile:
+        json.dump({
+            'scenario': scenario.name,
+            'transmitter': scenario.transmitter.name,
+            'transmitterLLA': scenario.transmitterLocation.LLA,
+            'receiver': scenario.receiver.name,
+            'antenna': scenario.antenna.name,
+            'receiverLLA': scenario.receiverLocation.LLA,
+            'target': target.name,
+            'RCS': target.RCS,
+            'SNR_Min': scenario.SNR_Min,
+            'rasters': {name: name + ".npy" for name in RASTERS},
+            'shape': [len(alts), len(lats), len(lons)], # altitude, lat, lon
+            'lat': [float(lats[0]), float(lats[-1]), len(lats)],
+            'lon': [float(lons[0]), float(lons[-1]), len(lons)],
+            'alt': [float(alts[0]), float(alts[-1]), len(alts)],
+            'levels': levels,
+        }, outFile, indent=2)
+
+def loadCoverage(path: str, mmap: bool = True) -> dict:
+    # coverage.json plus its rasters, memory mapped by default
+    with open(os.path.join(path, "coverage.json")) as inFile:
+        metadata = json.load(inFile)
+    mode = 'r' if mmap else None
+    metadata['rasters'] = {name: np.load(os.path.join(path, fileName), mmap_mode=mode) for name, fileName in metadata['rasters'].items()}
+    return metadata
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Received power, SNR and margin over a lat/lon/altitude grid")
+    parser.add_argument('--scenario', default=None, help="scenarios.yaml entry, default the SCENARIO environment variable or link_budget's")
+    parser.add_argument('--transmitter-site', default=None, help="locations.yaml entry to move the transmitter to")
+    parser.add_argument('--receiver-site', default=None, help="locations.yaml entry to move the receiver to")
+    parser.add_argument('--target', default="Boeing 737")
+    parser.add_argument('--lat', nargs=3, type=float, default=None, metavar=('MIN', 'MAX', 'COUNT'), help="default 1 degree around the transmitter, 1000 points")
+    parser.add_argument('--lon', nargs=3, type=float, default=None, metavar=('MIN', 'MAX', 'COUNT'))
+    parser.add_argument('--alt', nargs=3, type=float, default=[0, 12000, 20], metavar=('MIN', 'MAX', 'COUNT'), help="meters")
+    parser.add_argument('--out', default="FlightData/coverage/")
+    args = parser.parse_args()
+
+    scenario = configRegistry.getScenario(args.scenario) if args.scenario else configRegistry.selectScenario('WSR-88D Mount Jurupa')
+    transmitterLocation = configRegistry.getLocation(args.transmitter_site) if args.transmitter_site else scenario.transmitterLocation
+    receiverLocation = configRegistry.getLocation(args.receiver_site) if args.receiver_site else scenario.receiverLocation
+    scenario = configRegistry.makeScenario(scenario.name, scenario.transmitter, transmitterLocation, scenario.antenna, scenario.receiver,
+                                           receiverLocation, scenario.SNR_Min)
+    target = configRegistry.getTarget(args.target)
+    [lat0, lon0, _] = transmitterLocation.LLA
+    [lats, lons, alts] = getAxes(args.lat or [lat0 - 1, lat0 + 1, 1000], args.lon or [lon0 - 1, lon0 + 1, 1000], args.alt)
+
+    start = time.time()
+    ECEF = getGridECEF(lats, lons, alts)
+    print(f"Grid of {ECEF.shape[0]}x{ECEF.shape[1]}x{ECEF.shape[2]} points ready in {round(time.time() - start, 2)}s")
+
+    start = time.time()
+    os.makedirs(args.out, exist_ok=True)
+    rasters = computeCoverage(ECEF, scenario, target.RCS, args.out)
+    levels = summarize(rasters, alts)
+    writeMetadata(os.path.join(args.out, "coverage.json"), scenario, target, lats, lons, alts, levels)
+    print(f"Coverage for {scenario.transmitter.name} at {transmitterLocation.name} -> {scenario.receiver.name} at {receiverLocation.name} "
+          f"({target.name}) in {round(time.time() - start, 2)}s")
+
+    for level in levels:
+        print(f"{round(level['altitude']):>8}m {round(100*level['detectableFraction'], 1):>6}% detectable, max margin {round(level['maxMargin'], 1)} dB")
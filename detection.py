@@ -1,13 +1,19 @@
 from datetime import datetime
+from typing import List
 import struct
+import os
 
-from flightData import FlightState
+import numpy as np
+
+from flightData import FlightState, Flight
 
 class Detection():
     t: float
     snr: float
     state: FlightState
 
+    format = "!df"
+
     def __init__(self, t:float, state: FlightState, snr:float):
         self.t = t
         self.state = state
@@ -17,13 +23,108 @@ class Detection():
         return f"{self.t} - {self.snr} - {self.state.LLA}"
 
     def pack(self) -> bytes:
-        return struct.pack("!ff", self.t, self.snr) + self.state.pack()
+        return struct.pack(self.format, self.t, self.snr) + self.state.pack()
 
     def unpack(self, data: bytes):
-        format = "!ff"
-        size = struct.calcsize(format)
-        members = self.unpack(format, data[0:size])
+        size = struct.calcsize(self.format)
+        members = struct.unpack(self.format, data[0:size])
         self.t = members[0]
         self.snr = members[1]
+        if self.state is None:
+            self.state = FlightState(0.0, None, None, None)
         self.state.unpack(data[size:])
         return self
+
+
+# Batch detection format, one record per detection in a NumPy structured array
+# Files are a 16 byte header followed by the raw records, so they can be appended to and memory mapped without parsing
+# t and positions are doubles (ECEF needs them), SNR and AER are fine as 32 bit floats
+DETECTION_DTYPE = np.dtype([
+    ('t', 'f8'),         # seconds since tStart
+    ('snr', 'f4'),       # linear
+    ('id', 'S8'),        # flight id (ICAO hex)
+    ('category', 'S2'),
+    ('stateIdx', 'i4'),  # row of the flight's ADS-B arrays that was detected
+    ('LLA', 'f8', (3,)),
+    ('ECEF', 'f8', (3,)),
+    ('AER', 'f4', (3,)),
+])
+DETECTION_MAGIC = b'BISTDET\x00'
+DETECTION_VERSION = 1
+DETECTION_HEADER = struct.pack("<8sII", DETECTION_MAGIC, DETECTION_VERSION, DETECTION_DTYPE.itemsize)
+
+def toRecords(flight: Flight, detections: List[np.ndarray]) -> np.ndarray:
+    # [t, stateIdx, snr] arrays from simASR11.detect* to records
+    [t, stateIdx, snr] = detections
+    records = np.empty(len(t), dtype=DETECTION_DTYPE)
+    records['t'] = t
+    records['snr'] = snr
+    records['id'] = flight.id
+    records['category'] = flight.category
+    records['stateIdx'] = stateIdx
+    records['LLA'] = flight.LLA[stateIdx]
+    records['ECEF'] = flight.ECEF[stateIdx]
+    records['AER'] = flight.AER[stateIdx]
+    return records
+
+def chunkToRecords(flights: List[Flight], chunk: List[np.ndarray]) -> np.ndarray:
+    # [flightIdx, t, stateIdx, snr] chunks from detectionStream to records, keeping the chunk's row order
+    [flightIdx, t, stateIdx, snr] = chunk
+    records = np.empty(len(t), dtype=DETECTION_DTYPE)
+    records['t'] = t
+    records['snr'] = snr
+    records['stateIdx'] = stateIdx
+    # Rows grouped by flight with one sort, as detectionStream.CSVSink does
+    order = np.argsort(flightIdx, kind='stable')
+    bounds = np.searchsorted(flightIdx[order], np.arange(len(flights) + 1))
+    for idx in np.flatnonzero(np.diff(bounds)):
+        rows = order[bounds[idx]:bounds[idx+1]]
+        flight = flights[idx]
+        records['id'][rows] = flight.id
+        records['category'][rows] = flight.category
+        records['LLA'][rows] = flight.LLA[stateIdx[rows]]
+        records['ECEF'][rows] = flight.ECEF[stateIdx[rows]]
+        records['AER'][rows] = flight.AER[stateIdx[rows]]
+    return records
+
+def fromRecords(records: np.ndarray) -> List[Detection]:
+    # Back to Detection objects, only for small selections
+    return [Detection(float(record['t']), FlightState(float(record['t']), record['LLA'].copy(), record['ECEF'].copy(), record['AER'].astype(float)), float(record['snr']))
+            for record in records]
+
+def checkHeader(header: bytes, path: str):
+    [magic, version, itemsize] = struct.unpack("<8sII", header)
+    if magic != DETECTION_MAGIC or version != DETECTION_VERSION or itemsize != DETECTION_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a version {DETECTION_VERSION} detection file")
+
+def writeDetections(path: str, records: np.ndarray):
+    # Written next to path then moved into place so readers never see a half written file
+    tmpPath = path + ".part"
+    with open(tmpPath, 'wb') as outFile:
+        outFile.write(DETECTION_HEADER)
+        outFile.write(np.ascontiguousarray(records, dtype=DETECTION_DTYPE).tobytes())
+    os.replace(tmpPath, path)
+
+def appendDetections(path: str, records: np.ndarray):
+    # Creates the file if needed, a partial record left by an interrupted append is cut off first
+    if not os.path.exists(path):
+        writeDetections(path, records)
+        return
+    with open(path, 'r+b') as outFile:
+        checkHeader(outFile.read(len(DETECTION_HEADER)), path)
+        end = len(DETECTION_HEADER) + getDetectionCount(path) * DETECTION_DTYPE.itemsize
+        outFile.truncate(end)
+        outFile.seek(end)
+        outFile.write(np.ascontiguousarray(records, dtype=DETECTION_DTYPE).tobytes())
+
+def getDetectionCount(path: str) -> int:
+    return (os.path.getsize(path) - len(DETECTION_HEADER)) // DETECTION_DTYPE.itemsize
+
+def readDetections(path: str, mmap: bool = True) -> np.ndarray:
+    # Memory mapped (read only) by default, the whole file is only read when a column is used
+    with open(path, 'rb') as inFile:
+        checkHeader(inFile.read(len(DETECTION_HEADER)), path)
+        count = getDetectionCount(path)
+        if not mmap or count == 0:
+            return np.frombuffer(inFile.read(count * DETECTION_DTYPE.itemsize), dtype=DETECTION_DTYPE)
+    return np.memmap(path, dtype=DETECTION_DTYPE, mode='r', offset=len(DETECTION_HEADER), shape=(count,))
@@ -0,0 +1,179 @@
+from typing import List, Iterable, Iterator
+import os
+
+import numpy as np
+
+import flightData
+import detection
+import simASR11
+import simPool
+
+# Streaming version of the sim.py pipeline for runs too long to hold every detection in memory
+# Detections come out of a generator as [flightIdx, t, stateIdx, snr] pieces, are regrouped into chunks of a fixed number of rows,
+# handed to a sink that writes them out as they arrive and reduced into DetectionStats on the way
+# Memory is bounded by the chunk size and the simulation window, not by how long the simulation is
+
+def iterDetections(flights: List[flightData.Flight], simMode: str, pulseInterval: float, simRange: float, windowTime: float = 3600) -> Iterator[List[np.ndarray]]:
+    # Single process generator, simulates every flight over one windowTime slice of the timeline at a time
+    simulate = simPool.getSimulator(simMode, pulseInterval, simRange)
+    pulseCount = simASR11.getPulseCount(pulseInterval, simRange)
+    active = np.array([simPool.getActivePulses(flight, pulseInterval, pulseCount) for flight in flights], dtype=np.int64).reshape(-1, 2)
+    windowPulses = max(int(round(windowTime / pulseInterval)), 1)
+
+    for windowFirst in range(0, pulseCount, windowPulses):
+        windowEnd = min(windowFirst + windowPulses, pulseCount)
+        for flightIdx in np.flatnonzero((active[:, 0] < windowEnd) & (active[:, 1] > windowFirst)):
+            [t, stateIdx, snr] = simulate(flights[flightIdx], max(active[flightIdx, 0], windowFirst), min(active[flightIdx, 1], windowEnd))
+            if len(t) > 0:
+                yield [np.full(len(t), flightIdx, dtype=np.int32), t, stateIdx, snr]
+
+def iterPoolDetections(flightPath: str, tStart, simMode: str, pulseInterval: float, simRange: float, flights: List[flightData.Flight], processes: int = None) -> Iterator[List[np.ndarray]]:
+    # Pool generator, pieces arrive in the order the shards finish
+    for [flightIdx, _, [t, stateIdx, snr]] in simPool.iterPool(flightPath, tStart, simMode, pulseInterval, simRange, flights, processes):
+        if len(t) > 0:
+            yield [np.full(len(t), flightIdx, dtype=np.int32), t, stateIdx, snr]
+
+def iterFlightDetections(flightDetects: List[List[np.ndarray]]) -> Iterator[List[np.ndarray]]:
+    # Pieces from an in memory result with one [t, stateIdx, snr] per flight, like simASR11.detectPulseCentric returns
+    for flightIdx, [t, stateIdx, snr] in enumerate(flightDetects):
+        if len(t) > 0:
+            yield [np.full(len(t), flightIdx, dtype=np.int32), t, stateIdx, snr]
+
+def chunkDetections(pieces: Iterable[List[np.ndarray]], chunkSize: int = 100000) -> Iterator[List[np.ndarray]]:
+    # Regroups pieces of any size into [flightIdx, t, stateIdx, snr] chunks of exactly chunkSize rows, the last one may be short
+    # Buffered pieces are concatenated once per full chunk, a piece many chunks long is then sliced from an offset
+    # rather than copied again for every chunk taken out of it
+    buffered = []
+    bufferedRows = 0
+    for piece in pieces:
+        buffered.append(piece)
+        bufferedRows += len(piece[0])
+        if bufferedRows < chunkSize:
+            continue
+        columns = [np.concatenate(column) for column in zip(*buffered)]
+        offset = 0
+        while bufferedRows - offset >= chunkSize:
+            yield [column[offset:offset + chunkSize] for column in columns]
+            offset += chunkSize
+        buffered = [[column[offset:] for column in columns]]
+        bufferedRows -= offset
+    if bufferedRows > 0:
+        yield [np.concatenate(column) for column in zip(*buffered)]
+
+
+class DetectionStats():
+    # Running totals over the chunks seen so far, one slot per flight so the size doesn't depend on the simulated time
+    def __init__(self, flightCount: int):
+        self.total = 0
+        self.counts = np.zeros(flightCount, dtype=np.int64)
+        self.firstT = np.full(flightCount, np.inf)
+        self.firstStateIdx = np.full(flightCount, -1, dtype=np.int32)
+        self.firstSNR = np.full(flightCount, np.nan)
+        self.maxSNR = np.full(flightCount, -np.inf)
+        self.tMin = np.inf
+        self.tMax = -np.inf
+
+    def update(self, chunk: List[np.ndarray]):
+        [flightIdx, t, stateIdx, snr] = chunk
+        if len(t) == 0:
+            return
+        self.total += len(t)
+        self.tMin = min(self.tMin, t.min())
+        self.tMax = max(self.tMax, t.max())
+        self.counts += np.bincount(flightIdx, minlength=len(self.counts))
+        np.maximum.at(self.maxSNR, flightIdx, snr)
+
+        # Earliest detection of each flight in the chunk, then keep it where it beats what we already had
+        order = np.lexsort((t, flightIdx))
+        first = order[np.flatnonzero(np.diff(flightIdx[order], prepend=-1))]
+        earlier = t[first] < self.firstT[flightIdx[first]]
+        first = first[earlier]
+        self.firstT[flightIdx[first]] = t[first]
+        self.firstStateIdx[flightIdx[first]] = stateIdx[first]
+        self.firstSNR[flightIdx[first]] = snr[first]
+
+    def detectedFlights(self) -> np.ndarray:
+        return np.flatnonzero(self.counts)
+
+    def report(self, flights: List[flightData.Flight]):
+        # Same summary sim.py prints for an in memory run
+        print(f"Detected {len(self.detectedFlights())} flights")
+        for idx in self.detectedFlights():
+            flight = flights[idx]
+            print(f"Target {flight.id} with cat {flight.category} detected {self.counts[idx]} times:")
+            print(f"detects[0] - {flight.LLA[self.firstStateIdx[idx]]} - snr = {self.firstSNR[idx]}")
+
+
+class NullSink():
+    # Keeps nothing, for runs that only want DetectionStats
+    def write(self, chunk: List[np.ndarray]):
+        pass
+
+    def close(self):
+        pass
+
+class CSVSink():
+    # One line per detection, appended chunk by chunk
+    header = "id,category,t,snr,lat,lon,alt,az,el,range\n"
+
+    def __init__(self, path: str, flights: List[flightData.Flight]):
+        self.flights = flights
+        self.ids = np.array([flight.id for flight in flights])
+        self.categories = np.array([flight.category for flight in flights])
+        self.tmpPath = path + ".part"
+        self.path = path
+        self.file = open(self.tmpPath, 'w')
+        self.file.write(self.header)
+
+    def write(self, chunk: List[np.ndarray]):
+        [flightIdx, t, stateIdx, snr] = chunk
+        if len(t) == 0:
+            return
+
+        # Rows grouped by flight with one sort, then each flight's states are gathered in one go
+        order = np.argsort(flightIdx, kind='stable')
+        bounds = np.searchsorted(flightIdx[order], np.arange(len(self.flights) + 1))
+        LLA = np.empty((len(t), 3))
+        AER = np.empty((len(t), 3))
+        for idx in np.flatnonzero(np.diff(bounds)):
+            rows = order[bounds[idx]:bounds[idx+1]]
+            LLA[rows] = self.flights[idx].LLA[stateIdx[rows]]
+            AER[rows] = self.flights[idx].AER[stateIdx[rows]]
+
+        # Whole columns to text at once and the chunk written in one call, same text as formatting each value on its own
+        columns = [self.ids[flightIdx], self.categories[flightIdx], t, snr, *LLA.T, *AER.T]
+        lines = map(','.join, zip(*[map(str, column.tolist()) for column in columns]))
+        self.file.write('\n'.join(lines) + '\n')
+
+    def close(self):
+        # Only shows up under its real name once complete
+        self.file.close()
+        os.replace(self.tmpPath, self.path)
+
+class DetectionFileSink():
+    # Appends each chunk to a detection.py records file, readable with detection.readDetections even while the run is going
+    def __init__(self, path: str, flights: List[flightData.Flight]):
+        self.flights = flights
+        self.path = path
+        detection.writeDetections(path, np.empty(0, dtype=detection.DETECTION_DTYPE))
+
+    def write(self, chunk: List[np.ndarray]):
+        detection.appendDetections(self.path, detection.chunkToRecords(self.flights, chunk))
+
+    def close(self):
+        pass
+
+def getSink(path: str, flights: List[flightData.Flight]):
+    # CSV for .csv paths, the binary records format otherwise
+    if path.endswith(".csv"):
+        return CSVSink(path, flights)
+    return DetectionFileSink(path, flights)
+
+
+def runStream(pieces: Iterable[List[np.ndarray]], sink, stats: DetectionStats, chunkSize: int = 100000) -> DetectionStats:
+    # Drains the generator into the sink, reducing the stats as it goes
+    for chunk in chunkDetections(pieces, chunkSize):
+        stats.update(chunk)
+        sink.write(chunk)
+    sink.close()
+    return stats
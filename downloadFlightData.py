@@ -1,31 +1,132 @@
-import subprocess
-import shutil
-import time
+import http.client
 import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import List
 
 
 stem = "https://samples.adsbexchange.com/readsb-hist/"
 folder = "FlightData/"
-day = "2025/02/01/"
+firstDay = date(2025, 2, 1)
+lastDay = date(2025, 2, 1) # Inclusive
 ext = "Z.json.gz"
 
+workers = 8 # Concurrent downloads, each worker keeps its own connection open
+requestsPerSecond = 4 # Shared across all workers, be nice to the server
+retries = 3
+
 SecondsPerDay = 24*60*60
-for hour in range(24):
-    for minute in range(60):
-        for second in range(0, 60, 5):
-            fileName = str(hour).zfill(2) + str(minute).zfill(2) + str(second).zfill(2) + ext
-            
-            if (os.path.isfile(day + fileName)):
-                print(f"Skipping {fileName}")
-                continue
 
-            time.sleep(1)
-            
+class RateLimiter():
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.nextTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # Hands out evenly spaced start times to whichever thread asks next
+        with self.lock:
+            now = time.monotonic()
+            waitTime = self.nextTime - now
+            self.nextTime = max(self.nextTime, now) + self.interval
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+
+def dayFiles(day: date) -> List[str]:
+    # Paths of every 5 second snapshot of the day, relative to stem and folder
+    dayPath = day.strftime("%Y/%m/%d/")
+    files = []
+    for hour in range(24):
+        for minute in range(60):
+            for second in range(0, 60, 5):
+                files.append(dayPath + str(hour).zfill(2) + str(minute).zfill(2) + str(second).zfill(2) + ext)
+    return files
+
+
+def dayRange(first: date, last: date) -> List[date]:
+    return [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+
+class Downloader():
+    def __init__(self, stem: str, folder: str, workers: int = workers, requestsPerSecond: float = requestsPerSecond, retries: int = retries):
+        url = urllib.parse.urlsplit(stem)
+        self.connectionType = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.netloc
+        self.basePath = url.path
+        self.folder = folder
+        self.workers = workers
+        self.retries = retries
+        self.rateLimiter = RateLimiter(requestsPerSecond)
+        self.local = threading.local()
+
+    def getConnection(self) -> http.client.HTTPConnection:
+        # One keep-alive connection per worker thread
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connectionType(self.host, timeout=30)
+        return self.local.connection
+
+    def dropConnection(self):
+        if getattr(self.local, 'connection', None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+    def fetch(self, relPath: str) -> str:
+        # Returns 'skipped', 'downloaded', 'missing' or 'failed'
+        dest = os.path.join(self.folder, relPath)
+        if os.path.isfile(dest):
+            return 'skipped' # Finished by an earlier run, partial downloads only ever exist as .part files
+
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(2**attempt)
+            self.rateLimiter.wait()
+
             try:
-                subprocess.call(['wget', stem + day + fileName])
-                src = fileName
-                dest = folder + day + fileName
-                shutil.copyfile(src, dest)
-                os.remove(src)
-            except:
+                connection = self.getConnection()
+                connection.request('GET', self.basePath + relPath)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                self.dropConnection()
+                continue
+
+            if response.status == 404:
+                return 'missing'
+            elif response.status != 200:
                 continue
+
+            # Written next to the destination then renamed so a killed run never leaves a truncated snapshot behind
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmpPath = dest + ".part"
+            with open(tmpPath, 'wb') as outFile:
+                outFile.write(data)
+            os.replace(tmpPath, dest)
+            return 'downloaded'
+        return 'failed'
+
+    def download(self, relPaths: List[str]) -> dict:
+        counts = {'skipped': 0, 'downloaded': 0, 'missing': 0, 'failed': 0}
+        tStart = time.time()
+        with ThreadPoolExecutor(self.workers) as executor:
+            for idx, (relPath, result) in enumerate(zip(relPaths, executor.map(self.fetch, relPaths))):
+                counts[result] += 1
+                if result == 'failed':
+                    print(f"Failed to download {relPath}")
+                if (idx % 500) == 0 and idx > 0:
+                    secondsPerFile = (time.time() - tStart) / idx
+                    print(f"{idx}/{len(relPaths)} files, {counts}, estimated {round(secondsPerFile * (len(relPaths) - idx))}s remaining")
+        return counts
+
+
+if __name__ == '__main__':
+    relPaths = []
+    for day in dayRange(firstDay, lastDay):
+        relPaths += dayFiles(day)
+
+    downloader = Downloader(stem, folder)
+    counts = downloader.download(relPaths)
+    print(f"Finished {len(relPaths)} files: {counts}")
@@ -1,25 +1,219 @@
+from typing import List
+
 import numpy as np
+import scipy.constants
+
+# Bistatic range ellipsoids and a batched solver for where several of them intersect
+# A detection at receiver r of a pulse from transmitter t tells us the path length |p - t| + |p - r| of the target at p
+# Each such measurement puts the target on an ellipsoid with t and r as foci, with several transmitter/receiver pairs
+# the target is where the ellipsoids intersect
 
-def Ellipsoid():
-    a: float
-    b: float
+class Ellipsoid():
+    f1: np.ndarray # Foci, transmitter and receiver
+    f2: np.ndarray
+    a: float # Semi major axis, along f1 -> f2
+    b: float # Semi minor axes, b == c since the ellipsoid is symmetric about the f1 -> f2 axis
     c: float
+    center: np.ndarray
+    axis: np.ndarray # Unit vector from f1 to f2
+
+    def __init__(self, f1: np.ndarray, f2: np.ndarray, rangeSum: float):
+        # rangeSum = |p - f1| + |p - f2| for every point p on the ellipsoid, so 2a = rangeSum
+        # https://www.khanacademy.org/math/precalculus/x9e81a4f98389efdf:conics/x9e81a4f98389efdf:ellipse-foci/v/foci-of-an-ellipse
+        self.f1 = np.asarray(f1, dtype=float)
+        self.f2 = np.asarray(f2, dtype=float)
+        baseline = np.linalg.norm(self.f2 - self.f1)
+        if rangeSum < baseline:
+            raise ValueError(f"Range sum {rangeSum} is shorter than the baseline {baseline}")
+
+        self.a = rangeSum / 2
+        self.b = np.sqrt(self.a**2 - (baseline / 2)**2)
+        self.c = self.b
+        self.center = (self.f1 + self.f2) / 2
+        self.axis = (self.f2 - self.f1) / baseline if baseline > 0 else np.array([1.0, 0, 0])
+
+    @staticmethod
+    def fromDelay(f1: np.ndarray, f2: np.ndarray, delay: float) -> 'Ellipsoid':
+        # delay is how long after the direct path pulse the echo arrives at the receiver
+        return Ellipsoid(f1, f2, np.linalg.norm(np.asarray(f2) - np.asarray(f1)) + delay * scipy.constants.c)
+
+    def residual(self, p: np.ndarray) -> np.ndarray:
+        # Path length through p minus 2a, zero on the surface, works on (3,) or (N, 3)
+        return np.linalg.norm(p - self.f1, axis=-1) + np.linalg.norm(p - self.f2, axis=-1) - 2*self.a
+
+    def standardForm(self, p: np.ndarray) -> np.ndarray:
+        # ((x-h)**2)/(a**2) + ((y-k)**2)/(b**2) + ((z-q)**2)/(c**2), 1 on the surface, in the frame where the major axis is x
+        # https://en.wikipedia.org/wiki/Ellipsoid#Standard_equation
+        offset = np.asarray(p) - self.center
+        x = offset @ self.axis
+        yz2 = np.sum(offset * offset, axis=-1) - x*x
+        return (x*x) / (self.a**2) + yz2 / (self.b**2)
+
+
+def bistaticRangeSums(targets: np.ndarray, transmitters: np.ndarray, receivers: np.ndarray) -> np.ndarray:
+    # |target - transmitter| + |target - receiver| for (N, 3) targets and (K, 3) transmitter/receiver pairs, returns (N, K)
+    targets = np.asarray(targets, dtype=float)[:, None, :]
+    return np.linalg.norm(targets - transmitters, axis=-1) + np.linalg.norm(targets - receivers, axis=-1)
+
+def getInitialGuess(transmitters: np.ndarray, receivers: np.ndarray, rangeSums: np.ndarray) -> np.ndarray:
+    # Starting points for solveIntersections, (N, K, 3) transmitters/receivers and (N, K) rangeSums
+    # With a common transmitter t (taken as the origin) and R = |p|, each measurement |p| + |p - r_k| = s_k squares to the
+    # linear 2 r_k.p - 2 s_k R = |r_k|^2 - s_k^2 (spherical intersection), solved directly by least squares
+    # Rows with fewer receivers or different transmitters start above the centroid of the ellipsoid centers instead
+    [N, K] = rangeSums.shape
+    centers = (transmitters + receivers) / 2
+    baseline = np.linalg.norm(receivers - transmitters, axis=-1)
+    semiMinor = np.sqrt(np.maximum((rangeSums / 2)**2 - (baseline / 2)**2, 0))
+    centroid = centers.mean(axis=-2)
+    radius = np.linalg.norm(centroid, axis=-1, keepdims=True)
+    up = np.where(radius > 1e3, centroid / np.maximum(radius, 1e-12), np.array([0, 0, 1.0]))
+    guess = centroid + up * semiMinor.mean(axis=-1, keepdims=True)
+
+    common = np.all(np.abs(transmitters - transmitters[:, :1]) < 1e-6, axis=(1, 2))
+    rows = np.flatnonzero(common)
+    if K < 3 or len(rows) == 0:
+        return guess
+
+    t = transmitters[rows, 0]
+    r = receivers[rows] - t[:, None, :]
+    s = rangeSums[rows]
+    y = np.sum(r*r, axis=-1) - s*s
+    M = np.concatenate([2*r, -2*s[..., None]], axis=-1)
+
+    # Minimum norm least squares solution x = [p, R], dropping singular values that are numerically zero
+    [U, S, Vt] = np.linalg.svd(M, full_matrices=True)
+    U = U[:, :, :S.shape[1]]
+    keep = S > S[:, :1] * 1e-10
+    Uty = np.einsum('nki,nk->ni', U, y)
+    x = np.einsum('nij,ni->nj', Vt[:, :S.shape[1]], np.where(keep, Uty / np.where(keep, S, 1), 0))
+
+    # When the system is one short of full rank (three receivers, or every station in one plane) the solutions are x + lambda n
+    # for the null vector n, and |p| = R leaves two candidates, take the one higher above the transmitter
+    underdetermined = ~keep[:, -1] if S.shape[1] == 4 else np.ones(len(rows), dtype=bool)
+    null = Vt[:, 3]
+    a = np.sum(null[:, :3]**2, axis=-1) - null[:, 3]**2
+    b = 2*(np.sum(x[:, :3]*null[:, :3], axis=-1) - x[:, 3]*null[:, 3])
+    c = np.sum(x[:, :3]**2, axis=-1) - x[:, 3]**2
+    root = np.sqrt(np.maximum(b*b - 4*a*c, 0))
+    a = np.where(np.abs(a) < 1e-12, 1e-12, a)
+    candidates = x[:, None, :3] + ((np.stack([-b + root, -b - root], axis=1) / (2*a[:, None]))[..., None] * null[:, None, :3])
+    height = np.einsum('nci,ni->nc', candidates, up[rows])
+    p = np.where(underdetermined[:, None], candidates[np.arange(len(rows)), np.argmax(height, axis=1)], x[:, :3])
+
+    p = p + t
+    usable = np.all(np.isfinite(p), axis=1)
+    guess[rows[usable]] = p[usable]
+    return guess
+
+def solveSymmetric3(A: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Solves A x = b for a stack of symmetric 3x3 A (N, 3, 3) and b (N, 3) by the adjugate, much faster than np.linalg.solve for tiny systems
+    [a00, a01, a02, a11, a12, a22] = [A[:, 0, 0], A[:, 0, 1], A[:, 0, 2], A[:, 1, 1], A[:, 1, 2], A[:, 2, 2]]
+    c00 = a11*a22 - a12*a12
+    c01 = a02*a12 - a01*a22
+    c02 = a01*a12 - a02*a11
+    c11 = a00*a22 - a02*a02
+    c12 = a01*a02 - a00*a12
+    c22 = a00*a11 - a01*a01
+    det = a00*c00 + a01*c01 + a02*c02
+    x = np.empty_like(b)
+    x[:, 0] = c00*b[:, 0] + c01*b[:, 1] + c02*b[:, 2]
+    x[:, 1] = c01*b[:, 0] + c11*b[:, 1] + c12*b[:, 2]
+    x[:, 2] = c02*b[:, 0] + c12*b[:, 1] + c22*b[:, 2]
+    return x / det[:, None]
+
+def solveIntersections(transmitters: np.ndarray, receivers: np.ndarray, rangeSums: np.ndarray, x0: np.ndarray = None,
+                       iterations: int = 50, tolerance: float = 1e-3, damping: float = 1e-3) -> List[np.ndarray]:
+    # Least squares intersection of K ellipsoids for each of N detections, all detections are solved together
+    # transmitters and receivers are (K, 3) or (N, K, 3), rangeSums is (N, K) and x0 is (3,) or (N, 3), defaults to getInitialGuess
+    # Damped Gauss-Newton (Levenberg-Marquardt with a per detection damping factor) on r_k = |p - t_k| + |p - r_k| - s_k
+    # with the analytic Jacobian dr_k/dp = unit(p - t_k) + unit(p - r_k), stopping once a step is shorter than tolerance (in the units of the inputs)
+    # Returns [positions (N, 3), residual RMS (N,), converged (N,)]
+    rangeSums = np.atleast_2d(np.asarray(rangeSums, dtype=float))
+    [N, K] = rangeSums.shape
+    transmitters = np.broadcast_to(np.asarray(transmitters, dtype=float), (N, K, 3))
+    receivers = np.broadcast_to(np.asarray(receivers, dtype=float), (N, K, 3))
+
+    # Work relative to a local origin, ECEF coordinates are ~6e6m and squaring them loses precision
+    origin = transmitters[0, 0].copy()
+    transmitters = transmitters - origin
+    receivers = receivers - origin
+    if x0 is None:
+        p = getInitialGuess(transmitters + origin, receivers + origin, rangeSums) - origin
+    else:
+        p = np.broadcast_to(np.asarray(x0, dtype=float), (N, 3)) - origin
+
+    def evaluate(p: np.ndarray, rows: np.ndarray) -> List[np.ndarray]:
+        toTransmitter = p[:, None, :] - transmitters[rows]
+        toReceiver = p[:, None, :] - receivers[rows]
+        dt = np.maximum(np.linalg.norm(toTransmitter, axis=-1), 1e-9)
+        dr = np.maximum(np.linalg.norm(toReceiver, axis=-1), 1e-9)
+        r = dt + dr - rangeSums[rows]
+        J = toTransmitter / dt[..., None] + toReceiver / dr[..., None]
+        return [r, J]
+
+    allRows = np.arange(N)
+    p = p.copy()
+    [r, J] = evaluate(p, allRows)
+    cost = np.sum(r*r, axis=1)
+    lam = np.full(N, damping)
+    converged = np.zeros(N, dtype=bool)
+    active = np.ones(N, dtype=bool)
+
+    for _ in range(iterations):
+        rows = np.flatnonzero(active)
+        if len(rows) == 0:
+            break
+
+        # Normal equations (J^T J + lambda I) step = -J^T r, one 3x3 system per active detection
+        JtJ = np.einsum('nki,nkj->nij', J[rows], J[rows])
+        JtJ[:, [0, 1, 2], [0, 1, 2]] += lam[rows, None]
+        g = np.einsum('nki,nk->ni', J[rows], r[rows])
+        step = -solveSymmetric3(JtJ, g)
+
+        pNew = p[rows] + step
+        [rNew, JNew] = evaluate(pNew, rows)
+        costNew = np.sum(rNew*rNew, axis=1)
+
+        # Accept steps that reduce the cost and move towards Gauss-Newton, back off towards gradient descent otherwise
+        better = costNew <= cost[rows]
+        accepted = rows[better]
+        p[accepted] = pNew[better]
+        r[accepted] = rNew[better]
+        J[accepted] = JNew[better]
+        cost[accepted] = costNew[better]
+        lam[accepted] *= 0.3
+        lam[rows[~better]] *= 10
 
-    def __init__(f1: np.array, f2: np.array):
-        # In our case two of the axes, b and c, are the same since we're assuming symmetricality
+        done = better & (np.linalg.norm(step, axis=1) < tolerance)
+        converged[rows[done]] = True
+        active[rows[done]] = False
+        active[rows[lam[rows] > 1e12]] = False # Stuck, leave converged False
 
-        # a = semi major axis
-        # 2a = dt
+    return [p + origin, np.sqrt(cost / K), converged]
 
-        # Definition of an ellipsoid https://en.wikipedia.org/wiki/Ellipsoid#Standard_equation
-        # (x**2)/(a**2) + (y**2)/(b**2) + (z**2)/(c**2) = 1
-        # With translation added (h in +Z, k in +Y, q in +Z)
-        # ((x-h)**2)/(a**2) + (((y-k)**2)/(b**2) + ((z-q)**2)/(c**2) = 1
-        # Allow for radius != 1
-        # ((x-h)**2)/(a**2) + (((y-k)**2)/(b**2) + ((z-q)**2)/(c**2) = r
-        # Replace let a**2 = A; b**2 = B, c**2 = C
-        # ((x-h)**2)/A + (((y-k)**2)/B + ((z-q)**2)/C = r
-        # Get all unknowns onto right side
+def localizeTrack(transmitters: np.ndarray, receivers: np.ndarray, rangeSums: np.ndarray, x0: np.ndarray = None,
+                  maxResidual: float = 10, passes: int = 3, **solverArgs) -> List[np.ndarray]:
+    # solveIntersections for detections of one target in time order
+    # Detections that don't converge to a fix within maxResidual meters RMS are solved again, warm started from the
+    # previous good fix. Three receivers leave two exact solutions, pass x0 near the first fix to start on the right one
+    # Returns [positions (N, 3), residual RMS (N,), good (N,)]
+    rangeSums = np.atleast_2d(np.asarray(rangeSums, dtype=float))
+    N = rangeSums.shape[0]
+    transmitters = np.broadcast_to(np.asarray(transmitters, dtype=float), (N,) + np.shape(transmitters)[-2:])
+    receivers = np.broadcast_to(np.asarray(receivers, dtype=float), (N,) + np.shape(receivers)[-2:])
 
+    [p, rms, converged] = solveIntersections(transmitters, receivers, rangeSums, x0, **solverArgs)
+    good = converged & (rms <= maxResidual)
+    for _ in range(passes):
+        # Index of the last good fix at or before each detection
+        previous = np.maximum.accumulate(np.where(good, np.arange(N), -1))
+        retry = np.flatnonzero(~good & (previous >= 0))
+        if len(retry) == 0:
+            break
 
-        pass
+        [pRetry, rmsRetry, convergedRetry] = solveIntersections(transmitters[retry], receivers[retry], rangeSums[retry], p[previous[retry]], **solverArgs)
+        improved = rmsRetry < rms[retry]
+        p[retry[improved]] = pRetry[improved]
+        rms[retry[improved]] = rmsRetry[improved]
+        good[retry] = good[retry] | (convergedRetry & (rmsRetry <= maxResidual))
+    return [p, rms, good]
@@ -2,25 +2,23 @@ import gzip
 import json
 import glob
 import os
-import copy
+import hashlib
 import time
-import yaml
+from multiprocessing import Pool
 
 import numpy as np
 import pymap3d
-import pymap3d.vincenty as pmv
+
+import configRegistry
+from flightData import flightDataToTable, saveFlightTable
 
 removeEntries = ['adsb_icao', 'squawk', 'emergency', 'nav_altitude_fms', 'nav_qnh', 'nav_modes', 'alert', 'spi', 'oat', 'tat', 'mlat', 'tisb', 'messages', 'sil', 'sil_type']
-requiredFields = ['alt_geom', 'gs', 'track', 'geom_rate', 'category', 'lat', 'lon']
 
 maxDataAge = 30 # seconds, can't reliably recreate profile otherwise
 filterDistance = 30e3 # km - eye ball it using https://www.mapdevelopers.com/draw-circle-tool.php
 
-with open("ocations.yaml") as stream:
-    locations = yaml.safe_load(stream)
-
-ONTLLA = locations['ONT Airport']
-CableAirportECEF = pymap3d.geodetic2ecef(np.array([34.111906, -117.686524, 435]))
+ONTLLA = list(configRegistry.getLocation('ONT Airport').LLA)
+CableAirportECEF = np.array(pymap3d.geodetic2ecef(34.111906, -117.686524, 435))
 
 latMin = 33.5
 latMax = 35.5
@@ -28,84 +26,169 @@ lonMax = -116.5
 lonMin = -118.5
 
 dirPath = "FlightData/2025/03/01/"
-
-flightData = {}
-tStart = time.time()
-paths = glob.glob(dirPath + '*.json.gz')
-paths.sort()
-for idx, inFile, in enumerate(paths):
-    if idx > 0:
-        dt = time.time() - tStart
-        secondsPerFile = dt / idx
-        filesRemaining = len(paths) - idx
-        print(f"Parsing {inFile}, estimated {round(secondsPerFile * filesRemaining)}s remaining")
-
+useMultiprocessing = True # Parse snapshot files in parallel, output is identical to the sequential run
+
+# Filtered results of each snapshot are cached so re-runs only parse new or changed files
+# Shards are keyed by the snapshot's path, mtime and size and by every filter parameter, so changing any of them misses
+useFilterCache = True
+filterCachePath = "FlightData/.filterCache/"
+filterCacheMaxBytes = 2e9 # Least recently used shards are removed past this
+filterVersion = 1 # Bump whenever filterFile changes so shards from the old code aren't reused
+
+def surfaceDistance(lat: np.ndarray, lon: np.ndarray, lat0: float, lon0: float) -> np.ndarray:
+    # Haversine on a mean radius sphere, within ~0.5% of Vincenty which is plenty for an eyeballed filterDistance
+    lat, lon, lat0, lon0 = np.radians(lat), np.radians(lon), np.radians(lat0), np.radians(lon0)
+    a = np.sin((lat - lat0) / 2)**2 + np.cos(lat) * np.cos(lat0) * np.sin((lon - lon0) / 2)**2
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+def toFloat(value) -> float:
+    # Missing or non-numeric fields become NaN so only that aircraft fails the filters, not the whole snapshot
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def getFloats(aircraftList: list, field: str, rows) -> np.ndarray:
+    return np.array([toFloat(aircraftList[i].get(field)) for i in rows], dtype=float)
+
+def filterFile(inFile: str) -> list:
+    # Returns [id, aircraft] for every aircraft in the snapshot that passes the filters, in file order
     with gzip.open(inFile,'r') as fin:
         data = json.load(fin)
-        
-        t = int(data['now'])
-        for aircraft in data['aircraft']:
-            try:
-                if 'lat' not in aircraft or 'lon' not in aircraft:
-                    continue
-
-                lat = float(aircraft['lat'])
-                lon = float(aircraft['lon'])
-                
-                # Apply the easy filters first
-                if (lat < latMin or lat > latMax):
-                    continue
-                elif (lon < lonMin or lon > lonMax):
-                    continue
-                elif (aircraft['alt_baro'] == 'ground'):
-                    continue # Can't track targets on the ground
-                elif (aircraft['seen'] > maxDataAge):
-                    continue
-                elif (aircraft['type'] != 'adsb_icao'): # It seems like other types are less reliable
-                    continue
-                
-                # for field in requiredFields:
-                #     if field not in aircraft:
-                #         continue
-
-                alt = float(aircraft['alt_geom']) * 0.3048 # feet to meters
-
-                # Finished rough cut, now try fine cut
-                [dist, _] = pmv.vdist(lat, lon, ONTLLA[0], ONTLLA[1])
-                if dist > filterDistance:
-                    continue
-
-                # We also want to precompute some metadata that will always be true
-                AER = pymap3d.geodetic2aer(lat, lon, alt, ONTLLA[0], ONTLLA[1], ONTLLA[2])
-                ECEF = pymap3d.geodetic2ecef(lat, lon, alt)
-                
-                if (np.linalg.norm(ECEF - CableAirportECEF) < 500):
-                    # This fucking airport is constantly giving false alarms...
-                    continue
-
-                aircraft['AER'] = list(AER)
-                aircraft['ECEF'] = list(ECEF)
-
-                # Remove stuff we will never need
-                for entry in removeEntries:
-                    if entry in aircraft:
-                        del aircraft[entry]
-
-                # Add to the dictionary
-                id = aircraft['hex']
-                aircraft['t'] = t
-
-                del aircraft['hex']
-                if id not in flightData:
-                    flightData[id] = []
-                flightData[id].append(aircraft)
-
-            except Exception as e:
-                # print(f"Failed to parse data in {aircraft} - {e}")
-                pass
-
-print(f"Finished filtering, writing data to file")
-with open(dirPath.replace('/', '_')[:-1] + ".json", 'w') as filtFile:
-    json.dump(flightData, filtFile)
-
-# TODO: Consider interpolating position over time, annoying to map individual planes though
+
+    t = int(data['now'])
+    aircraftList = data['aircraft']
+
+    # Apply the easy filters first, missing fields become NaN which fails every comparison
+    lat = getFloats(aircraftList, 'lat', range(len(aircraftList)))
+    lon = getFloats(aircraftList, 'lon', range(len(aircraftList)))
+    keep = (lat >= latMin) & (lat <= latMax) & (lon >= lonMin) & (lon <= lonMax)
+    candidates = np.flatnonzero(keep)
+
+    seen = getFloats(aircraftList, 'seen', candidates)
+    alt = getFloats(aircraftList, 'alt_geom', candidates) * 0.3048 # feet to meters
+    valid = np.array([
+        aircraftList[i].get('alt_baro', 'ground') != 'ground' # Can't track targets on the ground
+        and aircraftList[i].get('type') == 'adsb_icao' # It seems like other types are less reliable
+        and 'hex' in aircraftList[i]
+        for i in candidates], dtype=bool)
+    keep = valid & (seen <= maxDataAge) & ~np.isnan(alt)
+
+    # Finished rough cut, now try fine cut
+    candidates, lat, lon, alt = candidates[keep], lat[candidates[keep]], lon[candidates[keep]], alt[keep]
+    keep = surfaceDistance(lat, lon, ONTLLA[0], ONTLLA[1]) <= filterDistance
+    candidates, lat, lon, alt = candidates[keep], lat[keep], lon[keep], alt[keep]
+
+    # We also want to precompute some metadata that will always be true
+    AER = np.column_stack(pymap3d.geodetic2aer(lat, lon, alt, ONTLLA[0], ONTLLA[1], ONTLLA[2])).reshape(-1, 3)
+    ECEF = np.column_stack(pymap3d.geodetic2ecef(lat, lon, alt)).reshape(-1, 3)
+
+    # This fucking airport is constantly giving false alarms...
+    keep = np.linalg.norm(ECEF - CableAirportECEF, axis=1) >= 500
+
+    results = []
+    for i, aircraftAER, aircraftECEF in zip(candidates[keep], AER[keep].tolist(), ECEF[keep].tolist()):
+        aircraft = aircraftList[i]
+        aircraft['AER'] = aircraftAER
+        aircraft['ECEF'] = aircraftECEF
+
+        # Remove stuff we will never need
+        for entry in removeEntries:
+            if entry in aircraft:
+                del aircraft[entry]
+
+        id = aircraft['hex']
+        aircraft['t'] = t
+
+        del aircraft['hex']
+        results.append([id, aircraft])
+    return results
+
+def filterFingerprint() -> str:
+    params = [filterVersion, latMin, latMax, lonMin, lonMax, maxDataAge, filterDistance, ONTLLA, CableAirportECEF.tolist(), removeEntries]
+    return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+def shardPath(inFile: str) -> str:
+    stat = os.stat(inFile)
+    key = json.dumps([os.path.abspath(inFile), stat.st_mtime_ns, stat.st_size, filterFingerprint()])
+    return os.path.join(filterCachePath, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+def filterFileCached(inFile: str) -> list:
+    # Same as filterFile but reuses the cached shard for the file if there is one
+    path = shardPath(inFile)
+    try:
+        with open(path) as shardFile:
+            results = json.load(shardFile)
+        os.utime(path) # Mark as recently used
+        return results
+    except (OSError, ValueError):
+        pass # Not cached yet, or a broken shard that will be overwritten
+
+    results = filterFile(inFile)
+
+    # Written under a temporary name first so other processes never see a partial shard
+    os.makedirs(filterCachePath, exist_ok=True)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    with open(tmpPath, 'w') as shardFile:
+        json.dump(results, shardFile)
+    os.replace(tmpPath, path)
+    return results
+
+def evictShards(maxBytes: float):
+    # Drops the least recently used shards until the cache fits in maxBytes
+    shards = []
+    for path in glob.glob(os.path.join(filterCachePath, '*.json')):
+        stat = os.stat(path)
+        shards.append([stat.st_mtime, stat.st_size, path])
+    shards.sort()
+
+    totalBytes = sum(shard[1] for shard in shards)
+    for _, size, path in shards:
+        if totalBytes <= maxBytes:
+            break
+        os.remove(path)
+        totalBytes -= size
+
+def mergeResults(paths: list, fileResults) -> dict:
+    # id -> aircraft snapshots, in path order
+    flightData = {}
+    tStart = time.time()
+    for idx, (inFile, results) in enumerate(zip(paths, fileResults)):
+        if idx > 0:
+            dt = time.time() - tStart
+            secondsPerFile = dt / idx
+            filesRemaining = len(paths) - idx
+            print(f"Parsed {inFile}, estimated {round(secondsPerFile * filesRemaining)}s remaining")
+
+        # Add to the dictionary
+        for id, aircraft in results:
+            if id not in flightData:
+                flightData[id] = []
+            flightData[id].append(aircraft)
+    return flightData
+
+if __name__ == '__main__':
+    paths = glob.glob(dirPath + '*.json.gz')
+    paths.sort()
+
+    # imap hands back results in path order so the merge is the same as a sequential run
+    filterFunc = filterFileCached if useFilterCache else filterFile
+    if useMultiprocessing:
+        with Pool() as pool:
+            flightData = mergeResults(paths, pool.imap(filterFunc, paths, chunksize=16))
+    else:
+        flightData = mergeResults(paths, map(filterFunc, paths))
+
+    if useFilterCache:
+        evictShards(filterCacheMaxBytes)
+
+    print(f"Finished filtering, writing data to file")
+    outPath = dirPath.replace('/', '_')[:-1]
+    saveFlightTable(outPath + ".flights", flightDataToTable(flightData))
+
+    writeJSON = True # The JSON copy is easier to inspect, flightData.convertFlights can also make it from the table later
+    if writeJSON:
+        with open(outPath + ".json", 'w') as filtFile:
+            json.dump(flightData, filtFile)
+
+    # TODO: Consider interpolating position over time, annoying to map individual planes though
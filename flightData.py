@@ -1,13 +1,20 @@
 from typing import List
-from datetime import datetime, timezone
+from datetime import datetime
 import json
 import struct
+import os
+import shutil
 
 import numpy as np
 import pymap3d
-from numba import njit
+
+MAX_STATE_AGE = 15 # seconds - Further than this from the nearest ADS-B message and the position isn't real
 
 class FlightState:
+    # Lightweight view of one row of a Flight's arrays, only created when someone asks for it
+    __slots__ = ('t', 'LLA', 'ECEF', 'AER')
+    format = "!d" + "ddd" + "ddd" + "fff" # ECEF needs doubles, as 32 bit floats it's only good to about a metre
+
     t: float
     LLA: np.ndarray
     ECEF: np.ndarray
@@ -16,19 +23,11 @@ class FlightState:
     # groundSpeed: float
     # altRate: float
 
-    def __init__(self, message: dict, tStart: datetime):
-        # TODO: Should we remove off the time since last seen?
-        self.t = (datetime.fromtimestamp(message['t'], tz=timezone.utc) - tStart).seconds
-        
-        self.LLA = np.array([message['lat'], message['lon'], message['alt_geom'] * 0.3048]) # alt feet to meters
-        # self.ECEF = np.array(message['ECEF'])
-        self.ECEF = np.array(pymap3d.geodetic2ecef(*(self.LLA)))
-        self.AER = np.array(message['AER'])
-        # self.track = message['track']
-        # self.groundSpeed = message['gs']
-        # self.altRate = (message['geom_rate'] * 0.3048) / 60 # feet/minute to meters/second
-
-        self.format = "!f" + "fff" + "fff" + "fff"
+    def __init__(self, t: float, LLA: np.ndarray, ECEF: np.ndarray, AER: np.ndarray):
+        self.t = t
+        self.LLA = LLA
+        self.ECEF = ECEF
+        self.AER = AER
 
     def __repr__(self):
         return f"{self.LLA}, {self.t}"
@@ -37,7 +36,7 @@ class FlightState:
         return struct.pack(self.format, self.t, *self.LLA, *self.ECEF, *self.AER)
 
     def unpack(self, data: bytes):
-        members = self.unpack(self.format)
+        members = struct.unpack(self.format, data[:struct.calcsize(self.format)])
         self.t = members[0]
         self.LLA = np.array(members[1:4])
         self.ECEF = np.array(members[4:7])
@@ -45,90 +44,205 @@ class FlightState:
         return self
 
 
-# @njit(cache=True)
-def binarySearch(data: List[float], val: float):
-    # https://stackoverflow.com/a/23682008
-
-    highIndex = len(data)-1
-    lowIndex = 0
-    while highIndex > lowIndex:
-            index = int((highIndex + lowIndex) / 2)
-            sub = data[index]
-            if data[lowIndex] == val:
-                    return [lowIndex, lowIndex]
-            elif sub == val:
-                    return [index, index]
-            elif data[highIndex] == val:
-                    return [highIndex, highIndex]
-            elif sub > val:
-                    if highIndex == index:
-                            return sorted([highIndex, lowIndex])
-                    highIndex = index
-            else:
-                    if lowIndex == index:
-                            return sorted([highIndex, lowIndex])
-                    lowIndex = index
-    return sorted([highIndex, lowIndex])
-
 class Flight():
+    # Positions are stored as columns, row i of t, LLA, ECEF and AER make up one ADS-B message
     id: str
-    positions: List[FlightState]
     category: str
-    positionTime: List[float]
+    t: np.ndarray    # (N,) seconds since tStart, sorted
+    LLA: np.ndarray  # (N, 3)
+    ECEF: np.ndarray # (N, 3)
+    AER: np.ndarray  # (N, 3)
 
-    previousStateIdx: int
-
-    def __init__(self, id: str, data: dict, tStart: datetime):
+    def __init__(self, id: str, category: str, t: np.ndarray, LLA: np.ndarray, ECEF: np.ndarray, AER: np.ndarray):
         self.id = id
-        self.positions = []
-        self.previousStateIdx = 0
-        self.useSearchShortcut = False
+        self.category = category
+
+        # Already sorted input (e.g. slices of a memory mapped flight table) is kept as a view instead of copied
+        if np.any(t[1:] < t[:-1]):
+            order = np.argsort(t, kind='stable')
+            t, LLA, ECEF, AER = t[order], LLA[order], ECEF[order], AER[order]
+        self.t = np.ascontiguousarray(t, dtype=float)
+        self.LLA = np.ascontiguousarray(LLA, dtype=float).reshape(-1, 3)
+        self.ECEF = np.ascontiguousarray(ECEF, dtype=float).reshape(-1, 3)
+        self.AER = np.ascontiguousarray(AER, dtype=float).reshape(-1, 3)
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def stateAt(self, idx: int) -> FlightState:
+        return FlightState(self.t[idx], self.LLA[idx], self.ECEF[idx], self.AER[idx])
+
+    def getStateIndex(self, t: float) -> int:
+        # Row of the most recent position at time t, or -1 if there isn't one within MAX_STATE_AGE
+        idx = max(int(np.searchsorted(self.t, t, side='right')) - 1, 0)
+        if abs(self.t[idx] - t) > MAX_STATE_AGE: # Too old to be real
+            return -1
+        return idx
 
+    def getState(self, t: float) -> FlightState:
+        # Since we later filter by a constant elevation angle we could do that here before interpolation
+        idx = self.getStateIndex(t)
+        if idx < 0:
+            return None
+        return self.stateAt(idx)
+
+    def getStateIndices(self, t: np.ndarray) -> np.ndarray:
+        # Batched version of getState, returns the row for each time in t or -1 where getState would return None
+        idx = np.searchsorted(self.t, t, side='right') - 1
+        np.clip(idx, 0, None, out=idx)
+        idx[np.abs(self.t[idx] - t) > MAX_STATE_AGE] = -1
+        return idx
+
+    def getStateIntervals(self) -> np.ndarray:
+        # Time span [start, end] over which getState returns each row, as an (N, 2) array
+        intervals = np.empty((len(self.t), 2))
+        intervals[:, 0] = self.t
+        intervals[0, 0] -= MAX_STATE_AGE
+        intervals[:, 1] = self.t + MAX_STATE_AGE
+        intervals[:-1, 1] = np.minimum(intervals[:-1, 1], self.t[1:])
+        return intervals
+
+
+# A flight table holds every flight of a day as columns:
+#   ids, categories - one entry per flight
+#   offsets         - rows of flight i are offsets[i]:offsets[i+1]
+#   t               - unix time of each message, sorted within each flight
+#   LLA, ECEF, AER  - (N, 3) per message
+# On disk it is a directory with one .npy per column so it can be memory mapped
+FLIGHT_TABLE_COLUMNS = ['ids', 'categories', 'offsets', 't', 'LLA', 'ECEF', 'AER']
+
+def flightDataToTable(flightData: dict, observerLLA: List[float] = None) -> dict:
+    # Converts filterData's {id: [message, ...]} into a flight table with one vectorized pass over every message
+    # ECEF and AER precomputed by filterData are reused, observerLLA is only needed if AER has to be computed
+    messages = [message for data in flightData.values() for message in data]
+    counts = np.array([len(data) for data in flightData.values()], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    # TODO: Should we remove off the time since last seen?
+    t = np.array([message['t'] for message in messages], dtype=float)
+
+    LLA = np.empty((len(messages), 3))
+    LLA[:, 0] = [message['lat'] for message in messages]
+    LLA[:, 1] = [message['lon'] for message in messages]
+    LLA[:, 2] = [message['alt_geom'] for message in messages]
+    LLA[:, 2] *= 0.3048 # alt feet to meters
+
+    ECEF = np.empty((len(messages), 3))
+    hasECEF = np.array(['ECEF' in message for message in messages], dtype=bool)
+    if hasECEF.any():
+        ECEF[hasECEF] = [message['ECEF'] for message, has in zip(messages, hasECEF) if has]
+    if not hasECEF.all():
+        ECEF[~hasECEF] = np.column_stack(pymap3d.geodetic2ecef(*LLA[~hasECEF].T))
+
+    AER = np.empty((len(messages), 3))
+    hasAER = np.array(['AER' in message for message in messages], dtype=bool)
+    if hasAER.any():
+        AER[hasAER] = [message['AER'] for message, has in zip(messages, hasAER) if has]
+    if not hasAER.all():
+        if observerLLA is None:
+            raise KeyError("AER missing from flight data and no observerLLA given to compute it")
+        AER[~hasAER] = np.column_stack(pymap3d.geodetic2aer(*LLA[~hasAER].T, *observerLLA))
+    # track = message['track']
+    # groundSpeed = message['gs']
+    # altRate = (message['geom_rate'] * 0.3048) / 60 # feet/minute to meters/second
+
+    categories = []
+    for data in flightData.values():
         if 'category' in data[0]:
-            self.category = data[0]['category']
+            categories.append(data[0]['category'])
         else:
-            self.category = 'A1' # Assume small
+            categories.append('A1') # Assume small
 
-        for message in data:
-            state = FlightState(message, tStart)
-            self.positions.append(state)
-        
-        self.positions.sort(key=lambda x: x.t)
-        self.positionTime = [p.t for p in self.positions]
+    # Sort by time within each flight
+    order = np.lexsort((t, np.repeat(np.arange(len(counts)), counts)))
 
+    return {
+        'ids': np.array(list(flightData.keys()), dtype=str),
+        'categories': np.array(categories, dtype=str),
+        'offsets': offsets,
+        't': t[order],
+        'LLA': LLA[order],
+        'ECEF': ECEF[order],
+        'AER': AER[order],
+    }
 
-    def getState(self, t: float) -> FlightState:
-        # Should consider returning none if timedelta is too large
-        # Since we later filter by a constant elevation angle we could do that here before interpolation
-        
-        # For large search spaces the binary search can still be a bottleneck
-        # However the user generally calls getState with t values going in linearly increasing amounts
-        # So if we do a quick check to see if the current or next index is closest we can probably reduce the search space significantly
-        # It seems that if there are large gaps in data this method just makes things slower since it will fall back on binarySearch anyway
-        if self.useSearchShortcut:
-            currentIdxDt = abs(self.positions[self.previousStateIdx].t - t)
-            nextIdxDt = abs(self.positions[self.previousStateIdx+1].t - t)
-            minDt = min(currentIdxDt, nextIdxDt)
-            if minDt < 5:
-                if currentIdxDt < nextIdxDt: # Current index is still the best choice
-                    return self.positions[self.previousStateIdx]
-                else: # Next index is now closer
-                    self.previousStateIdx += 1
-                    return self.positions[self.previousStateIdx]            
-
-        # Fall back on basic binary search if the optimization doesn't work, if there is a drop in ADSB data this will be required
-        idx = binarySearch(self.positionTime, t)[0]
-        if (self.positions[idx].t - t) > 15: # Too old to be real
-            return None
-        self.previousStateIdx = idx
-        return self.positions[idx]
 
+def tableToFlights(table: dict, tStart: datetime) -> List[Flight]:
+    # Flights share the table's LLA/ECEF/AER buffers, only the relative times are new
+    # Same as (datetime.fromtimestamp(t) - tStart).seconds
+    t = np.floor(table['t'] - tStart.timestamp()) % (24*60*60)
 
-def loadFlights(path: str, tStart: datetime) -> List[Flight]:
-    with open(path) as flightFile:
-        flightData = json.load(flightFile)
-    
+    offsets = table['offsets']
     flights = []
-    for key, value in flightData.items():
-        flights.append(Flight(key, value, tStart))
+    for flightIdx, (id, category) in enumerate(zip(table['ids'], table['categories'])):
+        rows = slice(offsets[flightIdx], offsets[flightIdx+1])
+        flights.append(Flight(str(id), str(category), t[rows], table['LLA'][rows], table['ECEF'][rows], table['AER'][rows]))
     return flights
+
+
+def saveFlightTable(path: str, table: dict):
+    # Written to a temporary directory first so a half written table is never picked up
+    tmpPath = path + ".tmp"
+    os.makedirs(tmpPath, exist_ok=True)
+    for column in FLIGHT_TABLE_COLUMNS:
+        np.save(os.path.join(tmpPath, column + ".npy"), table[column])
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmpPath, path)
+
+
+def loadFlightTable(path: str, mmap: bool = True) -> dict:
+    # Memory mapped columns load instantly and their pages are shared between processes
+    mode = 'r' if mmap else None
+    return {column: np.load(os.path.join(path, column + ".npy"), mmap_mode=mode) for column in FLIGHT_TABLE_COLUMNS}
+
+
+def tableToFlightData(table: dict) -> dict:
+    # Back to the {id: [message, ...]} JSON layout, only with the fields the table keeps
+    flightData = {}
+    offsets = table['offsets']
+    for flightIdx, (id, category) in enumerate(zip(table['ids'], table['categories'])):
+        messages = []
+        for row in range(offsets[flightIdx], offsets[flightIdx+1]):
+            LLA = table['LLA'][row]
+            messages.append({
+                't': float(table['t'][row]),
+                'lat': float(LLA[0]),
+                'lon': float(LLA[1]),
+                'alt_geom': float(LLA[2]) / 0.3048, # meters to feet
+                'category': str(category),
+                'AER': table['AER'][row].tolist(),
+                'ECEF': table['ECEF'][row].tolist(),
+            })
+        flightData[str(id)] = messages
+    return flightData
+
+
+def parseFlights(flightData: dict, tStart: datetime, observerLLA: List[float] = None) -> List[Flight]:
+    return tableToFlights(flightDataToTable(flightData, observerLLA), tStart)
+
+
+def parseFlight(id: str, data: List[dict], tStart: datetime, observerLLA: List[float] = None) -> Flight:
+    return parseFlights({id: data}, tStart, observerLLA)[0]
+
+
+def loadFlights(path: str, tStart: datetime, observerLLA: List[float] = None) -> List[Flight]:
+    # Accepts either a flight table directory or filterData's JSON
+    if os.path.isdir(path):
+        return tableToFlights(loadFlightTable(path), tStart)
+
+    with open(path) as flightFile:
+        flightData = json.load(flightFile)
+
+    return parseFlights(flightData, tStart, observerLLA)
+
+
+def convertFlights(srcPath: str, destPath: str):
+    # Converts between filterData's JSON and a flight table, direction is picked from whichever srcPath is
+    if os.path.isdir(srcPath):
+        with open(destPath, 'w') as flightFile:
+            json.dump(tableToFlightData(loadFlightTable(srcPath)), flightFile)
+    else:
+        with open(srcPath) as flightFile:
+            saveFlightTable(destPath, flightDataToTable(json.load(flightFile)))
@@ -0,0 +1,100 @@
+from typing import List
+
+import numpy as np
+
+from flightData import Flight, MAX_STATE_AGE
+
+# Index over every ADS-B sample of every flight by the time span getState returns it for and by its azimuth from the transmitter
+# Lets a pulse centric simulation ask which samples could be in the beam at a given time without looking at every flight
+
+class FlightIndex():
+    sectorWidth: float
+    sectorOffsets: np.ndarray # Entries of sector s are sectorOffsets[s]:sectorOffsets[s+1], sorted by start
+
+    # One entry per indexed sample
+    flightIdx: np.ndarray
+    stateIdx: np.ndarray
+    start: np.ndarray    # getState returns this sample from start...
+    nextTime: np.ndarray # ...until the next sample (inf for the last one)...
+    end: np.ndarray      # ...or until it's too old, so it's used over [start, min(nextTime, end)]
+    stateTime: np.ndarray
+    az: np.ndarray
+
+    def __init__(self, flights: List[Flight], sectorCount: int = 36, stateMasks: List[np.ndarray] = None, bucketWidth: float = 60):
+        # stateMasks optionally limits the index to some samples of each flight, e.g. the ones that are detectable at all
+        self.sectorWidth = 360 / sectorCount
+
+        flightIdx, stateIdx, start, nextTime, stateTime, az = [], [], [], [], [], []
+        for idx, flight in enumerate(flights):
+            mask = stateMasks[idx] if stateMasks is not None else np.ones(len(flight), dtype=bool)
+            flightStart = flight.t.copy()
+            flightStart[0] -= MAX_STATE_AGE
+            flightNext = np.append(flight.t[1:], np.inf)
+
+            rows = np.flatnonzero(mask)
+            flightIdx.append(np.full(len(rows), idx, dtype=np.int32))
+            stateIdx.append(rows.astype(np.int32))
+            start.append(flightStart[rows])
+            nextTime.append(flightNext[rows])
+            stateTime.append(flight.t[rows])
+            az.append(flight.AER[rows, 0])
+
+        flightIdx, stateIdx, start, nextTime, stateTime, az = [np.concatenate(column) if len(flights) > 0 else np.empty(0) for column in [flightIdx, stateIdx, start, nextTime, stateTime, az]]
+        sector = np.clip((az // self.sectorWidth).astype(int), 0, sectorCount - 1)
+
+        order = np.lexsort((start, sector))
+        self.flightIdx = flightIdx[order].astype(np.int32)
+        self.stateIdx = stateIdx[order].astype(np.int32)
+        self.start = start[order]
+        self.nextTime = nextTime[order]
+        self.stateTime = stateTime[order]
+        self.end = self.stateTime + MAX_STATE_AGE
+        self.az = az[order]
+        self.sectorOffsets = np.searchsorted(sector[order], np.arange(sectorCount + 1))
+
+        # No sample is used for longer than this, which bounds how far back query has to look
+        self.maxDuration = 2 * MAX_STATE_AGE
+
+        # Flight level spans, bucketed by time so activeFlights doesn't have to scan every flight
+        self.bucketWidth = bucketWidth
+        self.flightSpans = np.array([[flight.t[0] - MAX_STATE_AGE, flight.t[-1] + MAX_STATE_AGE] for flight in flights]).reshape(-1, 2)
+        firstBucket = np.floor(self.flightSpans[:, 0] / bucketWidth).astype(int)
+        lastBucket = np.floor(self.flightSpans[:, 1] / bucketWidth).astype(int)
+        self.bucketStart = firstBucket.min() if len(flights) > 0 else 0
+        bucketCounts = lastBucket - firstBucket + 1
+        bucket = np.repeat(firstBucket, bucketCounts) + (np.arange(bucketCounts.sum()) - np.repeat(np.cumsum(bucketCounts) - bucketCounts, bucketCounts)) - self.bucketStart
+        bucketFlights = np.repeat(np.arange(len(flights)), bucketCounts)
+        order = np.argsort(bucket, kind='stable')
+        self.bucketFlights = bucketFlights[order]
+        self.bucketOffsets = np.searchsorted(bucket[order], np.arange((bucket.max() + 2) if len(bucket) > 0 else 1))
+
+    def __len__(self) -> int:
+        return len(self.flightIdx)
+
+    def activeFlights(self, t: float) -> np.ndarray:
+        # Indices of the flights that getState could return a position for at time t
+        bucket = int(np.floor(t / self.bucketWidth)) - self.bucketStart
+        if bucket < 0 or bucket >= len(self.bucketOffsets) - 1:
+            return np.empty(0, dtype=int)
+        flights = self.bucketFlights[self.bucketOffsets[bucket]:self.bucketOffsets[bucket+1]]
+        spans = self.flightSpans[flights]
+        return flights[(spans[:, 0] <= t) & (spans[:, 1] >= t)]
+
+    def query(self, t0: float, t1: float, azMin: float, azMax: float) -> np.ndarray:
+        # Entries used at some point in [t0, t1] whose azimuth is within [azMin, azMax]
+        firstSector = max(int(azMin // self.sectorWidth), 0)
+        lastSector = min(int(azMax // self.sectorWidth), len(self.sectorOffsets) - 2)
+
+        entries = []
+        for sector in range(firstSector, lastSector + 1):
+            sectorStart = self.start[self.sectorOffsets[sector]:self.sectorOffsets[sector+1]]
+            first = self.sectorOffsets[sector] + np.searchsorted(sectorStart, t0 - self.maxDuration, side='left')
+            last = self.sectorOffsets[sector] + np.searchsorted(sectorStart, t1, side='right')
+            if last > first:
+                entries.append(np.arange(first, last))
+        if len(entries) == 0:
+            return np.empty(0, dtype=int)
+
+        entries = np.concatenate(entries)
+        keep = (np.minimum(self.nextTime[entries], self.end[entries]) >= t0) & (self.az[entries] >= azMin) & (self.az[entries] <= azMax)
+        return entries[keep]
@@ -0,0 +1,119 @@
+from typing import List
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+import flightData
+import configRegistry
+import simASR11
+
+# Splits the simulation into the expensive geometric part and the cheap radiometric part
+# The geometry is every pulse that has an aircraft in the beam (whatever its SNR) with the transmitter and receiver ranges, it only
+# depends on the flights, the sites and the pulse timing, so it is computed once and kept on disk under a key made from those
+# SNR, SNR_Min, RCS, gains and noise are then a vectorized pass over the cached hits: snr = powerScalar * RCS / (Rt^2 Rr^2) / noise
+# evaluate gives the same detections as the simulators for the current scenario
+
+cachePath = "FlightData/.geometryCache/"
+geometryVersion = 1 # Bump when getBeamHits changes
+GEOMETRY_COLUMNS = ['flightIdx', 't', 'stateIdx', 'Rt', 'Rr']
+
+def flightsFingerprint(flights: List[flightData.Flight]) -> str:
+    digest = hashlib.sha1()
+    for flight in flights:
+        digest.update(flight.id.encode())
+        digest.update(flight.t.tobytes())
+        digest.update(flight.ECEF.tobytes())
+        digest.update(flight.AER.tobytes())
+    return digest.hexdigest()
+
+def geometryKey(flights: List[flightData.Flight], pulseInterval: float, simRange: float) -> str:
+    # Everything the beam hits and ranges depend on: flights, transmitter/receiver site, pulse timing, beam shape and terrain
+    params = [geometryVersion, simASR11.transmitterECEF.tolist(), simASR11.receiverECEF.tolist(), pulseInterval, simRange,
+              simASR11.ASR11_ROT_S, simASR11.BEAMWIDTH_HORIZONAL, simASR11.BEAMWIDTH_VERTICAL, flightData.MAX_STATE_AGE]
+    if simASR11.terrainMask is not None:
+        params.append(simASR11.terrainMask.key)
+    return hashlib.sha1((json.dumps(params) + flightsFingerprint(flights)).encode()).hexdigest()
+
+def buildGeometry(flights: List[flightData.Flight], pulseInterval: float, simRange: float) -> dict:
+    # Columns sorted by flight then time, one row per beam hit
+    columns = {column: [] for column in GEOMETRY_COLUMNS}
+    for flightIdx, flight in enumerate(flights):
+        if (flightIdx % 50) == 0:
+            print(f"Building geometry for index {flightIdx}")
+        [t, stateIdx] = simASR11.getBeamHits(pulseInterval, simRange, flight)
+        [Rt, Rr] = simASR11.getRanges(flight)
+        columns['flightIdx'].append(np.full(len(t), flightIdx, dtype=np.int32))
+        columns['t'].append(t)
+        columns['stateIdx'].append(stateIdx)
+        columns['Rt'].append(Rt[stateIdx])
+        columns['Rr'].append(Rr[stateIdx])
+
+    geometry = {}
+    for column, dtype in zip(GEOMETRY_COLUMNS, [np.int32, float, np.int32, float, float]):
+        geometry[column] = np.concatenate(columns[column]) if len(flights) > 0 else np.empty(0, dtype=dtype)
+    return geometry
+
+def saveGeometry(path: str, geometry: dict):
+    # Same layout as a flight table, one .npy per column in a directory that's moved into place when complete
+    tmpPath = path + ".tmp"
+    os.makedirs(tmpPath, exist_ok=True)
+    for column in GEOMETRY_COLUMNS:
+        np.save(os.path.join(tmpPath, column + ".npy"), geometry[column])
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmpPath, path)
+
+def loadGeometry(path: str, mmap: bool = True) -> dict:
+    mode = 'r' if mmap else None
+    return {column: np.load(os.path.join(path, column + ".npy"), mmap_mode=mode) for column in GEOMETRY_COLUMNS}
+
+def getGeometryPath(flights: List[flightData.Flight], pulseInterval: float, simRange: float, cacheDir: str = cachePath) -> str:
+    return os.path.join(cacheDir, geometryKey(flights, pulseInterval, simRange) + ".geometry")
+
+def getGeometry(flights: List[flightData.Flight], pulseInterval: float, simRange: float, cacheDir: str = cachePath) -> dict:
+    # Cached geometry for the current scenario's sites, built on a miss
+    path = getGeometryPath(flights, pulseInterval, simRange, cacheDir)
+    if os.path.isdir(path):
+        return loadGeometry(path)
+    geometry = buildGeometry(flights, pulseInterval, simRange)
+    os.makedirs(cacheDir, exist_ok=True)
+    saveGeometry(path, geometry)
+    return geometry
+
+def getHitRCS(geometry: dict, flights: List[flightData.Flight], rcsTable: dict = None) -> np.ndarray:
+    # RCS of the aircraft behind each hit, rcsTable maps category -> RCS and defaults to targets.yaml
+    rcsTable = rcsTable or {}
+    flightRCS = np.array([rcsTable[flight.category] if flight.category in rcsTable else configRegistry.getTarget(flight.category).RCS for flight in flights])
+    return flightRCS[geometry['flightIdx']] if len(flights) > 0 else np.empty(0)
+
+def getSNR(geometry: dict, flights: List[flightData.Flight], powerScalar: float = None, noise: float = None, rcsTable: dict = None) -> np.ndarray:
+    # SNR of every hit, defaults to the current scenario, same arithmetic as simASR11.getSNRBatch
+    powerScalar = powerScalar if powerScalar is not None else simASR11.DETECT_POWER_SCALAR
+    noise = noise if noise is not None else simASR11.DETECT_NOISE
+    Rt2 = geometry['Rt']*geometry['Rt']
+    Rr2 = geometry['Rr']*geometry['Rr']
+    return (powerScalar * (getHitRCS(geometry, flights, rcsTable) / (Rt2*Rr2))) / noise
+
+def evaluate(geometry: dict, flights: List[flightData.Flight], powerScalar: float = None, noise: float = None, snrMin: float = None,
+             rcsTable: dict = None) -> List[List[np.ndarray]]:
+    # Detections as one [t, stateIdx, snr] per flight, like simPool.runPool
+    snrMin = snrMin if snrMin is not None else simASR11.SNR_Min
+    snr = getSNR(geometry, flights, powerScalar, noise, rcsTable)
+    detected = snr > snrMin
+
+    flightIdx = geometry['flightIdx'][detected]
+    [t, stateIdx, snr] = [np.asarray(geometry['t'][detected]), np.asarray(geometry['stateIdx'][detected]), snr[detected]]
+    bounds = np.searchsorted(flightIdx, np.arange(len(flights) + 1))
+    return [[t[bounds[idx]:bounds[idx+1]], stateIdx[bounds[idx]:bounds[idx+1]], snr[bounds[idx]:bounds[idx+1]]] for idx in range(len(flights))]
+
+def countDetections(geometry: dict, flights: List[flightData.Flight], powerScalar: np.ndarray, noise: np.ndarray, snrMin: np.ndarray,
+                    rcsTable: dict = None) -> np.ndarray:
+    # Total detections for every combination of the (broadcastable) parameter arrays, for parameter studies
+    # A hit is detected when RCS / (Rt^2 Rr^2) > snrMin * noise / powerScalar, so one sort of the hits answers every combination
+    # Up to floating point rounding at the threshold this matches len of evaluate's detections
+    factor = np.sort(getHitRCS(geometry, flights, rcsTable) / ((geometry['Rt']*geometry['Rt']) * (geometry['Rr']*geometry['Rr'])))
+    threshold = np.asarray(snrMin, dtype=float) * np.asarray(noise, dtype=float) / np.asarray(powerScalar, dtype=float)
+    return len(factor) - np.searchsorted(factor, threshold, side='right')
@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+import cProfile
+import json
+import time
+
+# Stage timers and hot path counters for simulation runs
+# Everything is a no-op until enable() is called, hot paths only pay for checking instrument.enabled
+# Counters are kept both in total and per flight, pool workers send theirs back with takeSnapshot and the parent merges them
+
+enabled = False
+stageTimes = {}
+counters = {}
+flightCounters = {}
+
+def enable(on: bool = True):
+    global enabled
+    enabled = on
+
+def reset():
+    stageTimes.clear()
+    counters.clear()
+    flightCounters.clear()
+
+@contextmanager
+def stage(name: str):
+    # with instrument.stage('simulate'): ...
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stageTimes[name] = stageTimes.get(name, 0) + time.perf_counter() - start
+
+def count(flightId: str, **values: int):
+    # instrument.count(flight.id, pulses=100, detections=2)
+    if not enabled:
+        return
+    flight = flightCounters.setdefault(flightId, {})
+    for key, value in values.items():
+        flight[key] = flight.get(key, 0) + int(value)
+        counters[key] = counters.get(key, 0) + int(value)
+
+def snapshot() -> dict:
+    return {'stages': dict(stageTimes), 'counters': dict(counters), 'flights': {id: dict(values) for id, values in flightCounters.items()}}
+
+def takeSnapshot() -> dict:
+    # Snapshot and reset, used by pool workers so each result only carries what happened since the last one
+    stats = snapshot()
+    reset()
+    return stats
+
+def merge(stats: dict):
+    for name, seconds in stats['stages'].items():
+        stageTimes[name] = stageTimes.get(name, 0) + seconds
+    for id, values in stats['flights'].items():
+        flight = flightCounters.setdefault(id, {})
+        for key, value in values.items():
+            flight[key] = flight.get(key, 0) + value
+    for key, value in stats['counters'].items():
+        counters[key] = counters.get(key, 0) + value
+
+def export(path: str):
+    with open(path, 'w') as outFile:
+        json.dump(snapshot(), outFile, indent=2)
+
+def summary() -> str:
+    lines = [f"{name}: {round(seconds, 3)}s" for name, seconds in stageTimes.items()]
+    lines += [f"{key}: {value}" for key, value in counters.items()]
+    return "\n".join(lines)
+
+def profile(func, path: str, *args, **kwargs):
+    # Runs func under cProfile and writes the stats to path for pstats/snakeviz
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
@@ -0,0 +1,76 @@
+import numpy as np
+
+# Compiled versions of the simASR11 hot loop, working on plain arrays so numba can compile them in nopython mode
+# cache=True keeps the compiled code in __pycache__ so pool workers load it instead of compiling again
+# Without numba the kernels still run as plain Python, simASR11.detectFlightCompiled uses the NumPy path instead
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True)
+def stateSNRKernel(stateECEF: np.ndarray, RCS: float, transmitterECEF: np.ndarray, receiverECEF: np.ndarray, powerScalar: float, noise: float) -> np.ndarray:
+    # Same as simASR11.getSNRBatch
+    snr = np.empty(stateECEF.shape[0])
+    for idx in range(stateECEF.shape[0]):
+        Rt2 = 0.0
+        Rr2 = 0.0
+        for axis in range(3):
+            dt = stateECEF[idx, axis] - transmitterECEF[axis]
+            dr = stateECEF[idx, axis] - receiverECEF[axis]
+            Rt2 += dt*dt
+            Rr2 += dr*dr
+        Rt = np.sqrt(Rt2)
+        Rr = np.sqrt(Rr2)
+        snr[idx] = (powerScalar * (RCS / ((Rt*Rt)*(Rr*Rr)))) / noise
+    return snr
+
+
+@njit(cache=True)
+def detectKernel(tPulses: np.ndarray, stateTime: np.ndarray, stateAER: np.ndarray, stateECEF: np.ndarray, stateVisible: np.ndarray, RCS: float,
+                 transmitterECEF: np.ndarray, receiverECEF: np.ndarray, powerScalar: float, noise: float, snrMin: float,
+                 rotationPeriod: float, beamwidthHorizontal: float, beamwidthVertical: float, maxStateAge: float):
+    # Returns [pulseIdx, stateIdx, snr] for every pulse that detects the flight, tPulses and stateTime must be sorted
+    # stateVisible is simASR11's terrain mask, all True without terrain masking
+    stateSNR = stateSNRKernel(stateECEF, RCS, transmitterECEF, receiverECEF, powerScalar, noise)
+
+    pulseIdx = np.empty(64, dtype=np.int64)
+    stateIdx = np.empty(64, dtype=np.int32)
+    count = 0
+
+    # Both are sorted so the state lookup is a pointer that only moves forward, same result as Flight.getStateIndices
+    state = 0
+    for pulse in range(tPulses.shape[0]):
+        t = tPulses[pulse]
+        while state + 1 < stateTime.shape[0] and stateTime[state + 1] <= t:
+            state += 1
+
+        if abs(stateTime[state] - t) > maxStateAge:
+            continue
+        if stateAER[state, 1] > beamwidthVertical or not stateVisible[state] or not stateSNR[state] > snrMin:
+            continue
+        az = ((t / rotationPeriod) % 1) * 360
+        if abs(stateAER[state, 0] - az) > beamwidthHorizontal:
+            continue
+
+        if count == pulseIdx.shape[0]:
+            pulseIdx = np.concatenate((pulseIdx, np.empty_like(pulseIdx)))
+            stateIdx = np.concatenate((stateIdx, np.empty_like(stateIdx)))
+        pulseIdx[count] = pulse
+        stateIdx[count] = state
+        count += 1
+
+    return pulseIdx[:count], stateIdx[:count], stateSNR[stateIdx[:count]]
+
+
+def warmup():
+    # Compiles (or loads from the cache) once in the parent so workers started afterwards find it in the cache
+    detectKernel(np.zeros(1), np.zeros(1), np.zeros((1, 3)), np.ones((1, 3)), np.ones(1, dtype=np.bool_), 1.0, np.zeros(3), np.zeros(3), 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
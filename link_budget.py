@@ -3,7 +3,8 @@ import scipy
 import pymap3d
 
 import scipy.constants
-import yaml
+
+import configRegistry
 
 def feet2meters(f: float) -> float:
     return f*0.3048
@@ -14,59 +15,41 @@ def linear2db(l: float) -> float:
 def db2linear(db: float) -> float:
     return 10**(db/10)
 
-with open("transmitters.yaml") as stream:
-    transmitters = yaml.safe_load(stream)
-
-with open("targets.yaml") as stream:
-    targets = yaml.safe_load(stream)
-
-with open("antennas.yaml") as stream:
-    antennas = yaml.safe_load(stream)
-
-with open("receivers.yaml") as stream:
-    receivers = yaml.safe_load(stream)
-
-with open("locations.yaml") as stream:
-    locations = yaml.safe_load(stream)
-
-# transmitter = transmitters['ASR-11']
-transmitter = transmitters['WSR-88D']
-target = targets['Boeing 737']
-antenna = antennas['Dipole']
-receiver = receivers['Pluto SDR']
-location = locations['Mount Jurupa']
+# Transmitter/receiver setup from scenarios.yaml, set the SCENARIO environment variable to pick another one
+# scenario = configRegistry.getScenario('ASR-11 Clairemont Hills')
+scenario = configRegistry.selectScenario('WSR-88D Mount Jurupa')
+target = configRegistry.getTarget('Boeing 737')
 
 T0 = 290 # Kelvin - System temperature
-SNR_Min = 10 # db - How much more powerful does the signal need to be in order to detect it
+SNR_Min = scenario.SNR_Min # How much more powerful does the signal need to be in order to detect it
 
-Pt = float(transmitter['Pt'])   # Transmitter power
-Gt = db2linear(float(transmitter['Gt']))   # Transmitter gain
-Fc = float(transmitter['Fc'])   # Transmitter frequency
-Tau = float(transmitter['Tau']) # Transmitter pulse width
+Pt = scenario.transmitter.Pt   # Transmitter power
+Gt = scenario.transmitter.Gt   # Transmitter gain
+Fc = scenario.transmitter.Fc   # Transmitter frequency
+Tau = scenario.transmitter.Tau # Transmitter pulse width
 
-RCS = float(target['RCS']) # Target Radar Cross Section
+RCS = target.RCS # Target Radar Cross Section
 
-Gr = db2linear(float(antenna['Gr'])) # Reciver antenna gain
+Gr = scenario.antenna.Gr # Reciver antenna gain
 
-Fn = float(receiver['F'])  # Receiver noise figure
-Tr = float(receiver['T'])  # Receiver temperature
-BW = float(receiver['BW']) # Receiver Bandwidth
+Fn = scenario.receiver.F  # Receiver noise figure
+Tr = scenario.receiver.T  # Receiver temperature
+BW = scenario.receiver.BW # Receiver Bandwidth
 
 
 # Later comes from simulations
-transmitterLLA = [34.052724, -117.596634, 0] # altitude might be off...
+transmitterLLA = scenario.transmitterLocation.LLA
 targetLLA = [34.05638, -117.66055, feet2meters(2250)] # 737 at takeoff
 # targetLLA = [34.0687, -117.51134, feet2meters(11500)] # 737 flying to LAX
 # targetLLA = [34.09941, -117.76307, feet2meters(29000)] # 737 flying to LAX
-receiverLLA = location['LLA']
+receiverLLA = scenario.receiverLocation.LLA
 
 
-transmitterECEF = np.array(pymap3d.geodetic2ecef(*transmitterLLA))
+transmitterECEF = np.array(scenario.transmitterLocation.ECEF)
 targetECEF = np.array(pymap3d.geodetic2ecef(*targetLLA))
-receiverECEF = np.array(pymap3d.geodetic2ecef(*receiverLLA))
+receiverECEF = np.array(scenario.receiverLocation.ECEF)
 
-transmitter2targetENU = np.array(pymap3d.ecef2enu(*receiverECEF, *transmitterLLA))
-elevationAngle = np.rad2deg(np.tan(transmitter2targetENU[2] / np.sqrt(transmitter2targetENU[0]**2 + transmitter2targetENU[1]**2)))
+elevationAngle = configRegistry.getElevationAngle(scenario)
 print(f"Transmitter to Receiver elevation angle = {round(elevationAngle, 3)} degrees")
 
 
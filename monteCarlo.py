@@ -0,0 +1,258 @@
+from datetime import datetime, timezone
+from multiprocessing import Pool
+from typing import List
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import configRegistry
+import flightData
+import geometryCache
+import simASR11
+import simPool
+
+# Probability of detection by Monte Carlo instead of the deterministic snr > SNR_Min
+# Every beam hit from the geometry cache gets trials draws of a Swerling RCS fluctuation and of the receiver noise:
+# a pulse is detected when |sqrt(snr * fluctuation) + noise|^2 > SNR_Min with complex Gaussian noise of unit power
+# Hits are grouped into beam dwells (one flight, one rotation), Swerling 1/3 keep the RCS for a whole dwell, 2/4 draw it per pulse
+# Trials are only counted, never stored: per flight and per bistatic range bin the pulse and dwell detections are summed over trials
+# Work is cut into chunks of whole dwells, each with its own RNG stream spawned from the seed and the chunk number,
+# so the results are the same whatever the number of processes or the order chunks finish in
+# Run from the repository root:
+#   python monteCarlo.py --swerling 1 --trials 1000 --out FlightData/monteCarlo.json
+
+# Swerling case: [chi-square degrees of freedom of the RCS, drawn per pulse rather than per dwell], 0 doesn't fluctuate
+SWERLING_CASES = {
+    0: [None, False],
+    1: [2, False],
+    2: [2, True],
+    3: [4, False],
+    4: [4, True],
+}
+maxDrawElements = 4000000 # Trials x pulses drawn at once, bounds memory per worker
+
+# Per worker state, set by initWorker
+geometry: dict = None
+workerSettings: dict = None
+
+def getDwells(geometry: dict) -> np.ndarray:
+    # Dwell number of every hit, a new dwell starts whenever the flight or the rotation changes
+    flightIdx = np.asarray(geometry['flightIdx'])
+    rotation = np.floor(np.asarray(geometry['t']) / simASR11.ASR11_ROT_S).astype(np.int64)
+    newDwell = np.ones(len(flightIdx), dtype=bool)
+    newDwell[1:] = (np.diff(flightIdx) != 0) | (np.diff(rotation) != 0)
+    return np.cumsum(newDwell) - 1
+
+def getRangeBins(geometry: dict, rangeBinWidth: float) -> np.ndarray:
+    # Bistatic range (Rt + Rr) bin of every hit
+    return ((np.asarray(geometry['Rt']) + np.asarray(geometry['Rr'])) // rangeBinWidth).astype(np.int64)
+
+def planChunks(dwell: np.ndarray, chunkSize: int) -> List[List[int]]:
+    # [firstHit, endHit] chunks of about chunkSize hits that never split a dwell
+    dwellStarts = np.flatnonzero(np.diff(dwell, prepend=-1))
+    edges = [0]
+    while edges[-1] < len(dwell):
+        nextEdge = np.searchsorted(dwellStarts, edges[-1] + chunkSize)
+        edges.append(int(dwellStarts[nextEdge]) if nextEdge < len(dwellStarts) else len(dwell))
+    return [[first, end] for first, end in zip(edges[:-1], edges[1:])]
+
+def drawFluctuation(rng: np.random.Generator, swerling: int, shape: tuple) -> np.ndarray:
+    # RCS over its mean, chi-square with the case's degrees of freedom scaled to a mean of 1
+    [dof, _] = SWERLING_CASES[swerling]
+    if dof is None:
+        return np.ones(shape, dtype=np.float32)
+    if dof == 2:
+        return rng.standard_exponential(shape, dtype=np.float32)
+    return rng.standard_gamma(dof / 2, shape, dtype=np.float32) / np.float32(dof / 2)
+
+def drawDetections(rng: np.random.Generator, snr: np.ndarray, dwell: np.ndarray, trials: int, swerling: int, snrMin: float,
+                   noiseDraws: bool = True) -> List[np.ndarray]:
+    # Returns [pulseDetections, dwellDetections], how many of the trials detected each pulse and each dwell (dwell numbered from 0)
+    # Trials are drawn in blocks so no more than maxDrawElements values are held at once
+    [_, perPulse] = SWERLING_CASES[swerling]
+    dwellCount = int(dwell[-1]) + 1 if len(dwell) > 0 else 0
+    pulseDetections = np.zeros(len(snr), dtype=np.int64)
+    dwellDetections = np.zeros(dwellCount, dtype=np.int64)
+    snr = snr.astype(np.float32)
+    dwellStarts = np.flatnonzero(np.diff(dwell, prepend=-1))
+
+    blockTrials = max(maxDrawElements // max(len(snr), 1), 1)
+    for blockStart in range(0, trials, blockTrials):
+        block = min(blockTrials, trials - blockStart)
+        if perPulse:
+            fluctuation = drawFluctuation(rng, swerling, (block, len(snr)))
+        else:
+            fluctuation = drawFluctuation(rng, swerling, (block, dwellCount))[:, dwell]
+        amplitude = np.sqrt(snr[None, :] * fluctuation)
+        if noiseDraws:
+            # Noise of unit power split over I and Q, the signal's phase doesn't matter so it is put on I
+            scale = np.float32(np.sqrt(0.5))
+            power = (amplitude + scale*rng.standard_normal((block, len(snr)), dtype=np.float32))**2
+            power += (scale*rng.standard_normal((block, len(snr)), dtype=np.float32))**2
+        else:
+            power = amplitude*amplitude
+        detected = power > snrMin
+
+        pulseDetections += detected.sum(axis=0)
+        dwellDetections += np.logical_or.reduceat(detected, dwellStarts, axis=1).sum(axis=0)
+    return [pulseDetections, dwellDetections]
+
+def getHitSNR(geometry: dict, flightRCS: np.ndarray, powerScalar: float, noise: float, rows: slice = slice(None)) -> np.ndarray:
+    # Mean SNR of the hits in rows, same arithmetic as geometryCache.getSNR
+    Rt = np.asarray(geometry['Rt'][rows])
+    Rr = np.asarray(geometry['Rr'][rows])
+    return (powerScalar * (flightRCS[np.asarray(geometry['flightIdx'][rows])] / ((Rt*Rt)*(Rr*Rr)))) / noise
+
+def simulateChunk(chunkIdx: int, firstHit: int, endHit: int, settings: dict, geometry: dict, dwell: np.ndarray, rangeBin: np.ndarray) -> List:
+    # [chunkIdx, per flight pulse detections, per flight dwell detections, per range bin pulse detections, per range bin dwell detections]
+    rows = slice(firstHit, endHit)
+    rng = np.random.default_rng(np.random.SeedSequence(settings['seed'], spawn_key=(chunkIdx,)))
+    snr = getHitSNR(geometry, settings['flightRCS'], settings['powerScalar'], settings['noise'], rows)
+    chunkDwell = dwell[rows] - dwell[firstHit]
+    [pulseDetections, dwellDetections] = drawDetections(rng, snr, chunkDwell, settings['trials'], settings['swerling'], settings['snrMin'],
+                                                        settings['noiseDraws'])
+
+    flightIdx = np.asarray(geometry['flightIdx'][rows])
+    dwellFirst = np.flatnonzero(np.diff(chunkDwell, prepend=-1))
+    flightCount = len(settings['flightRCS'])
+    binCount = settings['rangeBins']
+    return [chunkIdx,
+            np.bincount(flightIdx, weights=pulseDetections, minlength=flightCount),
+            np.bincount(flightIdx[dwellFirst], weights=dwellDetections, minlength=flightCount),
+            np.bincount(rangeBin[rows], weights=pulseDetections, minlength=binCount),
+            np.bincount(rangeBin[rows][dwellFirst], weights=dwellDetections, minlength=binCount)]
+
+def initWorker(geometryPath: str, settings: dict):
+    global geometry, workerSettings
+    geometry = geometryCache.loadGeometry(geometryPath)
+    workerSettings = settings
+    workerSettings['dwell'] = getDwells(geometry)
+    workerSettings['rangeBin'] = getRangeBins(geometry, settings['rangeBinWidth'])
+
+def simulateWorkerChunk(chunk: List[int]) -> List:
+    [chunkIdx, firstHit, endHit] = chunk
+    return simulateChunk(chunkIdx, firstHit, endHit, workerSettings, geometry, workerSettings['dwell'], workerSettings['rangeBin'])
+
+def checkSites(scenario: configRegistry.Scenario, geometryScenario: configRegistry.Scenario):
+    # The geometry's beam hits and ranges are for geometryScenario's sites, any other scenario's Pd would be for the wrong hits
+    sites = [['transmitter', scenario.transmitterLocation, geometryScenario.transmitterLocation],
+             ['receiver', scenario.receiverLocation, geometryScenario.receiverLocation]]
+    for [role, location, geometryLocation] in sites:
+        if tuple(location.LLA) != tuple(geometryLocation.LLA):
+            raise ValueError(f"{scenario.name} has its {role} at {location.LLA} but the geometry is for {geometryLocation.LLA}, "
+                             f"call simASR11.setScenario first")
+
+def runMonteCarlo(flights: List[flightData.Flight], pulseInterval: float, simRange: float, trials: int = 1000, swerling: int = 1,
+                  seed: int = 0, noiseDraws: bool = True, rangeBinWidth: float = 5e3, chunkSize: int = 20000, processes: int = None,
+                  scenario: configRegistry.Scenario = None, rcsTable: dict = None) -> dict:
+    # Pd per flight and per bistatic range bin for the current scenario (or scenario, which must share its sites)
+    # processes=1 runs in this process, otherwise chunks go out over a pool that memory maps the cached geometry
+    scenario = scenario or simASR11.scenario
+    checkSites(scenario, simASR11.scenario)
+    geometry = geometryCache.getGeometry(flights, pulseInterval, simRange)
+    geometryPath = geometryCache.getGeometryPath(flights, pulseInterval, simRange)
+    rcsTable = rcsTable or {}
+    flightRCS = np.array([rcsTable[flight.category] if flight.category in rcsTable else configRegistry.getTarget(flight.category).RCS for flight in flights])
+
+    dwell = getDwells(geometry)
+    rangeBin = getRangeBins(geometry, rangeBinWidth)
+    flightIdx = np.asarray(geometry['flightIdx'])
+    dwellFirst = np.flatnonzero(np.diff(dwell, prepend=-1))
+    rangeBins = int(rangeBin.max()) + 1 if len(rangeBin) > 0 else 0
+    settings = {'seed': seed, 'trials': trials, 'swerling': swerling, 'snrMin': scenario.SNR_Min, 'noiseDraws': noiseDraws,
+                'powerScalar': scenario.powerScalar, 'noise': scenario.noise, 'flightRCS': flightRCS, 'rangeBins': rangeBins,
+                'rangeBinWidth': rangeBinWidth}
+
+    chunks = [[chunkIdx, first, end] for chunkIdx, [first, end] in enumerate(planChunks(dwell, chunkSize))]
+    totals = [np.zeros(len(flights)), np.zeros(len(flights)), np.zeros(rangeBins), np.zeros(rangeBins)]
+    progress = simPool.ProgressReporter(len(geometry['t']))
+    if processes == 1:
+        results = (simulateChunk(chunkIdx, first, end, settings, geometry, dwell, rangeBin) for [chunkIdx, first, end] in chunks)
+        for result in results:
+            progress.update(chunks[result[0]][2] - chunks[result[0]][1])
+            for total, values in zip(totals, result[1:]):
+                total += values
+    else:
+        with Pool(processes or os.cpu_count(), initializer=initWorker, initargs=(geometryPath, settings)) as p:
+            for result in p.imap_unordered(simulateWorkerChunk, chunks, chunksize=1):
+                progress.update(chunks[result[0]][2] - chunks[result[0]][1])
+                for total, values in zip(totals, result[1:]):
+                    total += values
+
+    # Sums of whole numbers of detections, exact in float64 whatever order the chunks were added in
+    [flightPulseDetections, flightDwellDetections, rangePulseDetections, rangeDwellDetections] = totals
+    return {
+        'trials': trials,
+        'swerling': swerling,
+        'rangeBinWidth': rangeBinWidth,
+        'flightPulses': np.bincount(flightIdx, minlength=len(flights)),
+        'flightDwells': np.bincount(flightIdx[dwellFirst], minlength=len(flights)),
+        'flightPulseDetections': flightPulseDetections,
+        'flightDwellDetections': flightDwellDetections,
+        'rangePulses': np.bincount(rangeBin, minlength=rangeBins),
+        'rangeDwells': np.bincount(rangeBin[dwellFirst], minlength=rangeBins),
+        'rangePulseDetections': rangePulseDetections,
+        'rangeDwellDetections': rangeDwellDetections,
+    }
+
+def getPd(detections: np.ndarray, opportunities: np.ndarray, trials: int) -> np.ndarray:
+    # Share of the trials x opportunities that detected, nan where there were none
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return detections / (opportunities * trials)
+
+def summarize(result: dict, flights: List[flightData.Flight]) -> dict:
+    trials = result['trials']
+    flightPulsePd = getPd(result['flightPulseDetections'], result['flightPulses'], trials)
+    flightDwellPd = getPd(result['flightDwellDetections'], result['flightDwells'], trials)
+    rangePulsePd = getPd(result['rangePulseDetections'], result['rangePulses'], trials)
+    rangeDwellPd = getPd(result['rangeDwellDetections'], result['rangeDwells'], trials)
+    return {
+        'trials': trials,
+        'swerling': result['swerling'],
+        'flights': [{
+            'id': flight.id,
+            'category': flight.category,
+            'pulses': int(result['flightPulses'][idx]),
+            'dwells': int(result['flightDwells'][idx]),
+            'expectedDetections': float(result['flightPulseDetections'][idx] / trials),
+            'pulsePd': float(flightPulsePd[idx]),
+            'dwellPd': float(flightDwellPd[idx]),
+        } for idx, flight in enumerate(flights) if result['flightPulses'][idx] > 0],
+        'ranges': [{
+            'bistaticRange': float(idx * result['rangeBinWidth']),
+            'pulses': int(result['rangePulses'][idx]),
+            'dwells': int(result['rangeDwells'][idx]),
+            'pulsePd': float(rangePulsePd[idx]),
+            'dwellPd': float(rangeDwellPd[idx]),
+        } for idx in np.flatnonzero(result['rangePulses'])],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Probability of detection per flight and per range bin by Monte Carlo")
+    parser.add_argument('--flights', default="FlightData/2025_03_01.flights")
+    parser.add_argument('--sim-range', type=float, default=24*60*60)
+    parser.add_argument('--pulse-interval', type=float, default=1e-3)
+    parser.add_argument('--trials', type=int, default=1000)
+    parser.add_argument('--swerling', type=int, default=1, choices=sorted(SWERLING_CASES.keys()))
+    parser.add_argument('--no-noise', action='store_true', help="only draw the RCS fluctuation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--range-bin', type=float, default=5e3, help="bistatic range bin width in meters")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--out', default="FlightData/monteCarlo.json")
+    args = parser.parse_args()
+
+    tStart = datetime(2025, 3, 1, 0, 0, 0, tzinfo=timezone.utc)
+    flights = flightData.loadFlights(args.flights, tStart)
+    start = time.time()
+    result = runMonteCarlo(flights, args.pulse_interval, args.sim_range, args.trials, args.swerling, args.seed, not args.no_noise,
+                           args.range_bin, processes=args.processes)
+    print(f"{args.trials} trials of {int(result['flightPulses'].sum())} beam hits took {round(time.time() - start, 2)}s")
+
+    summary = summarize(result, flights)
+    with open(args.out, 'w') as outFile:
+        json.dump(summary, outFile, indent=2)
+    for rangeBin in summary['ranges']:
+        print(f"{round(rangeBin['bistaticRange']/1e3):>6}km {rangeBin['pulses']:>10} pulses  pulse Pd {rangeBin['pulsePd']:.4f}  dwell Pd {rangeBin['dwellPd']:.4f}")
@@ -1,52 +1,127 @@
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 import time
-import cProfile
-from multiprocessing import Pool
-from functools import partial
-from itertools import repeat
 
+import flightData
+import instrument
 
-import numpy as np
+# Stage timers and per flight hot path counters (pulses, state misses, FOV/SNR rejects, detections), summed over pool workers
+# and written to instrumentPath at the end of the run. The counters cost nothing while this is off
+instrumentRun = False
+instrumentPath = "simStats.json"
+# Set to a path to run the simulation under cProfile, view with python -m pstats or snakeviz. Only profiles this process, not pool workers
+profilePath = None
+instrument.enable(instrumentRun)
 
-import flightData
-import simASR11
+with instrument.stage('config'):
+    import configRegistry
+    import simASR11 # Loads the scenario from configRegistry
+    import simPool
+    import detectionStream
+    import geometryCache
+    import terrain
+print(f"Scenario {simASR11.scenario.name}, elevationAngle = {configRegistry.getElevationAngle(simASR11.scenario)}")
+
+# Elevation grid (an SRTM .hgt tile, or a .npy grid with a .json sidecar) to drop positions hidden behind terrain from the
+# transmitter or receiver. Horizon tables for both sites are cached under FlightData/.terrainCache/ after the first run
+# mastHeight puts the sites that far above the grid's terrain instead of at their locations.yaml altitude
+terrainPath = None
+# terrainPath = "FlightData/N34W118.hgt"
+mastHeight = None
+if terrainPath is not None:
+    with instrument.stage('terrain'):
+        simASR11.setTerrain(terrain.getTerrainMask(terrain.loadDEM(terrainPath), simASR11.scenario, mastHeight))
 
 # Pulse repetition frequency of 1ms - Field Measurements of Pulsed Radar with the Field Master ProTM MS2090A
 # @ 4.8s/rev this gives spacial resolution of 0.075 degrees - no chance I'm that good
 # So if we simulate ato 10ms we still giet 0.75 degree resolution
+# The beam scheduler only evaluates pulses while the beam is crossing each flight so it can afford the full 1ms PRF
 
+simMode = 'beam' # 'scalar' and 'batch' test every pulse in tPulses, 'beam' only tests pulses inside beam dwell windows
+# 'compiled' is 'batch' through the numba kernel in kernels.py, it falls back on 'batch' without numba
+# 'pulse' walks the pulses in time order in a single process, using flightIndex to find which aircraft could be in the beam
 simRange = 24*60*60
 # simRange = 5*60
-tPulses = np.arange(0, simRange, 1e-2)
+pulseInterval = 1e-3 if simMode in ['beam', 'pulse'] else 1e-2
 tStart = datetime(2025, 3, 1, 0, 0, 0, tzinfo=timezone.utc)
 
-# First load in all of the aircrafts
-flights = flightData.loadFlights("FlightData/2025_03_01.json.bak", tStart)
-
-# cProfile.run('simASR11.simulateFlight(tPulses, flights[1])')
-# exit(0)
+# First load in all of the aircrafts, the memory mapped flight table from filterData is much faster to load than the JSON
+flightPath = "FlightData/2025_03_01.flights"
+# flightPath = "FlightData/2025_03_01.json.bak"
+with instrument.stage('flightLoad'):
+    flights = flightData.loadFlights(flightPath, tStart)
 
+# Pool workers load the flights and build the pulse timeline themselves, only flight indices and detection arrays cross processes
+# Long flights are split into time shards and handed out largest first, see simPool
 useMultiprocessing = True
-start = time.time()
-flightDetects = []
-if useMultiprocessing:
-    with Pool() as p:
-        flightDetects = p.starmap(simASR11.simulateFlight, zip(repeat(tPulses), flights))
 
-else:
+# Keep the beam hits and ranges on disk (see geometryCache) and only redo the SNR pass, for studies that change
+# SNR_Min, gains, noise or RCS but not the sites or pulse timing. Gives the same detections as simMode
+useGeometryCache = False
+
+# Set to stream detections to a file chunk by chunk instead of keeping them all in memory, for multi day runs
+# Only the per flight summary is kept. 'pulse' and useGeometryCache work on every flight at once so they still hold their
+# detections in memory until the end of the simulation, only the output is streamed
+# .csv paths get text, anything else the memory mappable records format from detection.py (read back with detection.readDetections)
+streamPath = None
+# streamPath = "FlightData/2025_03_01.det"
+
+def runStream() -> detectionStream.DetectionStats:
+    if useGeometryCache:
+        pieces = detectionStream.iterFlightDetections(geometryCache.evaluate(geometryCache.getGeometry(flights, pulseInterval, simRange), flights))
+    elif simMode == 'pulse':
+        pieces = detectionStream.iterFlightDetections(simASR11.detectPulseCentric(pulseInterval, simRange, flights))
+    elif useMultiprocessing:
+        pieces = detectionStream.iterPoolDetections(flightPath, tStart, simMode, pulseInterval, simRange, flights)
+    else:
+        pieces = detectionStream.iterDetections(flights, simMode, pulseInterval, simRange)
+    return detectionStream.runStream(pieces, detectionStream.getSink(streamPath, flights), detectionStream.DetectionStats(len(flights)))
+
+def runSimulation() -> list:
+    if useGeometryCache:
+        return geometryCache.evaluate(geometryCache.getGeometry(flights, pulseInterval, simRange), flights)
+
+    if simMode == 'pulse':
+        return simASR11.detectPulseCentric(pulseInterval, simRange, flights)
+
+    if useMultiprocessing:
+        return simPool.runPool(flightPath, tStart, simMode, pulseInterval, simRange, flights)
+
+    flightDetects = []
+    simulate = simPool.getSimulator(simMode, pulseInterval, simRange)
+    pulseCount = simASR11.getPulseCount(pulseInterval, simRange)
     for flightIdx, flight in enumerate(flights):
         if (flightIdx % 50) == 0:
             print(f"Processing index {flightIdx}")
-        flightDetects.append(simASR11.simulateFlight(tPulses, flight))
+        flightDetects.append(simulate(flight, 0, pulseCount))
+    return flightDetects
 
+streaming = streamPath is not None
+start = time.time()
+with instrument.stage('simulate'):
+    run = runStream if streaming else runSimulation
+    if profilePath is not None:
+        result = instrument.profile(run, profilePath)
+    else:
+        result = run()
 
 print(f"Simulation took {time.time() - start}s")
 
-print(f"Detected {len(flightDetects) - flightDetects.count([])} flights")
-for flight, detects in zip(flights, flightDetects):
-    if len(detects) > 0:
-        print(f"Target {flight.id} with cat {flight.category} detected {len(detects)} times:")
-        print(f"detects[0] - {detects[0].state.LLA} - snr = {detects[0].snr}")
-
+# Spot check the selected mode against the plain NumPy path on a few flights
+checkMode = False
+if checkMode and simMode not in ['batch', 'pulse']:
+    mismatches = simPool.compareModes(flights[:20], simMode, 'batch', pulseInterval, simRange)
+    print(f"{simMode} matches batch" if len(mismatches) == 0 else f"{simMode} differs from batch for {mismatches}")
 
+with instrument.stage('report'):
+    if streaming:
+        result.report(flights)
+    else:
+        print(f"Detected {sum(len(t) > 0 for [t, _, _] in result)} flights")
+        for flight, [t, stateIdx, snr] in zip(flights, result):
+            if len(t) > 0:
+                print(f"Target {flight.id} with cat {flight.category} detected {len(t)} times:")
+                print(f"detects[0] - {flight.LLA[stateIdx[0]]} - snr = {snr[0]}")
 
+if instrument.enabled:
+    print(instrument.summary())
+    instrument.export(instrumentPath)
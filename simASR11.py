@@ -1,13 +1,12 @@
 from typing import Optional, List
-import yaml
 
 import numpy as np
-import pymap3d
-import scipy
-import scipy.constants
-from numba import njit
 
-from flightData import FlightState, Flight
+import configRegistry
+from flightData import Flight, MAX_STATE_AGE
+from flightIndex import FlightIndex
+import kernels
+import instrument
 from detection import Detection
 
 # Simulates the Bistatic receiver
@@ -28,62 +27,48 @@ ASR11_ROT_S = 1/ASR11_ROT_HZ
 BEAMWIDTH_HORIZONAL = 1.4
 BEAMWIDTH_VERTICAL = 5
 
-with open("transmitters.yaml") as stream:
-    transmitters = yaml.safe_load(stream)
+# Transmitter/receiver setup from scenarios.yaml, set the SCENARIO environment variable to pick another one
+# setScenario switches it at runtime, the module globals below are what the simulation functions read
+scenario: configRegistry.Scenario = None
+SNR_Min: float = None # Linear - How much more powerful does the signal need to be in order to detect it
+transmitterECEF: np.ndarray = None
+receiverECEF: np.ndarray = None
+DETECT_POWER_SCALAR: float = None # Constants with respect to inputs to getSNR
+DETECT_NOISE: float = None
+DETECT_MDS: float = None # dB
+
+def setScenario(newScenario: configRegistry.Scenario):
+    global scenario, SNR_Min, transmitterECEF, receiverECEF, DETECT_POWER_SCALAR, DETECT_NOISE, DETECT_MDS
+    scenario = newScenario
+    SNR_Min = scenario.SNR_Min
+    transmitterECEF = np.array(scenario.transmitterLocation.ECEF)
+    receiverECEF = np.array(scenario.receiverLocation.ECEF)
+    DETECT_POWER_SCALAR = scenario.powerScalar
+    DETECT_NOISE = scenario.noise
+    DETECT_MDS = linear2db(DETECT_NOISE) + SNR_Min
+
+setScenario(configRegistry.selectScenario('ASR-11 Clairemont Hills'))
+
+# Optional terrain masking, a terrain.TerrainMask for the scenario's sites. States it hides from the transmitter or the
+# receiver can't be detected. Worked out once per ADS-B sample so the per pulse checks are unchanged
+terrainMask = None
+
+def setTerrain(newTerrainMask):
+    global terrainMask
+    terrainMask = newTerrainMask
+
+def getTerrainVisibility(flight: Flight) -> Optional[np.ndarray]:
+    # Per state mask of line of sight from both sites, None without terrain masking
+    if terrainMask is None:
+        return None
+    return terrainMask.getVisibleStates(flight.ECEF)
+
+def getRCS(category: str) -> float:
+    return configRegistry.getTarget(category).RCS
 
-with open("targets.yaml") as stream:
-    targets = yaml.safe_load(stream)
-
-with open("antennas.yaml") as stream:
-    antennas = yaml.safe_load(stream)
-
-with open("receivers.yaml") as stream:
-    receivers = yaml.safe_load(stream)
-
-with open("locations.yaml") as stream:
-    locations = yaml.safe_load(stream)
-
-
-transmitter = transmitters['ASR-11']
-antenna = antennas['Dipole']
-receiver = receivers['Pluto SDR']
-location = locations['Clairemont Hills']
-
-
-T0 = 290 # Kelvin - System temperature
-SNR_Min = 5 # db - How much more powerful does the signal need to be in order to detect it
-
-Pt = float(transmitter['Pt'])   # Transmitter power
-Gt = db2linear(float(transmitter['Gt']))   # Transmitter gain
-Fc = float(transmitter['Fc'])   # Transmitter frequency
-Tau = float(transmitter['Tau']) # Transmitter pulse width
-
-Gr = db2linear(float(antenna['Gr'])) # Reciver antenna gain
-
-Fn = float(receiver['F'])  # Receiver noise figure
-Tr = float(receiver['T'])  # Receiver temperature
-BW = float(receiver['BW']) # Receiver Bandwidth
-
-# Altitudes from https://en-gb.topographic-map.com/map-4d9jnh/The-World/?center=34.05351%2C-117.64143&popup=34.05623%2C-117.60057
-transmitterLLA = [34.052724, -117.596634, 282]
-receiverLLA = location['LLA']
-
-transmitterECEF = np.array(pymap3d.geodetic2ecef(*transmitterLLA))
-receiverECEF = np.array(pymap3d.geodetic2ecef(*receiverLLA))
-
-transmitter2targetENU = np.array(pymap3d.ecef2enu(*receiverECEF, *transmitterLLA))
-elevationAngle = np.rad2deg(np.tan(transmitter2targetENU[2] / np.sqrt(transmitter2targetENU[0]**2 + transmitter2targetENU[1]**2)))
-
-print(f"elevationAngle = {elevationAngle}")
-# if elevationAngle < 1:
-#     print(f"Receiver unlikely to get direct signal from antenna at elevation angle {elevationAngle}")
-#     exit(0)
-
-# @njit(cache=True)
 def getAz(t: float) -> float:
     return ((t / ASR11_ROT_S) % 1) * 360
 
-# @njit(cache=True)
 def isInFOV(t: float, AER: np.ndarray) -> bool:
     # Can't be above beam and can't be too close to the ground due to clutter
     # if AER[1] > BEAMWIDTH_VERTICAL or AER[1] < 0.5:
@@ -94,16 +79,6 @@ def isInFOV(t: float, AER: np.ndarray) -> bool:
         return False        
     return True
 
-# Constants with respect to inputs to this function
-wavelength = scipy.constants.c / Fc
-wavelength2 = wavelength*wavelength
-DETECT_POWER_SCALAR = (Pt*Gt*Gr*wavelength2) / ((4*np.pi)**3)
-# DETECT_NOISE = (scipy.constants.k * Tr * Fn) / Tau # using pulse to set bandwidth
-DETECT_NOISE = db2linear(linear2db(scipy.constants.k*Tr) + Fn + linear2db(BW)) # https://en.wikipedia.org/wiki/Minimum_detectable_signal#General
-# Alternative noise floor calculation: https://en.wikipedia.org/wiki/Minimum_detectable_signal
-DETECT_MDS = linear2db(DETECT_NOISE) + SNR_Min # dB
-
-# @njit(cache=True)
 def getSNR(targetECEF: np.ndarray, RCS: float) -> float:
     Rt = np.linalg.norm(targetECEF - transmitterECEF)
     Rr = np.linalg.norm(targetECEF - receiverECEF)
@@ -118,8 +93,22 @@ def getSNR(targetECEF: np.ndarray, RCS: float) -> float:
 
     return Pr / N
 
+def getSNRBatch(targetECEF: np.ndarray, RCS: float) -> np.ndarray:
+    # Same as getSNR for an (N, 3) array of target positions
+    Rt = np.linalg.norm(targetECEF - transmitterECEF, axis=1)
+    Rr = np.linalg.norm(targetECEF - receiverECEF, axis=1)
+
+    Rt2 = Rt*Rt
+    Rr2 = Rr*Rr
+
+    Pr = DETECT_POWER_SCALAR * ((RCS) / (Rt2*Rr2))
+    N = DETECT_NOISE
+
+    return Pr / N
+
 def simulateFlight(tPulses: np.ndarray, flight: Flight) -> List[Detection]:
-    RCS = float(targets[flight.category]['RCS'])
+    RCS = getRCS(flight.category)
+    visible = getTerrainVisibility(flight)
 
     detects = []
     for t in tPulses:
@@ -130,8 +119,254 @@ def simulateFlight(tPulses: np.ndarray, flight: Flight) -> List[Detection]:
         if not isInFOV(t, state.AER):
             continue
 
+        if visible is not None and not visible[flight.getStateIndex(t)]:
+            continue
+
         snr = getSNR(state.ECEF, RCS)
         if snr > SNR_Min:
             detects.append(Detection(t, state, snr))
     return detects
 
+# The detect* functions return detections as arrays [t, stateIdx, snr] rather than a list of Detection objects
+# stateIdx is the row of the flight's arrays that was detected, toDetections turns them back into Detections
+def toDetections(flight: Flight, detections: List[np.ndarray]) -> List[Detection]:
+    [t, stateIdx, snr] = detections
+    return [Detection(t[idx], flight.stateAt(stateIdx[idx]), snr[idx]) for idx in range(len(t))]
+
+def emptyDetections() -> List[np.ndarray]:
+    return [np.empty(0), np.empty(0, dtype=np.int32), np.empty(0)]
+
+def concatDetections(detections: List[List[np.ndarray]]) -> List[np.ndarray]:
+    if len(detections) == 0:
+        return emptyDetections()
+    return [np.concatenate(column) for column in zip(*detections)]
+
+def detectFlight(tPulses: np.ndarray, flight: Flight) -> List[np.ndarray]:
+    # simulateFlight with array output
+    RCS = getRCS(flight.category)
+    visible = getTerrainVisibility(flight)
+
+    detects = []
+    for t in tPulses:
+        idx = flight.getStateIndex(t)
+        if idx < 0:
+            continue
+
+        if not isInFOV(t, flight.AER[idx]):
+            continue
+
+        if visible is not None and not visible[idx]:
+            continue
+
+        snr = getSNR(flight.ECEF[idx], RCS)
+        if snr > SNR_Min:
+            detects.append([t, idx, snr])
+    if instrument.enabled:
+        countPulses(tPulses, flight.getStateIndices(tPulses), flight, len(detects))
+    if len(detects) == 0:
+        return emptyDetections()
+    [t, stateIdx, snr] = zip(*detects)
+    return [np.array(t), np.array(stateIdx, dtype=np.int32), np.array(snr)]
+
+def countPulses(t: np.ndarray, idx: np.ndarray, flight: Flight, detections: int):
+    # Splits the pulses in t by why they did or didn't detect the flight, in the order simulateFlight checks them
+    # idx is flight.getStateIndices(t), only called while instrument.enabled so the extra pass is free otherwise
+    found = idx >= 0
+    inBeam = found.copy()
+    inBeam[found] = (flight.AER[idx[found], 1] <= BEAMWIDTH_VERTICAL) & (np.abs(flight.AER[idx[found], 0] - getAz(t[found])) <= BEAMWIDTH_HORIZONAL)
+    visible = getTerrainVisibility(flight)
+    if visible is None:
+        instrument.count(flight.id, pulses=len(t), stateMisses=len(t) - found.sum(), fovRejects=found.sum() - inBeam.sum(),
+                         snrRejects=inBeam.sum() - detections, detections=detections)
+        return
+    inSight = inBeam.copy()
+    inSight[inBeam] = visible[idx[inBeam]]
+    instrument.count(flight.id, pulses=len(t), stateMisses=len(t) - found.sum(), fovRejects=found.sum() - inBeam.sum(),
+                     terrainRejects=inBeam.sum() - inSight.sum(), snrRejects=inSight.sum() - detections, detections=detections)
+
+def detectPulses(t: np.ndarray, flight: Flight, stateSNR: np.ndarray, stateCandidate: np.ndarray) -> List[np.ndarray]:
+    # Checks the pulse times in t against the flight given the per-state SNR and a mask of states that can be detected at all
+    idx = flight.getStateIndices(t)
+
+    hit = idx >= 0
+    hit[hit] = stateCandidate[idx[hit]]
+    hit[hit] = np.abs(flight.AER[idx[hit], 0] - getAz(t[hit])) <= BEAMWIDTH_HORIZONAL
+
+    stateIdx = idx[hit].astype(np.int32)
+    if instrument.enabled:
+        countPulses(t, idx, flight, len(stateIdx))
+    return [t[hit], stateIdx, stateSNR[stateIdx]]
+
+def getStateDetectability(flight: Flight) -> List[np.ndarray]:
+    # Everything that only depends on the state is computed once per ADS-B sample rather than once per pulse
+    RCS = getRCS(flight.category)
+    stateSNR = getSNRBatch(flight.ECEF, RCS)
+    stateCandidate = (flight.AER[:, 1] <= BEAMWIDTH_VERTICAL) & (stateSNR > SNR_Min)
+    visible = getTerrainVisibility(flight)
+    if visible is not None:
+        stateCandidate &= visible
+    return [stateSNR, stateCandidate]
+
+def detectFlightBatch(tPulses: np.ndarray, flight: Flight, chunkSize: int = 1000000) -> List[np.ndarray]:
+    # Array version of simulateFlight, gives the same detections but processes tPulses in chunks of chunkSize
+    [stateSNR, stateCandidate] = getStateDetectability(flight)
+
+    detects = []
+    for chunkStart in range(0, len(tPulses), chunkSize):
+        t = tPulses[chunkStart:chunkStart+chunkSize]
+        detects.append(detectPulses(t, flight, stateSNR, stateCandidate))
+    return concatDetections(detects)
+
+def simulateFlightBatch(tPulses: np.ndarray, flight: Flight, chunkSize: int = 1000000) -> List[Detection]:
+    return toDetections(flight, detectFlightBatch(tPulses, flight, chunkSize))
+
+def getBeamWindows(intervals: np.ndarray, az: np.ndarray) -> np.ndarray:
+    # For targets at azimuth az that hold still over intervals, find every [start, end] window where the beam covers them
+    # Like isInFOV the azimuth check doesn't wrap around north so windows are clipped to the rotation they're in
+    phaseStart = (np.maximum(az - BEAMWIDTH_HORIZONAL, 0) / 360) * ASR11_ROT_S
+    phaseEnd = (np.minimum(az + BEAMWIDTH_HORIZONAL, 360) / 360) * ASR11_ROT_S
+
+    firstRotation = np.floor(intervals[:, 0] / ASR11_ROT_S).astype(int)
+    lastRotation = np.floor(intervals[:, 1] / ASR11_ROT_S).astype(int)
+    rotationCount = lastRotation - firstRotation + 1
+
+    # One row per (interval, rotation) pair
+    intervalIdx = np.repeat(np.arange(len(intervals)), rotationCount)
+    rotation = np.arange(rotationCount.sum()) - np.repeat(np.cumsum(rotationCount) - rotationCount, rotationCount)
+    rotationStart = (firstRotation[intervalIdx] + rotation) * ASR11_ROT_S
+
+    windows = np.empty((len(intervalIdx), 2))
+    windows[:, 0] = np.maximum(rotationStart + phaseStart[intervalIdx], intervals[intervalIdx, 0])
+    windows[:, 1] = np.minimum(rotationStart + phaseEnd[intervalIdx], intervals[intervalIdx, 1])
+    return windows[windows[:, 0] <= windows[:, 1]]
+
+def detectFlightCompiled(tPulses: np.ndarray, flight: Flight) -> List[np.ndarray]:
+    # detectFlightBatch through the compiled kernel, falls back on the NumPy version when numba isn't installed
+    if not kernels.NUMBA_AVAILABLE:
+        return detectFlightBatch(tPulses, flight)
+
+    RCS = getRCS(flight.category)
+    visible = getTerrainVisibility(flight)
+    if visible is None:
+        visible = np.ones(len(flight), dtype=np.bool_)
+    [pulseIdx, stateIdx, snr] = kernels.detectKernel(tPulses, flight.t, flight.AER, flight.ECEF, visible, RCS,
+                                                     transmitterECEF, receiverECEF, DETECT_POWER_SCALAR, DETECT_NOISE, SNR_Min,
+                                                     ASR11_ROT_S, BEAMWIDTH_HORIZONAL, BEAMWIDTH_VERTICAL, MAX_STATE_AGE)
+    if instrument.enabled:
+        countPulses(tPulses, flight.getStateIndices(tPulses), flight, len(pulseIdx))
+    return [tPulses[pulseIdx], stateIdx, snr]
+
+def getPulseCount(pulseInterval: float, simRange: float) -> int:
+    # len(np.arange(0, simRange, pulseInterval))
+    return int(np.ceil(simRange / pulseInterval))
+
+def getBeamPulses(pulseInterval: float, simRange: float, flight: Flight, stateMask: np.ndarray, pulseRange: List[int] = None) -> np.ndarray:
+    # Times of the pulses of np.arange(0, simRange, pulseInterval)[firstPulse:endPulse] that fall inside a beam dwell window
+    # of one of the states in stateMask, padded by a pulse on either side so the exact FOV check still has to be done
+    pulseCount = getPulseCount(pulseInterval, simRange)
+    [firstPulse, endPulse] = pulseRange if pulseRange is not None else [0, pulseCount]
+
+    intervals = flight.getStateIntervals()[stateMask]
+    np.clip(intervals, 0, simRange, out=intervals)
+    windows = getBeamWindows(intervals, flight.AER[stateMask, 0])
+
+    windowFirst = np.clip(np.ceil(windows[:, 0] / pulseInterval).astype(int) - 1, firstPulse, endPulse)
+    windowLast = np.clip(np.floor(windows[:, 1] / pulseInterval).astype(int) + 1, firstPulse - 1, endPulse - 1)
+    windowPulses = np.maximum(windowLast - windowFirst + 1, 0)
+
+    pulseIdx = np.arange(windowPulses.sum()) - np.repeat(np.cumsum(windowPulses) - windowPulses, windowPulses)
+    pulseIdx += np.repeat(windowFirst, windowPulses)
+    return np.unique(pulseIdx) * pulseInterval
+
+def detectFlightBeam(pulseInterval: float, simRange: float, flight: Flight, pulseRange: List[int] = None) -> List[np.ndarray]:
+    # Event driven version of detectFlightBatch(np.arange(0, simRange, pulseInterval)[firstPulse:endPulse], flight)
+    # Only the pulses that fall inside a beam dwell window of a detectable state are evaluated
+    [stateSNR, stateCandidate] = getStateDetectability(flight)
+    t = getBeamPulses(pulseInterval, simRange, flight, stateCandidate, pulseRange)
+    return detectPulses(t, flight, stateSNR, stateCandidate)
+
+def getBeamHits(pulseInterval: float, simRange: float, flight: Flight, pulseRange: List[int] = None) -> List[np.ndarray]:
+    # [t, stateIdx] of every pulse that has the flight in its beam and in sight of both sites, whatever the SNR, a superset of detectFlightBeam's detections
+    inElevation = flight.AER[:, 1] <= BEAMWIDTH_VERTICAL
+    visible = getTerrainVisibility(flight)
+    if visible is not None:
+        inElevation &= visible # Terrain doesn't depend on the receiver's gains or noise either
+    t = getBeamPulses(pulseInterval, simRange, flight, inElevation, pulseRange)
+    idx = flight.getStateIndices(t)
+
+    hit = idx >= 0
+    hit[hit] = inElevation[idx[hit]]
+    hit[hit] = np.abs(flight.AER[idx[hit], 0] - getAz(t[hit])) <= BEAMWIDTH_HORIZONAL
+    return [t[hit], idx[hit].astype(np.int32)]
+
+def getRanges(flight: Flight) -> List[np.ndarray]:
+    # [Rt, Rr] of every state, as getSNRBatch computes them
+    return [np.linalg.norm(flight.ECEF - transmitterECEF, axis=1), np.linalg.norm(flight.ECEF - receiverECEF, axis=1)]
+
+def simulateFlightBeam(pulseInterval: float, simRange: float, flight: Flight) -> List[Detection]:
+    return toDetections(flight, detectFlightBeam(pulseInterval, simRange, flight))
+
+def detectPulseCentric(pulseInterval: float, simRange: float, flights: List[Flight]) -> List[List[np.ndarray]]:
+    # Same detections as detectFlightBeam for every flight, but walks the pulses in time order and asks a FlightIndex
+    # which samples could be in the beam, so the cost follows beam/target coincidences rather than flights x pulses
+    stateDetectability = [getStateDetectability(flight) for flight in flights]
+    index = FlightIndex(flights, stateMasks=[stateCandidate for _, stateCandidate in stateDetectability])
+    stateSNR = [snr for snr, _ in stateDetectability]
+
+    # The beam sweeps one index sector per chunk, only that sector's neighbours can be within BEAMWIDTH_HORIZONAL
+    assert index.sectorWidth >= BEAMWIDTH_HORIZONAL
+    chunkTime = (index.sectorWidth / 360) * ASR11_ROT_S
+    sectorCount = len(index.sectorOffsets) - 1
+    pulseCount = getPulseCount(pulseInterval, simRange)
+
+    # Per flight counters for instrument, a pulse/sample pair that isn't the sample getState would return counts as a state miss
+    # Only detectable samples are indexed so there are no SNR rejects here
+    pairCounts = np.zeros((3, len(flights)), dtype=np.int64)
+
+    detects = []
+    for chunk in range(int(np.ceil(simRange / chunkTime))):
+        t0 = chunk * chunkTime
+        t1 = (chunk + 1) * chunkTime
+        sector = chunk % sectorCount
+        entries = index.query(t0, t1, (sector - 1) * index.sectorWidth, (sector + 2) * index.sectorWidth)
+        if len(entries) == 0:
+            continue
+
+        # Pulses of the chunk each entry is used for, padded by one in case of rounding
+        chunkFirst = int(np.ceil(t0 / pulseInterval))
+        chunkEnd = min(int(np.ceil(t1 / pulseInterval)), pulseCount)
+        entryFirst = np.clip(np.ceil(index.start[entries] / pulseInterval).astype(int) - 1, chunkFirst, chunkEnd)
+        entryLast = np.clip(np.floor(np.minimum(index.nextTime[entries], index.end[entries]) / pulseInterval).astype(int) + 1, chunkFirst - 1, chunkEnd - 1)
+        entryPulses = np.maximum(entryLast - entryFirst + 1, 0)
+
+        pairEntry = np.repeat(entries, entryPulses)
+        pulseIdx = np.arange(entryPulses.sum()) - np.repeat(np.cumsum(entryPulses) - entryPulses, entryPulses) + np.repeat(entryFirst, entryPulses)
+        t = pulseIdx * pulseInterval
+
+        # Exactly the sample getState would return, in the beam
+        hit = (t >= index.start[pairEntry]) & (t < index.nextTime[pairEntry]) & (np.abs(t - index.stateTime[pairEntry]) <= MAX_STATE_AGE)
+        if instrument.enabled:
+            pairCounts[0] += np.bincount(index.flightIdx[pairEntry], minlength=len(flights))
+            pairCounts[1] += np.bincount(index.flightIdx[pairEntry[hit]], minlength=len(flights))
+        hit[hit] = np.abs(index.az[pairEntry[hit]] - getAz(t[hit])) <= BEAMWIDTH_HORIZONAL
+        if instrument.enabled:
+            pairCounts[2] += np.bincount(index.flightIdx[pairEntry[hit]], minlength=len(flights))
+        if hit.any():
+            detects.append([index.flightIdx[pairEntry[hit]], t[hit], index.stateIdx[pairEntry[hit]]])
+
+    for idx in np.flatnonzero(pairCounts[0]):
+        [pulses, found, detections] = pairCounts[:, idx]
+        instrument.count(flights[idx].id, pulses=pulses, stateMisses=pulses - found, fovRejects=found - detections, detections=detections)
+
+    # Regroup by flight, in time order
+    flightDetects = [emptyDetections() for _ in flights]
+    if len(detects) == 0:
+        return flightDetects
+    [flightIdx, t, stateIdx] = [np.concatenate(column) for column in zip(*detects)]
+    order = np.lexsort((t, flightIdx))
+    [flightIdx, t, stateIdx] = [flightIdx[order], t[order], stateIdx[order]]
+    bounds = np.searchsorted(flightIdx, np.arange(len(flights) + 1))
+    for idx in np.flatnonzero(np.diff(bounds)):
+        rows = slice(bounds[idx], bounds[idx+1])
+        flightDetects[idx] = [t[rows], stateIdx[rows], stateSNR[idx][stateIdx[rows]]]
+    return flightDetects
@@ -0,0 +1,162 @@
+from datetime import datetime
+from functools import partial
+from multiprocessing import Pool
+from typing import List, Callable
+import os
+import time
+
+import numpy as np
+
+import flightData
+import simASR11
+import kernels
+import instrument
+import configRegistry
+
+# Runs simASR11 over a day of flights on a process pool without shipping data to the workers
+# Each worker memory maps the flight table (pages are shared between processes) and sets up its simulator once in initWorker
+# Tasks are [flightIdx, firstPulse, endPulse] shards and results come back as the compact [t, stateIdx, snr] arrays from simASR11.detect*
+
+flights: List[flightData.Flight] = None
+simulate: Callable = None
+
+shardsPerProcess = 4 # Work is cut into roughly this many shards per process so the largest ones don't leave cores idle at the end
+minShardPulses = 100000 # Don't bother splitting below this, per task overhead would dominate
+stateCostPulses = 50 # Rough cost of setting up one ADS-B sample in units of evaluated pulses
+
+def simulatePulseRange(detect: Callable, pulseInterval: float, flight: flightData.Flight, firstPulse: int, endPulse: int) -> List[np.ndarray]:
+    # Same values as np.arange(0, simRange, pulseInterval)[firstPulse:endPulse] without holding the whole timeline in memory
+    return detect(np.arange(firstPulse, endPulse) * pulseInterval, flight)
+
+def simulateBeamRange(pulseInterval: float, simRange: float, flight: flightData.Flight, firstPulse: int, endPulse: int) -> List[np.ndarray]:
+    return simASR11.detectFlightBeam(pulseInterval, simRange, flight, [firstPulse, endPulse])
+
+def getSimulator(simMode: str, pulseInterval: float, simRange: float) -> Callable:
+    # Returns simulate(flight, firstPulse, endPulse) -> [t, stateIdx, snr] for 'scalar', 'batch', 'compiled' or 'beam'
+    # Shards only limit which pulses are evaluated, getState always sees the whole flight so there are no seams between shards
+    if simMode == 'beam':
+        return partial(simulateBeamRange, pulseInterval, simRange)
+
+    if simMode == 'batch':
+        return partial(simulatePulseRange, simASR11.detectFlightBatch, pulseInterval)
+    elif simMode == 'compiled':
+        return partial(simulatePulseRange, simASR11.detectFlightCompiled, pulseInterval)
+    return partial(simulatePulseRange, simASR11.detectFlight, pulseInterval)
+
+def initWorker(flightPath: str, tStart: datetime, simMode: str, pulseInterval: float, simRange: float, scenario: configRegistry.Scenario = None,
+               instrumented: bool = False, terrainMask=None):
+    global flights, simulate
+    instrument.enable(instrumented)
+    if scenario is not None:
+        simASR11.setScenario(scenario) # The parent's scenario object, it may have been switched or built with makeScenario
+    simASR11.setTerrain(terrainMask) # Only the two horizon tables are sent, not the elevation grid
+    with instrument.stage('workerFlightLoad'):
+        flights = flightData.loadFlights(flightPath, tStart)
+    simulate = getSimulator(simMode, pulseInterval, simRange)
+
+def simulateShard(shard: List[int]) -> List:
+    # The worker's instrument stats since its last shard ride along with the result, None when instrument is off
+    [flightIdx, firstPulse, endPulse] = shard
+    with instrument.stage('workerSimulate'):
+        detects = simulate(flights[flightIdx], firstPulse, endPulse)
+    return [flightIdx, firstPulse, detects, instrument.takeSnapshot() if instrument.enabled else None]
+
+def getActivePulses(flight: flightData.Flight, pulseInterval: float, pulseCount: int) -> List[int]:
+    # Pulses outside of [first position - MAX_STATE_AGE, last position + MAX_STATE_AGE] can never see the flight
+    # Padded by a pulse either side in case of rounding
+    firstPulse = int(np.ceil((flight.t[0] - flightData.MAX_STATE_AGE) / pulseInterval)) - 1
+    endPulse = int(np.floor((flight.t[-1] + flightData.MAX_STATE_AGE) / pulseInterval)) + 2
+    return [min(max(firstPulse, 0), pulseCount), min(max(endPulse, 0), pulseCount)]
+
+def estimateCost(flight: flightData.Flight, pulses: int, simMode: str) -> float:
+    # The beam scheduler only looks at the pulses inside the beam so its cost is mostly set by the ADS-B samples
+    if simMode == 'beam':
+        pulses = pulses * (2*simASR11.BEAMWIDTH_HORIZONAL / 360)
+    return pulses + len(flight) * stateCostPulses
+
+def planShards(flights: List[flightData.Flight], simMode: str, pulseInterval: float, simRange: float, processes: int) -> List[List]:
+    # Returns [cost, flightIdx, firstPulse, endPulse] shards, largest first
+    pulseCount = simASR11.getPulseCount(pulseInterval, simRange)
+    active = [getActivePulses(flight, pulseInterval, pulseCount) for flight in flights]
+    costs = [estimateCost(flight, endPulse - firstPulse, simMode) for flight, [firstPulse, endPulse] in zip(flights, active)]
+    targetCost = max(sum(costs) / (processes * shardsPerProcess), 1)
+
+    shards = []
+    for flightIdx, (cost, [firstPulse, endPulse]) in enumerate(zip(costs, active)):
+        if endPulse <= firstPulse:
+            continue # Never active during the simulation
+
+        shardCount = int(min(np.ceil(cost / targetCost), max((endPulse - firstPulse) // minShardPulses, 1)))
+        edges = np.linspace(firstPulse, endPulse, shardCount + 1).astype(int)
+        for shardFirst, shardEnd in zip(edges[:-1], edges[1:]):
+            shards.append([cost / shardCount, flightIdx, int(shardFirst), int(shardEnd)])
+
+    shards.sort(key=lambda shard: -shard[0])
+    return shards
+
+class ProgressReporter():
+    def __init__(self, totalCost: float, interval: float = 10):
+        self.totalCost = totalCost
+        self.doneCost = 0
+        self.interval = interval
+        self.tStart = time.time()
+        self.tLastPrint = self.tStart
+
+    def update(self, cost: float):
+        self.doneCost += cost
+        now = time.time()
+        if now - self.tLastPrint < self.interval or self.doneCost <= 0:
+            return
+        self.tLastPrint = now
+        elapsed = now - self.tStart
+        remaining = elapsed * (self.totalCost - self.doneCost) / self.doneCost
+        print(f"Simulated {round(100 * self.doneCost / self.totalCost, 1)}% after {round(elapsed)}s, estimated {round(remaining)}s remaining")
+
+def iterPool(flightPath: str, tStart: datetime, simMode: str, pulseInterval: float, simRange: float, flights: List[flightData.Flight], processes: int = None):
+    # Yields [flightIdx, firstPulse, detects] for each shard as soon as a worker finishes it, in no particular order
+    # flightPath should be a flight table so the workers can memory map it, JSON works but every worker parses its own copy
+    # flights is the caller's copy, only used to plan the shards
+    processes = processes or os.cpu_count()
+    shards = planShards(flights, simMode, pulseInterval, simRange, processes)
+    shardCosts = {(flightIdx, firstPulse): cost for [cost, flightIdx, firstPulse, _] in shards}
+    progress = ProgressReporter(sum(shardCosts.values()))
+
+    if simMode == 'compiled' and kernels.NUMBA_AVAILABLE:
+        kernels.warmup() # Workers then load the kernel from numba's cache instead of each compiling it
+
+    # Largest shards go out first and each worker pulls the next one as soon as it is free
+    initArgs = (flightPath, tStart, simMode, pulseInterval, simRange, simASR11.scenario, instrument.enabled, simASR11.terrainMask)
+    with Pool(processes, initializer=initWorker, initargs=initArgs) as p:
+        for [flightIdx, firstPulse, detects, stats] in p.imap_unordered(simulateShard, [shard[1:] for shard in shards], chunksize=1):
+            progress.update(shardCosts[(flightIdx, firstPulse)])
+            if stats is not None:
+                instrument.merge(stats)
+            yield [flightIdx, firstPulse, detects]
+
+def runPool(flightPath: str, tStart: datetime, simMode: str, pulseInterval: float, simRange: float, flights: List[flightData.Flight], processes: int = None) -> List[List[np.ndarray]]:
+    # iterPool collected into one [t, stateIdx, snr] per flight
+    flightShards = [[] for _ in flights]
+    for [flightIdx, firstPulse, detects] in iterPool(flightPath, tStart, simMode, pulseInterval, simRange, flights, processes):
+        flightShards[flightIdx].append([firstPulse, detects])
+
+    # Stitch each flight's shards back together in time order
+    flightDetects = []
+    with instrument.stage('aggregate'):
+        for shardResults in flightShards:
+            shardResults.sort(key=lambda result: result[0])
+            flightDetects.append(simASR11.concatDetections([detects for _, detects in shardResults]))
+    return flightDetects
+
+def compareModes(flights: List[flightData.Flight], simModeA: str, simModeB: str, pulseInterval: float, simRange: float) -> List[str]:
+    # Runs both modes over flights in this process and returns the ids of flights where the detections differ
+    simulateA = getSimulator(simModeA, pulseInterval, simRange)
+    simulateB = getSimulator(simModeB, pulseInterval, simRange)
+    pulseCount = simASR11.getPulseCount(pulseInterval, simRange)
+
+    mismatches = []
+    for flight in flights:
+        [tA, stateIdxA, snrA] = simulateA(flight, 0, pulseCount)
+        [tB, stateIdxB, snrB] = simulateB(flight, 0, pulseCount)
+        if not (np.array_equal(tA, tB) and np.array_equal(stateIdxA, stateIdxB) and np.allclose(snrA, snrB)):
+            mismatches.append(flight.id)
+    return mismatches
@@ -3,6 +3,8 @@ import scipy
 import matplotlib.pyplot as plt
 import scipy.optimize
 
+from ellipsoidMath import Ellipsoid, solveIntersections
+
 # Center of the reference frame is the transmitter
 # Pulse is transmitted at t=0
 
@@ -34,17 +36,13 @@ targetSemiMinorAxis = np.sqrt((dTargetPath / 2)**2 - (dReceiver/2)**2)
 
 dTargetTruth = np.linalg.norm(targetsENU - receiversENU, axis=1)
 
-def est(p):
-    d1 = np.linalg.norm(p - transmitterENU)
-    d2 = np.linalg.norm(p - receiversENU, axis=1)
-    dist = d1 + d2
-    error = dist - dTargetPath
-    print(f"p = {p}, error = {np.sum(error**2)}")
-    return np.sum(error**2)
-
-general = scipy.optimize.minimize(est, np.zeros(3), method='Nelder-Mead', tol=1e-12)
-print(f"general = {general}")
-# print(f"{est([0, 1e3, 0])}")
+ellipsoids = [Ellipsoid(transmitterENU, receiverENU, rangeSum) for receiverENU, rangeSum in zip(receiversENU, dTargetPath)]
+
+# Gauss-Newton on all ellipsoids at once, solveIntersections takes (N, K) range sums so many targets can be solved together
+# Units here are km so the tolerance is tighter than the default, which is meant for meters
+[position, residual, converged] = solveIntersections(transmitterENU, receiversENU, dTargetPath[None, :], tolerance=1e-9)
+print(f"position = {position[0]}, residual = {residual[0]}, converged = {converged[0]}")
+print(f"ellipsoid residuals = {[ellipsoid.residual(position[0]) for ellipsoid in ellipsoids]}")
 
 # def mapEllipse(a, b, h, k):
 #     # ((x-h)**2 / a**2) + (y**2)/(b**2) = 1
@@ -0,0 +1,141 @@
+from datetime import datetime, timezone
+from typing import List
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import configRegistry
+import detection
+import flightData
+import geometryCache
+import simASR11
+
+# Compares receiver sites, receivers and antennas in one pass over a day of flights
+# Which pulses put an aircraft in the beam and its range from the transmitter don't depend on the receiver, so the beam hits
+# are found once (from the geometry cache) and every site x receiver x antenna combination is evaluated on them with broadcast
+# ranges and SNR, giving the same detections as running sim.py with each combination as its scenario
+# Run from the repository root:
+#   python siteSweep.py --out FlightData/siteSweep.json
+#   python siteSweep.py --sites "Clairemont Hills" "Mount Jurupa" --receivers "Pluto SDR" --detections FlightData/siteSweep/
+
+def getCombinations(sites: List[str], receivers: List[str], antennas: List[str]) -> List[configRegistry.Scenario]:
+    # One scenario per combination, sharing the current scenario's transmitter and SNR_Min
+    base = simASR11.scenario
+    scenarios = []
+    for site in sites:
+        location = configRegistry.getLocation(site)
+        for receiverName in receivers:
+            receiver = configRegistry.getReceiver(receiverName)
+            for antennaName in antennas:
+                antenna = configRegistry.getAntenna(antennaName)
+                scenarios.append(configRegistry.makeScenario(f"{site} / {receiverName} / {antennaName}", base.transmitter, base.transmitterLocation,
+                                                            antenna, receiver, location, base.SNR_Min))
+    return scenarios
+
+def sweep(flights: List[flightData.Flight], geometry: dict, scenarios: List[configRegistry.Scenario], chunkSize: int = 1000000) -> List[np.ndarray]:
+    # Returns a (hits,) mask of detected hits per scenario, in scenario order
+    # Every scenario must share the transmitter the geometry was built for, the receiver range is recomputed per site
+    # hits x sites ranges are done chunkSize hits at a time to bound memory
+    RCS = geometryCache.getHitRCS(geometry, flights)
+    ECEF = np.empty((len(geometry['t']), 3))
+    flightIdx = np.asarray(geometry['flightIdx'])
+    stateIdx = np.asarray(geometry['stateIdx'])
+    bounds = np.searchsorted(flightIdx, np.arange(len(flights) + 1))
+    for idx in np.flatnonzero(np.diff(bounds)):
+        rows = slice(bounds[idx], bounds[idx+1])
+        ECEF[rows] = flights[idx].ECEF[stateIdx[rows]]
+
+    # Sites are shared between the receiver/antenna combinations so the ranges are only worked out once per site
+    sites = sorted(set(scenario.receiverLocation.ECEF for scenario in scenarios))
+    siteIdx = np.array([sites.index(scenario.receiverLocation.ECEF) for scenario in scenarios])
+    siteECEF = np.array(sites)
+    powerScalar = np.array([scenario.powerScalar for scenario in scenarios])
+    noise = np.array([scenario.noise for scenario in scenarios])
+    snrMin = np.array([scenario.SNR_Min for scenario in scenarios])
+
+    detected = np.empty((len(scenarios), len(RCS)), dtype=bool)
+    Rt = np.asarray(geometry['Rt'])
+    for chunkStart in range(0, len(RCS), chunkSize):
+        rows = slice(chunkStart, chunkStart + chunkSize)
+        Rr = np.linalg.norm(ECEF[rows, None, :] - siteECEF[None, :, :], axis=2) # (hits, sites)
+        Rt2 = Rt[rows]*Rt[rows]
+        Rr2 = Rr*Rr
+        factor = RCS[rows, None] / (Rt2[:, None]*Rr2) # Same arithmetic as simASR11.getSNRBatch
+        snr = (powerScalar[None, :] * factor[:, siteIdx]) / noise[None, :]
+        detected[:, rows] = (snr > snrMin[None, :]).T
+    return list(detected)
+
+def summarize(flights: List[flightData.Flight], geometry: dict, scenario: configRegistry.Scenario, detected: np.ndarray) -> dict:
+    flightIdx = np.asarray(geometry['flightIdx'])[detected]
+    counts = np.bincount(flightIdx, minlength=len(flights))
+    with np.errstate(invalid='ignore'):
+        elevationAngle = float(configRegistry.getElevationAngle(scenario))
+    categories = {}
+    for idx in np.flatnonzero(counts):
+        categories[flights[idx].category] = categories.get(flights[idx].category, 0) + 1
+    return {
+        'scenario': scenario.name,
+        'site': scenario.receiverLocation.name,
+        'receiver': scenario.receiver.name,
+        'antenna': scenario.antenna.name,
+        'elevationAngle': elevationAngle if np.isfinite(elevationAngle) else None, # None for a receiver at the transmitter
+        'detections': int(detected.sum()),
+        'flightsDetected': int(np.count_nonzero(counts)),
+        'flightsDetectedByCategory': categories,
+        'detectionsPerFlight': {flights[idx].id: int(counts[idx]) for idx in np.flatnonzero(counts)},
+    }
+
+def writeDetections(path: str, flights: List[flightData.Flight], geometry: dict, scenario: configRegistry.Scenario, detected: np.ndarray):
+    # detection.py records for one combination, SNR worked out for that combination
+    flightIdx = np.asarray(geometry['flightIdx'])[detected]
+    stateIdx = np.asarray(geometry['stateIdx'])[detected]
+    ECEF = np.empty((len(stateIdx), 3))
+    for idx in np.unique(flightIdx):
+        rows = flightIdx == idx
+        ECEF[rows] = flights[idx].ECEF[stateIdx[rows]]
+    RCS = geometryCache.getHitRCS(geometry, flights)[detected]
+    Rt = np.asarray(geometry['Rt'])[detected]
+    Rr = np.linalg.norm(ECEF - np.array(scenario.receiverLocation.ECEF), axis=1)
+    snr = (scenario.powerScalar * (RCS / ((Rt*Rt)*(Rr*Rr)))) / scenario.noise
+    detection.writeDetections(path, detection.chunkToRecords(flights, [flightIdx, np.asarray(geometry['t'])[detected], stateIdx, snr]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate every receiver site x receiver x antenna combination in one pass")
+    parser.add_argument('--flights', default="FlightData/2025_03_01.flights")
+    parser.add_argument('--sim-range', type=float, default=24*60*60)
+    parser.add_argument('--pulse-interval', type=float, default=1e-3)
+    parser.add_argument('--sites', nargs='+', default=None, help="locations.yaml entries, default all")
+    parser.add_argument('--receivers', nargs='+', default=None, help="receivers.yaml entries, default all")
+    parser.add_argument('--antennas', nargs='+', default=None, help="antennas.yaml entries, default all")
+    parser.add_argument('--out', default="FlightData/siteSweep.json")
+    parser.add_argument('--detections', default=None, help="directory to write one detection file per combination to")
+    args = parser.parse_args()
+
+    tStart = datetime(2025, 3, 1, 0, 0, 0, tzinfo=timezone.utc)
+    start = time.time()
+    flights = flightData.loadFlights(args.flights, tStart)
+    geometry = geometryCache.getGeometry(flights, args.pulse_interval, args.sim_range)
+    print(f"Loaded {len(flights)} flights and {len(geometry['t'])} beam hits in {round(time.time() - start, 2)}s")
+
+    scenarios = getCombinations(args.sites or configRegistry.getNames('locations'), args.receivers or configRegistry.getNames('receivers'),
+                                args.antennas or configRegistry.getNames('antennas'))
+    start = time.time()
+    detected = sweep(flights, geometry, scenarios)
+    print(f"Evaluated {len(scenarios)} combinations in {round(time.time() - start, 2)}s")
+
+    results = [summarize(flights, geometry, scenario, mask) for scenario, mask in zip(scenarios, detected)]
+    with open(args.out, 'w') as outFile:
+        json.dump({'transmitter': simASR11.scenario.transmitter.name, 'simRange': args.sim_range, 'pulseInterval': args.pulse_interval,
+                   'flights': len(flights), 'results': results}, outFile, indent=2)
+
+    if args.detections is not None:
+        os.makedirs(args.detections, exist_ok=True)
+        for scenario, mask in zip(scenarios, detected):
+            fileName = scenario.name.replace(" / ", "_").replace(" ", "-") + ".det"
+            writeDetections(os.path.join(args.detections, fileName), flights, geometry, scenario, mask)
+
+    for result in sorted(results, key=lambda result: -result['flightsDetected']):
+        print(f"{result['scenario']:<50}{result['flightsDetected']:>6} flights{result['detections']:>10} detections")
@@ -0,0 +1,167 @@
+from datetime import datetime, timezone
+from typing import List
+import gzip
+import json
+import os
+
+import numpy as np
+import pymap3d
+
+import configRegistry
+import flightData
+import terrain
+
+# Reproducible fake ADS-B days for benchmarking without real data under FlightData/
+# Aircraft fly straight-ish tracks around ONT, helicopters (A7) loiter, and every aircraft randomly drops out for a while
+
+ONTLLA = list(configRegistry.getLocation('ONT Airport').LLA) # Tracks are centred on the site filterData filters around
+
+# Category: [speed m/s, altitude min/max feet, lifetime min/max seconds]
+categoryProfiles = {
+    'A1': [60, 1500, 9000, 600, 3600],
+    'A2': [90, 3000, 15000, 600, 3600],
+    'A3': [180, 2000, 35000, 300, 2400],
+    'A5': [220, 5000, 38000, 300, 2400],
+    'A7': [30, 500, 3000, 1800, 4*3600],
+}
+
+def generateTracks(aircraftCount: int = 200, duration: float = 3600, seed: int = 0, categories: List[str] = None,
+                   gapProbability: float = 0.01, snapshotInterval: float = 5, spread: float = 40e3) -> List[dict]:
+    # Returns one dict per aircraft with hex, category and t (seconds from the start of the day), lat, lon, alt (feet) arrays
+    rng = np.random.default_rng(seed)
+    categories = categories or list(categoryProfiles.keys())
+    snapshotTimes = np.arange(0, duration, snapshotInterval)
+
+    tracks = []
+    for idx in range(aircraftCount):
+        category = str(rng.choice(categories))
+        [speed, altMin, altMax, lifeMin, lifeMax] = categoryProfiles[category]
+
+        life = rng.uniform(lifeMin, lifeMax)
+        tFirst = rng.uniform(-life / 2, duration)
+        t = snapshotTimes[(snapshotTimes >= tFirst) & (snapshotTimes < tFirst + life)]
+        if len(t) < 2:
+            continue
+
+        # Drop outs, each snapshot has gapProbability of starting a gap of up to a couple of minutes
+        keep = np.ones(len(t), dtype=bool)
+        for gapStart in np.flatnonzero(rng.random(len(t)) < gapProbability):
+            keep[gapStart:gapStart + rng.integers(1, int(120 / snapshotInterval) + 2)] = False
+        if keep.sum() < 2:
+            continue
+
+        # Random walk on heading and altitude, integrated on a flat earth around the start point
+        north0, east0 = rng.uniform(-spread, spread, 2)
+        heading = rng.uniform(0, 2*np.pi) + np.cumsum(rng.normal(0, 0.05 if category != 'A7' else 0.3, len(t)))
+        north = north0 + np.cumsum(speed * snapshotInterval * np.cos(heading))
+        east = east0 + np.cumsum(speed * snapshotInterval * np.sin(heading))
+        alt = np.clip(rng.uniform(altMin, altMax) + np.cumsum(rng.normal(0, 100, len(t))), altMin / 2, altMax)
+
+        lat = ONTLLA[0] + north / 111320
+        lon = ONTLLA[1] + east / (111320 * np.cos(np.radians(ONTLLA[0])))
+        tracks.append({
+            'hex': '%06x' % (0xa00000 + idx),
+            'category': category,
+            'speed': speed,
+            't': t[keep],
+            'lat': lat[keep],
+            'lon': lon[keep],
+            'alt': alt[keep],
+            'heading': np.degrees(heading[keep]) % 360,
+        })
+    return tracks
+
+
+def tracksToSnapshots(tracks: List[dict], duration: float, tStart: datetime, snapshotInterval: float = 5) -> List[dict]:
+    # readsb-hist style snapshots as downloadFlightData fetches them, ordered by time
+    snapshots = []
+    rows = {}
+    for track in tracks:
+        for row, t in enumerate(track['t']):
+            rows.setdefault(int(round(t / snapshotInterval)), []).append([track, row])
+
+    for snapshotIdx in range(int(np.ceil(duration / snapshotInterval))):
+        aircraft = []
+        for track, row in rows.get(snapshotIdx, []):
+            aircraft.append({
+                'hex': track['hex'],
+                'type': 'adsb_icao',
+                'category': track['category'],
+                'lat': round(float(track['lat'][row]), 6),
+                'lon': round(float(track['lon'][row]), 6),
+                'alt_baro': int(track['alt'][row]) - 50,
+                'alt_geom': int(track['alt'][row]),
+                'gs': round(track['speed'] * 1.94384, 1), # m/s to knots
+                'track': round(float(track['heading'][row]), 2),
+                'geom_rate': 0,
+                'seen': 0.5,
+                'squawk': '1200',
+                'messages': 100,
+            })
+        snapshots.append({'now': tStart.timestamp() + snapshotIdx * snapshotInterval, 'aircraft': aircraft})
+    return snapshots
+
+
+def writeSnapshots(dirPath: str, snapshots: List[dict], tStart: datetime):
+    os.makedirs(dirPath, exist_ok=True)
+    for snapshot in snapshots:
+        offset = int(snapshot['now'] - tStart.timestamp())
+        fileName = str(offset // 3600).zfill(2) + str((offset // 60) % 60).zfill(2) + str(offset % 60).zfill(2) + "Z.json.gz"
+        with gzip.open(os.path.join(dirPath, fileName), 'wt') as outFile:
+            json.dump(snapshot, outFile)
+
+
+def tracksToFlightData(tracks: List[dict], tStart: datetime, observerLLA: List[float] = ONTLLA) -> dict:
+    # Same {id: [message, ...]} layout filterData writes, with AER and ECEF precomputed
+    data = {}
+    for track in tracks:
+        alt = track['alt'] * 0.3048 # feet to meters
+        AER = np.column_stack(pymap3d.geodetic2aer(track['lat'], track['lon'], alt, *observerLLA))
+        ECEF = np.column_stack(pymap3d.geodetic2ecef(track['lat'], track['lon'], alt))
+        data[track['hex']] = [{
+            't': int(tStart.timestamp() + t),
+            'lat': float(lat),
+            'lon': float(lon),
+            'alt_geom': float(altFeet),
+            'category': track['category'],
+            'AER': aer,
+            'ECEF': ecef,
+        } for t, lat, lon, altFeet, aer, ecef in zip(track['t'], track['lat'], track['lon'], track['alt'], AER.tolist(), ECEF.tolist())]
+    return data
+
+
+def generateDay(outPath: str, aircraftCount: int = 200, duration: float = 3600, seed: int = 0, tStart: datetime = datetime(2025, 3, 1, tzinfo=timezone.utc),
+                writeRaw: bool = True, **trackArgs) -> dict:
+    # Writes <outPath>/snapshots/*.json.gz, <outPath>/flights.json and <outPath>/flights.flights, returns their paths
+    tracks = generateTracks(aircraftCount, duration, seed, **trackArgs)
+    paths = {'snapshots': os.path.join(outPath, "snapshots/"), 'json': os.path.join(outPath, "flights.json"), 'table': os.path.join(outPath, "flights.flights")}
+    if writeRaw:
+        writeSnapshots(paths['snapshots'], tracksToSnapshots(tracks, duration, tStart), tStart)
+
+    data = tracksToFlightData(tracks, tStart)
+    os.makedirs(outPath, exist_ok=True)
+    with open(paths['json'], 'w') as outFile:
+        json.dump(data, outFile)
+    flightData.saveFlightTable(paths['table'], flightData.flightDataToTable(data))
+    return paths
+
+
+def generateDEM(outPath: str, centerLLA: List[float] = ONTLLA, size: float = 2, spacing: float = 1/1200, hillCount: int = 40,
+                seed: int = 0) -> terrain.DEM:
+    # Flat valley at the center's altitude with random Gaussian hills, size degrees across at SRTM3 spacing, written with terrain.saveDEM
+    rng = np.random.default_rng(seed)
+    count = int(round(size / spacing)) + 1
+    lat0 = centerLLA[0] + size / 2 # North up like an .hgt tile
+    lon0 = centerLLA[1] - size / 2
+    lat = lat0 - np.arange(count) * spacing
+    lon = lon0 + np.arange(count) * spacing
+
+    heights = np.full((count, count), centerLLA[2], dtype=np.float32)
+    for _ in range(hillCount):
+        [hillLat, hillLon] = [rng.uniform(lat[-1], lat[0]), rng.uniform(lon[0], lon[-1])]
+        [height, width] = [rng.uniform(200, 1500), rng.uniform(0.01, 0.08)]
+        heights += (height * np.exp(-((lat[:, None] - hillLat)**2 + (lon[None, :] - hillLon)**2) / (2*width*width))).astype(np.float32)
+
+    dem = terrain.DEM(heights, lat0, lon0, -spacing, spacing)
+    terrain.saveDEM(outPath, dem)
+    return terrain.loadDEM(outPath)
@@ -0,0 +1,163 @@
+from typing import List, Tuple
+import hashlib
+import json
+import os
+
+import numpy as np
+import pymap3d
+
+# Terrain line of sight masking for the transmitter -> target and target -> receiver paths
+# The elevation grid is memory mapped, either an SRTM .hgt tile (raw big endian int16) or a .npy grid with a .json sidecar
+# giving where it is (saveDEM writes those). Every site gets a horizon table once: for each azimuth bin the highest elevation
+# angle of the terrain up to each ground range bin. A target is then visible when its elevation angle from the site is above the
+# table entry for its azimuth and ground range, one lookup per ADS-B sample whatever the terrain resolution
+# Heights are used as they come, like the rest of the repo treats altitudes. Refraction is ignored
+
+cachePath = "FlightData/.terrainCache/"
+horizonVersion = 1 # Bump when buildHorizon changes
+hgtVoid = -32768
+
+class DEM():
+    # heights[row, col] is the terrain height at lat0 + row*dLat, lon0 + col*dLon
+    heights: np.ndarray
+    lat0: float
+    lon0: float
+    dLat: float
+    dLon: float
+
+    def __init__(self, heights: np.ndarray, lat0: float, lon0: float, dLat: float, dLon: float):
+        self.heights = heights
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.dLat = dLat
+        self.dLon = dLon
+
+    def fingerprint(self) -> str:
+        digest = hashlib.sha1(json.dumps([self.lat0, self.lon0, self.dLat, self.dLon, list(self.heights.shape)]).encode())
+        digest.update(np.ascontiguousarray(self.heights).tobytes())
+        return digest.hexdigest()
+
+    def getElevation(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        # Bilinear interpolation, nan outside the grid and over voids
+        row = (np.asarray(lat) - self.lat0) / self.dLat
+        col = (np.asarray(lon) - self.lon0) / self.dLon
+        inside = (row >= 0) & (row <= self.heights.shape[0] - 1) & (col >= 0) & (col <= self.heights.shape[1] - 1)
+
+        row0 = np.clip(np.floor(row), 0, self.heights.shape[0] - 2).astype(int)
+        col0 = np.clip(np.floor(col), 0, self.heights.shape[1] - 2).astype(int)
+        rowFrac = np.clip(row - row0, 0, 1)
+        colFrac = np.clip(col - col0, 0, 1)
+        corners = [self.heights[row0 + dRow, col0 + dCol].astype(float) for dRow, dCol in [(0, 0), (0, 1), (1, 0), (1, 1)]]
+        corners = [np.where(corner == hgtVoid, np.nan, corner) for corner in corners]
+
+        height = ((corners[0]*(1 - colFrac) + corners[1]*colFrac)*(1 - rowFrac) +
+                  (corners[2]*(1 - colFrac) + corners[3]*colFrac)*rowFrac)
+        return np.where(inside, height, np.nan)
+
+def parseHgtName(path: str) -> Tuple[float, float]:
+    # N34W118.hgt is the tile whose south west corner is at 34N 118W
+    name = os.path.basename(path).upper()
+    lat = int(name[1:3]) * (1 if name[0] == 'N' else -1)
+    lon = int(name[4:7]) * (1 if name[3] == 'E' else -1)
+    return lat, lon
+
+def loadDEM(path: str) -> DEM:
+    # Memory mapped, only the parts of the grid that get looked at are read
+    if path.lower().endswith(".hgt"):
+        size = int(round(np.sqrt(os.path.getsize(path) // 2)))
+        [south, west] = parseHgtName(path)
+        heights = np.memmap(path, dtype='>i2', mode='r', shape=(size, size)) # Rows go north to south
+        return DEM(heights, south + 1, west, -1 / (size - 1), 1 / (size - 1))
+
+    with open(os.path.splitext(path)[0] + ".json") as inFile:
+        metadata = json.load(inFile)
+    return DEM(np.load(path, mmap_mode='r'), metadata['lat0'], metadata['lon0'], metadata['dLat'], metadata['dLon'])
+
+def saveDEM(path: str, dem: DEM):
+    # .npy grid plus a .json sidecar with the same name
+    np.save(path, np.asarray(dem.heights))
+    with open(os.path.splitext(path)[0] + ".json", 'w') as outFile:
+        json.dump({'lat0': dem.lat0, 'lon0': dem.lon0, 'dLat': dem.dLat, 'dLon': dem.dLon}, outFile)
+
+
+class Horizon():
+    # table[azIdx, rangeIdx] is the highest terrain elevation angle seen from the site within rangeIdx*rangeStep of ground range
+    # along azimuth azIdx*azimuthStep, column 0 has no terrain in front of it
+    siteLLA: Tuple[float, float, float]
+    azimuthStep: float
+    rangeStep: float
+    table: np.ndarray
+
+    def __init__(self, siteLLA: Tuple[float, float, float], azimuthStep: float, rangeStep: float, table: np.ndarray):
+        self.siteLLA = tuple(siteLLA)
+        self.azimuthStep = azimuthStep
+        self.rangeStep = rangeStep
+        self.table = table
+
+    def isVisible(self, az: np.ndarray, el: np.ndarray, srange: np.ndarray) -> np.ndarray:
+        # AER of targets seen from the site, beyond the table's range only the terrain inside it is checked
+        groundRange = srange * np.cos(np.deg2rad(el))
+        azIdx = np.rint(az / self.azimuthStep).astype(int) % self.table.shape[0]
+        rangeIdx = np.minimum((groundRange / self.rangeStep).astype(int), self.table.shape[1] - 1)
+        return el > self.table[azIdx, rangeIdx]
+
+    def isVisibleECEF(self, ECEF: np.ndarray) -> np.ndarray:
+        return self.isVisible(*pymap3d.ecef2aer(ECEF[:, 0], ECEF[:, 1], ECEF[:, 2], *self.siteLLA))
+
+def buildHorizon(dem: DEM, siteLLA: List[float], maxRange: float = 100e3, azimuthStep: float = 0.1, rangeStep: float = 200,
+                 chunkSize: int = 100) -> np.ndarray:
+    # Walks every azimuth out to maxRange in rangeStep steps, chunkSize azimuths at a time
+    azimuths = np.arange(0, 360, azimuthStep)
+    distance = np.arange(1, int(np.ceil(maxRange / rangeStep)) + 1) * rangeStep
+    table = np.full((len(azimuths), len(distance) + 1), -90, dtype=np.float32)
+    for chunkStart in range(0, len(azimuths), chunkSize):
+        az = azimuths[chunkStart:chunkStart + chunkSize, None]
+        [lat, lon, _] = pymap3d.aer2geodetic(np.broadcast_to(az, (len(az), len(distance))), 0, distance[None, :], *siteLLA)
+        height = dem.getElevation(lat, lon)
+        [_, el, _] = pymap3d.geodetic2aer(lat, lon, np.nan_to_num(height), *siteLLA)
+        el[np.isnan(height)] = -90 # Off the grid or a void, nothing in the way
+        table[chunkStart:chunkStart + chunkSize, 1:] = np.maximum.accumulate(el, axis=1)
+    return table
+
+def getHorizon(dem: DEM, siteLLA: List[float], maxRange: float = 100e3, azimuthStep: float = 0.1, rangeStep: float = 200,
+               cacheDir: str = cachePath, demFingerprint: str = None) -> Horizon:
+    # Cached under a key made from the grid, the site and the table resolution, built on a miss
+    params = [horizonVersion, demFingerprint or dem.fingerprint(), [float(value) for value in siteLLA], maxRange, azimuthStep, rangeStep]
+    path = os.path.join(cacheDir, hashlib.sha1(json.dumps(params).encode()).hexdigest() + ".horizon.npy")
+    if not os.path.exists(path):
+        table = buildHorizon(dem, siteLLA, maxRange, azimuthStep, rangeStep)
+        os.makedirs(cacheDir, exist_ok=True)
+        np.save(path + ".tmp.npy", table)
+        os.replace(path + ".tmp.npy", path)
+    return Horizon(siteLLA, azimuthStep, rangeStep, np.load(path))
+
+def getSiteLLA(dem: DEM, LLA: List[float], mastHeight: float = None) -> List[float]:
+    # The site as given, or standing mastHeight above the terrain under it instead of the hand copied altitude
+    if mastHeight is None:
+        return list(LLA)
+    return [LLA[0], LLA[1], float(dem.getElevation(LLA[0], LLA[1])) + mastHeight]
+
+
+class TerrainMask():
+    # Line of sight from both the transmitter and the receiver, what simASR11.setTerrain takes
+    transmitter: Horizon
+    receiver: Horizon
+    key: str # Identifies the terrain and sites for caches built with the mask on
+
+    def __init__(self, transmitter: Horizon, receiver: Horizon, key: str):
+        self.transmitter = transmitter
+        self.receiver = receiver
+        self.key = key
+
+    def getVisibleStates(self, ECEF: np.ndarray) -> np.ndarray:
+        # (N,) mask of the (N, 3) positions neither site has terrain in the way of
+        return self.transmitter.isVisibleECEF(ECEF) & self.receiver.isVisibleECEF(ECEF)
+
+def getTerrainMask(dem: DEM, scenario, mastHeight: float = None, maxRange: float = 100e3, azimuthStep: float = 0.1, rangeStep: float = 200,
+                   cacheDir: str = cachePath) -> TerrainMask:
+    # Horizons for the scenario's transmitter and receiver sites
+    demFingerprint = dem.fingerprint()
+    horizons = [getHorizon(dem, getSiteLLA(dem, location.LLA, mastHeight), maxRange, azimuthStep, rangeStep, cacheDir, demFingerprint)
+                for location in [scenario.transmitterLocation, scenario.receiverLocation]]
+    key = hashlib.sha1(json.dumps([demFingerprint, [horizon.siteLLA for horizon in horizons], maxRange, azimuthStep, rangeStep]).encode()).hexdigest()
+    return TerrainMask(horizons[0], horizons[1], key)
@@ -0,0 +1,74 @@
+import http.server
+import os
+import threading
+
+import pytest
+
+import downloadFlightData
+
+# Downloader against a local http.server serving a temporary readsb-hist tree
+
+truncatedPath = "2025/02/01/000010Z.json.gz"
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def do_GET(self):
+        # truncatedPath promises more bytes than it sends, like a connection dropped mid transfer
+        if self.path.endswith(truncatedPath):
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            self.wfile.write(b'partial')
+            self.close_connection = True
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(tmp_path):
+    served = tmp_path / "served"
+    for relPath in ["2025/02/01/000000Z.json.gz", "2025/02/01/000005Z.json.gz"]:
+        (served / relPath).parent.mkdir(parents=True, exist_ok=True)
+        (served / relPath).write_bytes(relPath.encode())
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), lambda *args: Handler(*args, directory=str(served)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+def getDownloader(stem: str, folder: str) -> downloadFlightData.Downloader:
+    return downloadFlightData.Downloader(stem, folder, workers=2, requestsPerSecond=0, retries=1)
+
+def listParts(folder: str) -> list:
+    return [name for _, _, names in os.walk(folder) for name in names if name.endswith(".part")]
+
+def test_download(server, tmp_path):
+    folder = str(tmp_path / "FlightData") + "/"
+    relPaths = ["2025/02/01/000000Z.json.gz", "2025/02/01/000005Z.json.gz", "2025/02/01/000015Z.json.gz"]
+    counts = getDownloader(server, folder).download(relPaths)
+
+    assert counts == {'skipped': 0, 'downloaded': 2, 'missing': 1, 'failed': 0}
+    for relPath in relPaths[:2]:
+        with open(os.path.join(folder, relPath), 'rb') as inFile:
+            assert inFile.read() == relPath.encode()
+    assert not os.path.exists(os.path.join(folder, relPaths[2]))
+    assert listParts(folder) == []
+
+def test_resume_skips_finished_files(server, tmp_path):
+    folder = str(tmp_path / "FlightData") + "/"
+    relPaths = ["2025/02/01/000000Z.json.gz", "2025/02/01/000005Z.json.gz"]
+    getDownloader(server, folder).download(relPaths[:1])
+
+    counts = getDownloader(server, folder).download(relPaths)
+    assert counts == {'skipped': 1, 'downloaded': 1, 'missing': 0, 'failed': 0}
+
+def test_interrupted_transfer_leaves_no_part(server, tmp_path):
+    folder = str(tmp_path / "FlightData") + "/"
+    counts = getDownloader(server, folder).download([truncatedPath])
+
+    assert counts == {'skipped': 0, 'downloaded': 0, 'missing': 0, 'failed': 1}
+    assert not os.path.exists(os.path.join(folder, truncatedPath))
+    assert listParts(folder) == []
@@ -0,0 +1,75 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import configRegistry
+import flightData
+import kernels
+import simASR11
+import simPool
+import syntheticData
+
+# The compiled kernel and the beam scheduler against the Python paths on a synthetic day with a scenario that detects it
+
+tStart = datetime(2025, 3, 1, tzinfo=timezone.utc)
+pulseInterval = 1e-2
+simRange = 600
+snrMin = 0.1 # Linear, low enough for a good share of the synthetic traffic to be detected
+
+@pytest.fixture(scope='module')
+def flights(tmp_path_factory):
+    paths = syntheticData.generateDay(str(tmp_path_factory.mktemp("day")), 20, simRange, seed=0, tStart=tStart, writeRaw=False)
+    return flightData.loadFlights(paths['table'], tStart)
+
+@pytest.fixture(autouse=True)
+def scenario():
+    previous = simASR11.scenario
+    base = previous
+    simASR11.setScenario(configRegistry.makeScenario("Kernel test", base.transmitter, base.transmitterLocation, base.antenna, base.receiver,
+                                                     base.receiverLocation, snrMin))
+    yield simASR11.scenario
+    simASR11.setScenario(previous)
+
+def runMode(simMode: str, flights: list) -> list:
+    simulate = simPool.getSimulator(simMode, pulseInterval, simRange)
+    pulseCount = simASR11.getPulseCount(pulseInterval, simRange)
+    return [simulate(flight, 0, pulseCount) for flight in flights]
+
+def assertSameDetections(detectsA: list, detectsB: list):
+    for [tA, stateIdxA, snrA], [tB, stateIdxB, snrB] in zip(detectsA, detectsB):
+        np.testing.assert_array_equal(tA, tB)
+        np.testing.assert_array_equal(stateIdxA, stateIdxB)
+        np.testing.assert_array_equal(snrA, snrB)
+
+def test_scenario_detects(flights):
+    detects = runMode('batch', flights)
+    assert sum(len(t) > 0 for [t, _, _] in detects) >= 3
+
+@pytest.mark.parametrize('simMode', ['compiled', 'beam'])
+def test_modes_match_batch(flights, simMode):
+    assertSameDetections(runMode(simMode, flights), runMode('batch', flights))
+
+def test_scalar_matches_batch(flights):
+    # Same pulses and states. getSNR takes the norm of a single vector, which numpy does as a dot product, so its SNR can be
+    # a rounding step away from the row-wise norm that getSNRBatch and the kernel share
+    for [tA, stateIdxA, snrA], [tB, stateIdxB, snrB] in zip(runMode('scalar', flights), runMode('batch', flights)):
+        np.testing.assert_array_equal(tA, tB)
+        np.testing.assert_array_equal(stateIdxA, stateIdxB)
+        np.testing.assert_allclose(snrA, snrB, rtol=1e-12)
+
+def test_compiled_falls_back_without_numba(flights, monkeypatch):
+    monkeypatch.setattr(kernels, 'NUMBA_AVAILABLE', False)
+    assertSameDetections(runMode('compiled', flights), runMode('batch', flights))
+
+def test_kernel_runs_as_python(flights):
+    # What detectKernel is without numba, over the flights' first minute
+    kernel = getattr(kernels.detectKernel, 'py_func', kernels.detectKernel)
+    tPulses = np.arange(0, 60, pulseInterval)
+    for flight in flights:
+        visible = np.ones(len(flight), dtype=np.bool_)
+        args = [tPulses, flight.t, flight.AER, flight.ECEF, visible, simASR11.getRCS(flight.category), simASR11.transmitterECEF,
+                simASR11.receiverECEF, simASR11.DETECT_POWER_SCALAR, simASR11.DETECT_NOISE, simASR11.SNR_Min, simASR11.ASR11_ROT_S,
+                simASR11.BEAMWIDTH_HORIZONAL, simASR11.BEAMWIDTH_VERTICAL, flightData.MAX_STATE_AGE]
+        for resultA, resultB in zip(kernel(*args), kernels.detectKernel(*args)):
+            np.testing.assert_array_equal(resultA, resultB)
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pymap3d
+import pytest
+
+import configRegistry
+import syntheticData
+import terrain
+
+# Line of sight masking over a synthetic valley with an east-west ridge north of the sites
+
+siteLLA = [34.05, -117.6, 300.0]
+ridgeLat = [34.095, 34.105] # About 5km north of the transmitter
+ridgeHeight = 1300.0
+maxRange = 20e3
+
+@pytest.fixture
+def dem(tmp_path):
+    # Flat valley from syntheticData with the ridge raised across the whole grid, back through saveDEM/loadDEM
+    path = str(tmp_path / "valley.npy")
+    valley = syntheticData.generateDEM(path, siteLLA, size=0.6, spacing=1/600, hillCount=0)
+    heights = np.array(valley.heights)
+    lat = valley.lat0 + np.arange(heights.shape[0]) * valley.dLat
+    heights[(lat >= ridgeLat[0]) & (lat <= ridgeLat[1]), :] = ridgeHeight
+    terrain.saveDEM(path, terrain.DEM(heights, valley.lat0, valley.lon0, valley.dLat, valley.dLon))
+    return terrain.loadDEM(path)
+
+@pytest.fixture
+def scenario():
+    base = configRegistry.getScenario('ASR-11 Clairemont Hills')
+    transmitter = configRegistry.makeLocation("Valley transmitter", siteLLA)
+    receiver = configRegistry.makeLocation("Valley receiver", [siteLLA[0] - 0.03, siteLLA[1] + 0.03, siteLLA[2]])
+    return configRegistry.makeScenario("Valley", base.transmitter, transmitter, base.antenna, base.receiver, receiver, base.SNR_Min)
+
+def toECEF(LLA: list) -> np.ndarray:
+    LLA = np.array(LLA)
+    return np.column_stack(pymap3d.geodetic2ecef(LLA[:, 0], LLA[:, 1], LLA[:, 2]))
+
+def test_ridge_masks_low_targets_behind_it(dem, scenario, tmp_path):
+    mask = terrain.getTerrainMask(dem, scenario, maxRange=maxRange, cacheDir=str(tmp_path / "cache"))
+    positions = [
+        [34.15, -117.6, 500],   # Behind the ridge and below it
+        [34.15, -117.55, 800],  # Behind the ridge and below it, off to the side
+        [34.15, -117.6, 8000],  # Behind the ridge but high enough to be seen over it
+        [34.075, -117.6, 500],  # In front of the ridge
+        [33.95, -117.6, 500],   # South, nothing in the way
+        [34.05, -117.45, 500],  # East, nothing in the way
+    ]
+    np.testing.assert_array_equal(mask.getVisibleStates(toECEF(positions)), [False, False, True, True, True, True])
+
+def test_flat_valley_masks_nothing(tmp_path, scenario):
+    flat = syntheticData.generateDEM(str(tmp_path / "flat.npy"), siteLLA, size=0.6, spacing=1/600, hillCount=0)
+    mask = terrain.getTerrainMask(flat, scenario, maxRange=maxRange, cacheDir=str(tmp_path / "cache"))
+    rng = np.random.default_rng(0)
+    LLA = np.column_stack([rng.uniform(33.8, 34.3, 200), rng.uniform(-117.85, -117.35, 200), rng.uniform(400, 10000, 200)])
+    assert mask.getVisibleStates(toECEF(LLA)).all()
+
+def test_second_mask_comes_from_cache(dem, scenario, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = terrain.getTerrainMask(dem, scenario, maxRange=maxRange)
+    cached = sorted(os.listdir(os.path.join(tmp_path, terrain.cachePath)))
+    assert len(cached) == 2 and all(name.endswith(".horizon.npy") for name in cached)
+
+    def rebuilt(*args, **kwargs):
+        raise AssertionError("horizon rebuilt instead of loaded from the cache")
+    monkeypatch.setattr(terrain, 'buildHorizon', rebuilt)
+    second = terrain.getTerrainMask(dem, scenario, maxRange=maxRange)
+
+    assert second.key == first.key
+    np.testing.assert_array_equal(second.transmitter.table, first.transmitter.table)
+    np.testing.assert_array_equal(second.receiver.table, first.receiver.table)
+    assert sorted(os.listdir(os.path.join(tmp_path, terrain.cachePath))) == cached
@@ -0,0 +1,271 @@
+from typing import List, Iterable, Iterator
+import argparse
+import time
+
+import numpy as np
+import pymap3d
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+import detection
+
+# Builds tracks out of unlabeled detections, for the visualization and localization stages after sim.py
+# Detections are consumed in time order one scan (scanTime seconds) at a time. Within a scan the pulses that hit the same
+# aircraft are merged into one measurement (detections within clusterRadius of each other), then each measurement is gated
+# against the live tracks' predicted positions through a KD-tree so the cost follows tracks + measurements rather than their product
+# Tracks are constant velocity Kalman filters in ECEF, all updated together as arrays. A track that hasn't been updated for
+# maxCoast seconds is retired and handed back, so memory only holds the live tracks whatever the length of the input
+# Run from the repository root on a detection file from detectionStream or siteSweep --detections:
+#   python tracker.py FlightData/detections.det --out FlightData/tracks.npy
+
+TRACK_DTYPE = np.dtype([
+    ('trackId', 'i4'),
+    ('t', 'f8'),
+    ('LLA', 'f8', (3,)),
+    ('ECEF', 'f8', (3,)),
+    ('velocity', 'f4', (3,)), # ECEF m/s
+])
+
+def clusterMeasurements(t: np.ndarray, ECEF: np.ndarray, clusterRadius: float) -> List[np.ndarray]:
+    # [t, ECEF, cluster] with one row per cluster of detections closer than clusterRadius, cluster is each detection's row
+    if len(t) <= 1:
+        return [t, ECEF, np.zeros(len(t), dtype=np.int64)]
+    pairs = cKDTree(ECEF).query_pairs(clusterRadius, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(t), len(t)))
+    [count, cluster] = connected_components(graph, directed=False)
+    size = np.bincount(cluster, minlength=count)
+    clusterT = np.bincount(cluster, weights=t, minlength=count) / size
+    clusterECEF = np.column_stack([np.bincount(cluster, weights=ECEF[:, axis], minlength=count) for axis in range(3)]) / size[:, None]
+    return [clusterT, clusterECEF, cluster]
+
+def getTransition(dt: np.ndarray, accelSigma: float) -> List[np.ndarray]:
+    # [F, Q] per dt for a constant velocity model driven by white acceleration noise
+    F = np.repeat(np.eye(6)[None, :, :], len(dt), axis=0)
+    F[:, :3, 3:] = np.eye(3) * dt[:, None, None]
+    q = accelSigma*accelSigma
+    Q = np.zeros((len(dt), 6, 6))
+    Q[:, :3, :3] = np.eye(3) * (q * dt**3 / 3)[:, None, None]
+    Q[:, :3, 3:] = np.eye(3) * (q * dt**2 / 2)[:, None, None]
+    Q[:, 3:, :3] = Q[:, :3, 3:]
+    Q[:, 3:, 3:] = np.eye(3) * (q * dt)[:, None, None]
+    return [F, Q]
+
+class Tracker():
+    # Live tracks, one row each
+    ids: np.ndarray
+    x: np.ndarray       # (tracks, 6) ECEF position and velocity
+    P: np.ndarray       # (tracks, 6, 6)
+    tLast: np.ndarray   # Time of the last update
+    hits: np.ndarray    # Updates so far, confirmed once confirmHits
+    history: List[list] # [t, x] per update, per track
+    labels: List[dict]  # Truth label -> detections, only when labels are passed to update
+
+    def __init__(self, gate: float = 3000, clusterRadius: float = 300, measurementSigma: float = 50, accelSigma: float = 5,
+                 velocitySigma: float = 300, confirmHits: int = 3, maxCoast: float = 20, candidateTracks: int = 4):
+        # gate is how far (m) a measurement can be from a track's predicted position, it has to cover an aircraft's move
+        # over a rotation for a new track that doesn't know its velocity yet
+        self.gate = gate
+        self.clusterRadius = clusterRadius
+        self.R = np.eye(3) * measurementSigma*measurementSigma
+        self.accelSigma = accelSigma
+        self.velocitySigma = velocitySigma
+        self.confirmHits = confirmHits
+        self.maxCoast = maxCoast
+        self.candidateTracks = candidateTracks
+        self.nextId = 0
+
+        self.ids = np.empty(0, dtype=np.int64)
+        self.x = np.empty((0, 6))
+        self.P = np.empty((0, 6, 6))
+        self.tLast = np.empty(0)
+        self.hits = np.empty(0, dtype=np.int64)
+        self.history = []
+        self.labels = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def retire(self, retired: np.ndarray) -> List[dict]:
+        # Drops the tracks in the retired mask, returns the confirmed ones
+        tracks = [self.getTrack(idx) for idx in np.flatnonzero(retired) if self.hits[idx] >= self.confirmHits]
+        keep = ~retired
+        [self.ids, self.x, self.P, self.tLast, self.hits] = [self.ids[keep], self.x[keep], self.P[keep], self.tLast[keep], self.hits[keep]]
+        self.history = [history for history, kept in zip(self.history, keep) if kept]
+        self.labels = [labels for labels, kept in zip(self.labels, keep) if kept]
+        return tracks
+
+    def getTrack(self, idx: int) -> dict:
+        [t, x] = zip(*self.history[idx])
+        return {'trackId': int(self.ids[idx]), 't': np.array(t), 'x': np.array(x), 'labels': self.labels[idx]}
+
+    def update(self, t: np.ndarray, ECEF: np.ndarray, labels: np.ndarray = None) -> List[dict]:
+        # One scan of detections, time ordered after whatever came before. Returns the tracks that were retired
+        if len(t) == 0:
+            return []
+        [clusterT, clusterECEF, cluster] = clusterMeasurements(t, ECEF, self.clusterRadius)
+        retired = self.retire(clusterT.min() - self.tLast > self.maxCoast)
+
+        trackIdx = np.full(len(clusterT), -1)
+        if len(self) > 0:
+            [F, _] = getTransition(np.full(len(self), clusterT.mean()) - self.tLast, self.accelSigma)
+            predicted = np.einsum('nij,nj->ni', F, self.x)[:, :3]
+            trackIdx = self.associate(predicted, clusterECEF)
+
+        assigned = np.flatnonzero(trackIdx >= 0)
+        if len(assigned) > 0:
+            self.correct(trackIdx[assigned], clusterT[assigned], clusterECEF[assigned])
+        unassigned = np.flatnonzero(trackIdx < 0)
+        if len(unassigned) > 0:
+            self.start(clusterT[unassigned], clusterECEF[unassigned])
+            trackIdx[unassigned] = np.arange(len(self) - len(unassigned), len(self))
+
+        if labels is not None:
+            # Counted per (track, label) pair rather than per detection
+            [uniqueLabels, labelIdx] = np.unique(labels, return_inverse=True)
+            [pairs, counts] = np.unique(trackIdx[cluster] * len(uniqueLabels) + labelIdx.reshape(-1), return_counts=True)
+            for pair, count in zip(pairs, counts):
+                [track, label] = divmod(int(pair), len(uniqueLabels))
+                self.labels[track][uniqueLabels[label]] = self.labels[track].get(uniqueLabels[label], 0) + int(count)
+        return retired
+
+    def associate(self, predicted: np.ndarray, ECEF: np.ndarray) -> np.ndarray:
+        # Track for each measurement (-1 for none), greedy over the candidate pairs closest first
+        # Each measurement has its candidateTracks nearest tracks within the gate, so one that loses its nearest track to a
+        # closer measurement falls back to its next candidate instead of starting a new track
+        k = min(self.candidateTracks, len(predicted))
+        [distance, nearest] = cKDTree(predicted).query(ECEF, k=k, distance_upper_bound=self.gate)
+        [distance, nearest] = [distance.reshape(len(ECEF), k), nearest.reshape(len(ECEF), k)]
+        [measurement, candidate] = np.nonzero(np.isfinite(distance))
+        track = nearest[measurement, candidate]
+        order = np.lexsort((track, measurement, distance[measurement, candidate]))
+
+        trackIdx = np.full(len(ECEF), -1)
+        taken = np.zeros(len(predicted), dtype=bool)
+        for pairMeasurement, pairTrack in zip(measurement[order], track[order]):
+            if trackIdx[pairMeasurement] < 0 and not taken[pairTrack]:
+                trackIdx[pairMeasurement] = pairTrack
+                taken[pairTrack] = True
+        return trackIdx
+
+    def correct(self, tracks: np.ndarray, t: np.ndarray, ECEF: np.ndarray):
+        # Predict to each measurement's time then a Kalman update, for all the tracks at once
+        [F, Q] = getTransition(t - self.tLast[tracks], self.accelSigma)
+        x = np.einsum('nij,nj->ni', F, self.x[tracks])
+        P = F @ self.P[tracks] @ F.transpose(0, 2, 1) + Q
+
+        # H = [I 0] so S and K only need the position rows/columns of P
+        S = P[:, :3, :3] + self.R
+        K = P[:, :, :3] @ np.linalg.inv(S)
+        x += np.einsum('nij,nj->ni', K, ECEF - x[:, :3])
+        P -= K @ P[:, :3, :]
+
+        self.x[tracks] = x
+        self.P[tracks] = P
+        self.tLast[tracks] = t
+        self.hits[tracks] += 1
+        for track, tUpdate, xUpdate in zip(tracks, t, x):
+            self.history[track].append([tUpdate, xUpdate])
+
+    def start(self, t: np.ndarray, ECEF: np.ndarray):
+        # Tentative tracks at rest with a velocity uncertainty wide enough for any aircraft
+        x = np.zeros((len(t), 6))
+        x[:, :3] = ECEF
+        P = np.zeros((len(t), 6, 6))
+        P[:, :3, :3] = self.R
+        P[:, 3:, 3:] = np.eye(3) * self.velocitySigma*self.velocitySigma
+
+        self.ids = np.append(self.ids, np.arange(self.nextId, self.nextId + len(t)))
+        self.nextId += len(t)
+        self.x = np.concatenate((self.x, x))
+        self.P = np.concatenate((self.P, P))
+        self.tLast = np.append(self.tLast, t)
+        self.hits = np.append(self.hits, np.ones(len(t), dtype=np.int64))
+        self.history.extend([[tStart, xStart]] for tStart, xStart in zip(t, x))
+        self.labels.extend({} for _ in t)
+
+    def flush(self) -> List[dict]:
+        # Retires every live track, at the end of the input
+        return self.retire(np.ones(len(self), dtype=bool))
+
+
+def iterTracks(scans: Iterable[List[np.ndarray]], tracker: Tracker) -> Iterator[dict]:
+    # Feeds [t, ECEF] or [t, ECEF, labels] scans through tracker, yielding tracks as they are retired
+    for scan in scans:
+        yield from tracker.update(*scan)
+    yield from tracker.flush()
+
+def isTimeOrdered(records: np.ndarray, blockSize: int = 1000000) -> bool:
+    # Checked a block at a time so a memory mapped file isn't read in all at once
+    for blockStart in range(0, len(records), blockSize):
+        t = np.asarray(records['t'][max(blockStart - 1, 0):blockStart + blockSize])
+        if np.any(np.diff(t) < 0):
+            return False
+    return True
+
+def iterRecordScans(records: np.ndarray, scanTime: float, blockSize: int = 1000000) -> Iterator[np.ndarray]:
+    # Records of each scanTime window of time ordered records, read blockSize rows at a time
+    # The last scan of a block may carry on into the next one so it is held back until the next block is read
+    if len(records) == 0:
+        return
+    tFirst = float(records['t'][0])
+    carry = records[:0]
+    for blockStart in range(0, len(records), blockSize):
+        block = np.concatenate((carry, np.asarray(records[blockStart:blockStart + blockSize])))
+        scan = np.floor((block['t'] - tFirst) / scanTime).astype(np.int64)
+        starts = np.flatnonzero(np.diff(scan, prepend=-1))
+        for first, end in zip(starts[:-1], starts[1:]):
+            yield block[first:end]
+        carry = block[starts[-1]:]
+    yield carry
+
+def trackRecords(records: np.ndarray, tracker: Tracker, scanTime: float = 1, blockSize: int = 1000000) -> Iterator[dict]:
+    # Tracks from a detection.py records array (e.g. detection.readDetections), the ADS-B ids are kept as labels
+    # Records must be in time order, they are then streamed blockSize rows at a time so memory doesn't grow with the file
+    # (use sortRecords first for files that aren't, e.g. the ones detectionStream writes one window of flights at a time)
+    if not isTimeOrdered(records, blockSize):
+        raise ValueError("Detections must be in time order, see tracker.sortRecords")
+    scans = ([np.asarray(scan['t']), np.asarray(scan['ECEF']), np.asarray(scan['id'])] for scan in iterRecordScans(records, scanTime, blockSize))
+    return iterTracks(scans, tracker)
+
+def sortRecords(records: np.ndarray) -> np.ndarray:
+    # Time ordered copy, held in memory so the file has to fit in it
+    return np.asarray(records)[np.argsort(records['t'], kind='stable')]
+
+def toRecords(tracks: List[dict]) -> np.ndarray:
+    # One TRACK_DTYPE row per track update
+    records = np.empty(sum(len(track['t']) for track in tracks), dtype=TRACK_DTYPE)
+    if len(records) == 0:
+        return records
+    records['trackId'] = np.concatenate([np.full(len(track['t']), track['trackId']) for track in tracks])
+    records['t'] = np.concatenate([track['t'] for track in tracks])
+    x = np.concatenate([track['x'] for track in tracks])
+    records['ECEF'] = x[:, :3]
+    records['velocity'] = x[:, 3:]
+    records['LLA'] = np.column_stack(pymap3d.ecef2geodetic(x[:, 0], x[:, 1], x[:, 2]))
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Associate detections into tracks")
+    parser.add_argument('detections', help="detection.py records file. Files from sim.py, simPool and detectionStream are written a "
+                        "window of flights at a time rather than in time order, they are sorted in memory first so the whole file has to fit")
+    parser.add_argument('--scan-time', type=float, default=1)
+    parser.add_argument('--gate', type=float, default=3000)
+    parser.add_argument('--max-coast', type=float, default=20)
+    parser.add_argument('--out', default="FlightData/tracks.npy")
+    args = parser.parse_args()
+
+    records = detection.readDetections(args.detections)
+    start = time.time()
+    if not isTimeOrdered(records):
+        print("Detections aren't in time order, sorting them in memory")
+        records = sortRecords(records)
+    tracks = list(trackRecords(records, Tracker(gate=args.gate, maxCoast=args.max_coast), args.scan_time))
+    print(f"Associated {len(records)} detections into {len(tracks)} tracks in {round(time.time() - start, 2)}s")
+    np.save(args.out, toRecords(tracks))
+
+    # Each track's ADS-B ids show how clean the association is, purity is the share of its detections from its main aircraft
+    detections = sum(sum(track['labels'].values()) for track in tracks)
+    pure = sum(max(track['labels'].values()) for track in tracks)
+    aircraft = len(set(max(track['labels'], key=track['labels'].get) for track in tracks))
+    print(f"{aircraft} aircraft, {round(100 * pure / max(detections, 1), 2)}% of tracked detections on their track's main aircraft")